@@ -0,0 +1,392 @@
+import asyncio
+import concurrent.futures
+
+import numpy as np
+import fsspec
+import ujson
+from fsspec.asyn import sync
+
+from utils import parse_envi_header, default_output_file, EnviHeader, EnviHeaderCache, \
+    string_encode, zarray_common, parse_date, chunk_grid, interleave_dims, envi_cube_grid, \
+    grid_paths, grid_chunk_refs, grid_nchunks, envi_data_path
+from shift_kerchunk import kerchunk_shift_rfl, check_mosaic_compatible
+from envi_store import load_references
+from reference_writer import write_references, write_parquet_grid
+from iostats import phase, timed_phase, dump_stats
+
+def list_headers(prefix, suffix="rfl_phase.hdr", storage_options=None, detail=False):
+    '''
+    List the ENVI headers directly under `prefix` whose names end with
+    `suffix`, as full URLs, sorted. With `detail=True`, returns
+    `{url: info}` with the listing's size/ETag/mtime for each header.
+    '''
+    fs, path = fsspec.core.url_to_fs(prefix, **(storage_options or {}))
+    infos = {fs.unstrip_protocol(f["name"]): f for f in fs.ls(path, detail=True)
+             if f["name"].endswith(suffix)}
+    if detail:
+        return dict(sorted(infos.items()))
+    return sorted(infos)
+
+async def _fetch_all(fs, paths, concurrency, method="_cat_file"):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(path):
+        async with semaphore:
+            try:
+                return await getattr(fs, method)(path)
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*[fetch(p) for p in paths])
+
+def _fetch_many(fs, paths, concurrency, method="cat_file"):
+    # `method` of `fs` on every path, with at most `concurrency` calls in
+    # flight; exceptions are returned in place of results
+    if fs.async_impl:
+        return sync(fs.loop, _fetch_all, fs, paths, concurrency, "_" + method)
+
+    def fetch(path):
+        try:
+            return getattr(fs, method)(path)
+        except Exception as e:
+            return e
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(fetch, paths))
+
+def fetch_infos(paths, concurrency=64, storage_options=None):
+    '''
+    `info` (size, ETag, ...) of many files concurrently, as in
+    `fetch_headers`. Paths may use different protocols. Returns
+    `{path: info dict or exception}`; missing files give `FileNotFoundError`.
+    '''
+    by_protocol = {}
+    for path in paths:
+        by_protocol.setdefault(fsspec.core.split_protocol(path)[0], []).append(path)
+    infos = {}
+    for protocol_paths in by_protocol.values():
+        fs, _ = fsspec.core.url_to_fs(protocol_paths[0], **(storage_options or {}))
+        stripped = [fs._strip_protocol(p) for p in protocol_paths]
+        infos.update(zip(protocol_paths, _fetch_many(fs, stripped, concurrency, "info")))
+    return infos
+
+def fetch_headers(paths, concurrency=64, storage_options=None, cache=None, infos=None):
+    '''
+    Fetch and parse many ENVI headers concurrently. Async filesystems (e.g.
+    s3fs) are driven with asyncio on one shared session, with at most
+    `concurrency` requests in flight; other filesystems use a thread pool.
+    Headers found in `cache` (an `EnviHeaderCache`, checked against
+    `infos` from the listing) are neither fetched nor parsed again.
+
+    Returns `{path: EnviHeader or exception}`.
+    '''
+    headers = {}
+    if cache is not None and infos is not None:
+        for path in paths:
+            header = cache.get(path, infos[path])
+            if header is not None:
+                headers[path] = header
+        paths = [p for p in paths if p not in headers]
+    if not paths:
+        return headers
+    fs, _ = fsspec.core.url_to_fs(paths[0], **(storage_options or {}))
+    stripped = [fs._strip_protocol(p) for p in paths]
+    with phase("header fetch"):
+        texts = _fetch_many(fs, stripped, concurrency)
+
+    with phase("header parse"):
+        for path, text in zip(paths, texts):
+            if isinstance(text, Exception):
+                headers[path] = text
+                continue
+            try:
+                headers[path] = parse_envi_header(text.decode(), path)
+            except Exception as e:
+                headers[path] = e
+                continue
+            if cache is not None and infos is not None:
+                cache.put(path, infos[path], headers[path])
+    return headers
+
+def _build_one(rfl_path, rfl_meta, output_file, lines_per_chunk, output_format, bands_per_chunk):
+    return kerchunk_shift_rfl(rfl_path, output_file, lines_per_chunk=lines_per_chunk,
+                              output_format=output_format, rfl_meta=rfl_meta,
+                              bands_per_chunk=bands_per_chunk)
+
+@timed_phase("build_prefix")
+def build_prefix(prefix, suffix="rfl_phase.hdr", output_dir=None, lines_per_chunk=1,
+                 output_format="json", concurrency=64, processes=None,
+                 storage_options=None, header_cache_dir=None, progress=print, bands_per_chunk=None):
+    '''
+    Build SHIFT reflectance references for every header under `prefix`.
+
+    The prefix is listed once, all headers are fetched concurrently (see
+    `fetch_headers`), and references are built and written in a process
+    pool (`lines_per_chunk` and `bands_per_chunk` as in `kerchunk_shift_rfl`).
+    Outputs go next to each header unless `output_dir` is given.
+    With `header_cache_dir`, parsed headers are cached on disk by ETag or
+    mtime, so unchanged headers are not fetched again on later runs.
+    `progress` is called with a one-line message per finished file.
+
+    Returns `(outputs, failures)`: `{hdr_path: output_file}` and
+    `{hdr_path: error message}`.
+    '''
+    infos = list_headers(prefix, suffix, storage_options, detail=True)
+    flist = list(infos)
+    cache = EnviHeaderCache(header_cache_dir) if header_cache_dir is not None else None
+    headers = fetch_headers(flist, concurrency, storage_options, cache=cache, infos=infos)
+
+    outputs = {}
+    failures = {}
+    for path, meta in headers.items():
+        if isinstance(meta, Exception):
+            failures[path] = f"Header: {meta!r}"
+            progress(f"[{len(outputs) + len(failures)}/{len(flist)}] FAILED {path}: {failures[path]}")
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = {}
+        for path, meta in headers.items():
+            if isinstance(meta, Exception):
+                continue
+            output_file = default_output_file(path, output_format)
+            if output_dir is not None:
+                output_file = output_dir.rstrip("/") + "/" + output_file.rsplit("/", 1)[-1]
+            future = pool.submit(_build_one, path, meta, output_file, lines_per_chunk, output_format,
+                                 bands_per_chunk)
+            futures[future] = path
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                outputs[path] = future.result()
+                status = f"OK {path} -> {outputs[path]}"
+            except Exception as e:
+                failures[path] = repr(e)
+                status = f"FAILED {path}: {failures[path]}"
+            progress(f"[{len(outputs) + len(failures)}/{len(flist)}] {status}")
+
+    return outputs, failures
+
+def mosaic_sources(refs, grids):
+    '''
+    `{hdr_path: version}` of the time steps of a time-stacked mosaic, in
+    time order. Mosaics written before sources were recorded get versions
+    of `None`, with paths recovered from the reflectance references.
+    '''
+    attrs = ujson.loads(refs[".zattrs"])
+    if "sources" in attrs:
+        return attrs["sources"]
+    if "reflectance" in grids:
+        data_paths = grid_paths(grids["reflectance"])
+    else:
+        zarray = ujson.loads(refs["reflectance/.zarray"])
+        first = ".".join(["0"]*(len(zarray["shape"]) - 1))
+        data_paths = []
+        for t in range(zarray["shape"][0]):
+            ref = refs[f"reflectance/{t}.{first}"]
+            assert isinstance(ref, list), f"Cannot recover the source file of time step {t} from inlined data."
+            data_paths.append(ref[0])
+    return {f"{path}.hdr": None for path in data_paths}
+
+def time_step_grid(data_path, base, chunks):
+    '''
+    Grid of one time step of a mosaic with header `base` and reflectance
+    `chunks` (time axis first).
+    '''
+    lines_per_chunk = chunks[1 + interleave_dims[base.interleave].index("line")]
+    bands_per_chunk = chunks[1 + interleave_dims[base.interleave].index("band")]
+    # The chunks are those of an existing mosaic, short last chunks included
+    _, _, step_chunks, grid = envi_cube_grid(data_path, base, lines_per_chunk, bands_per_chunk, allow_short=True)
+    assert step_chunks == chunks[1:], f"Chunks {chunks} do not match a time-stacked {base.interleave} mosaic."
+    return grid
+
+def _step_key(var, t, rest):
+    return f"{var}/{t}.{rest}" if rest else f"{var}/{t}"
+
+@timed_phase("update_shift_mosaic")
+def update_shift_mosaic(output_file, prefix, suffix="rfl_phase.hdr", concurrency=64,
+                        storage_options=None, header_cache_dir=None, progress=print):
+    '''
+    Bring an existing time-stacked SHIFT reflectance mosaic (as written by
+    `make-shift-multi.py` or `make-shift-multi-kerchunk.py`, in any output
+    format) up to date with the headers under `prefix`.
+
+    Time steps are matched to headers by name and version (ETag, or mtime
+    and size). Only new and changed headers are fetched. Their references
+    are inserted in date order, time steps whose files were removed are
+    dropped, and references of unchanged time steps are kept as they are.
+    Parquet mosaics only rewrite the record batches from the first changed
+    time step on; JSON and grid files are rewritten from the updated
+    reference set. Headers that fail to parse or do not match the mosaic
+    are reported and retried on the next run.
+
+    Returns `(added, changed, removed, failures)`.
+    '''
+    infos = list_headers(prefix, suffix, storage_options, detail=True)
+    versions = {path: EnviHeaderCache.version(info) for path, info in infos.items()}
+    refs, grids = load_references(output_file, storage_options)
+    sources = mosaic_sources(refs, grids)
+
+    changed = [p for p in versions if p in sources and sources[p] not in (None, versions[p])]
+    added = [p for p in versions if p not in sources]
+    removed = [p for p in sources if p not in versions]
+    # Versions are recorded on the first update of a mosaic that has none
+    if not (added or changed or removed or None in sources.values()):
+        progress(f"{output_file} is up to date ({len(sources)} time steps).")
+        return [], [], [], {}
+
+    cache = EnviHeaderCache(header_cache_dir) if header_cache_dir is not None else None
+    headers = fetch_headers(added + changed, concurrency, storage_options, cache=cache, infos=infos)
+    attrs = ujson.loads(refs[".zattrs"])
+    base = EnviHeader.from_dict({k: v for k, v in attrs.items() if k != "sources"})
+    failures = {}
+    for path, header in headers.items():
+        try:
+            if isinstance(header, Exception):
+                raise header
+            check_mosaic_compatible(base, header, path)
+        except Exception as e:
+            failures[path] = f"Header: {e!r}"
+            progress(f"FAILED {path}: {failures[path]}")
+    updated = [p for p in headers if p not in failures]
+
+    # Failed changed files keep their old references and version
+    new_sources = {p: versions[p] for p in versions if p in sources and p not in changed}
+    new_sources.update({p: sources[p] for p in changed if p in failures})
+    new_sources.update({p: versions[p] for p in updated})
+    order = sorted(new_sources, key=lambda p: (parse_date(p), p))
+    new_sources = {p: new_sources[p] for p in order}
+    old_index = {p: t for t, p in enumerate(sources)}
+    new_index = {p: t for t, p in enumerate(order)}
+    first_changed = next((t for t, p in enumerate(order) if p in updated or old_index[p] != t), len(order))
+
+    zarray = ujson.loads(refs["reflectance/.zarray"])
+    old_shape = list(zarray["shape"])
+    zarray["shape"][0] = len(order)
+    dates = np.array([parse_date(p) for p in order])
+    attrs["sources"] = new_sources
+    meta = {
+        ".zattrs": ujson.dumps(attrs),
+        "reflectance/.zarray": ujson.dumps(zarray),
+        "time/.zarray": ujson.dumps({
+            **zarray_common,
+            "chunks": [len(dates)],
+            "dtype": np.dtype(dates[0]).str,
+            "shape": [len(dates)]
+        }),
+        "time/.zattrs": ujson.dumps({
+            "_ARRAY_DIMENSIONS": ["time"]
+        }),
+        "time/0": string_encode(dates)
+    }
+    data_paths = [envi_data_path(p) for p in order]
+    step_grid = time_step_grid(data_paths[0], base, zarray["chunks"])
+    reflectance_grid = chunk_grid(data_paths, step_grid["offset"], [0] + step_grid["strides"],
+                                  step_grid["length"], path_axis=0)
+
+    if grids:
+        output = {"version": 1, "refs": {**refs, **meta}, "grids": {**grids, "reflectance": reflectance_grid}}
+        write_references(output, output_file, "grid")
+    elif not isinstance(refs, dict):
+        # Parquet: reflectance records before the first changed time step stay as they are
+        for key, value in meta.items():
+            refs[key] = value
+        refs.flush()
+        record_size = refs.record_size
+        chunks_per_step = int(np.prod(grid_nchunks(zarray["shape"][1:], zarray["chunks"][1:])))
+        write_parquet_grid(refs.fs, refs.root, "reflectance", reflectance_grid, zarray["shape"],
+                           zarray["chunks"], record_size, start_record=first_changed*chunks_per_step // record_size)
+        nrecords = -(-len(order)*chunks_per_step // record_size)
+        old_nrecords = -(-old_shape[0]*chunks_per_step // record_size)
+        for record in range(nrecords, old_nrecords):
+            refs.fs.rm_file(f"{refs.root}/reflectance/refs.{record}.parq")
+    else:
+        # Other variables stacked along time (e.g. spatial_ref from MultiZarrToZarr) are the same
+        # for every compatible scene, so new time steps copy those of an unchanged one
+        stacked = [key.rpartition("/")[0] for key in refs if key.endswith("/.zattrs") and key != "time/.zattrs"
+                   and ujson.loads(refs[key]).get("_ARRAY_DIMENSIONS", [])[:1] == ["time"]]
+        template = next((p for p in order if p not in updated), None)
+        assert template is not None or stacked == ["reflectance"], \
+            f"No unchanged time step to copy {stacked} from; rebuild the mosaic."
+        old_paths = list(sources)
+        new_refs = {}
+        for key, value in refs.items():
+            var, _, chunk_key = key.rpartition("/")
+            if var not in stacked or chunk_key.startswith(".z"):
+                new_refs[key] = value
+                continue
+            t, _, rest = chunk_key.partition(".")
+            path = old_paths[int(t)]
+            if path in new_index and path not in updated:
+                new_refs[_step_key(var, new_index[path], rest)] = value
+            if path == template and var != "reflectance":
+                for p in updated:
+                    new_refs[_step_key(var, new_index[p], rest)] = value
+        for var in stacked:
+            var_zarray = ujson.loads(refs[f"{var}/.zarray"])
+            assert var_zarray["chunks"][0] == 1, f"{var} must have one chunk per time step."
+            var_zarray["shape"][0] = len(order)
+            new_refs[f"{var}/.zarray"] = ujson.dumps(var_zarray)
+        new_refs.update(meta)
+        for path in updated:
+            grid = time_step_grid(envi_data_path(path), base, zarray["chunks"])
+            step_refs = grid_chunk_refs("reflectance", grid, zarray["shape"][1:], zarray["chunks"][1:])
+            for key, ref in step_refs:
+                new_refs[_step_key("reflectance", new_index[path], key.partition("/")[2])] = ref
+        write_references({"version": 1, "refs": new_refs}, output_file, "json")
+
+    added = [p for p in added if p in updated]
+    changed = [p for p in changed if p in updated]
+    progress(f"Updated {output_file}: {len(added)} added, {len(changed)} changed, "
+             f"{len(removed)} removed, {len(failures)} failed ({len(order)} time steps).")
+    return added, changed, removed, failures
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Create Kerchunk metadata for all SHIFT reflectance mosaics under a prefix")
+    parser.add_argument("prefix", metavar="Prefix", type=str,
+                        help = "Path or S3 URL of the directory containing the HDR files.")
+    parser.add_argument("--suffix", type=str, default="rfl_phase.hdr",
+                        help = "Only process HDR files whose names end with this suffix.")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help = "Directory for the outputs. Default: next to each HDR file.")
+    parser.add_argument("--lines_per_chunk", metavar="Lines per chunk", type=str, default="1",
+                        help = "Number of reflectance lines per chunk (must divide the number of lines, except with grid output), or 'auto' to target ~32 MiB chunks.")
+    parser.add_argument("--bands_per_chunk", metavar="Bands per chunk", type=int, default=None,
+                        help = "Split each BIL line into chunks of this many bands, so that reads of a few "
+                        "bands only fetch those bands. Requires lines_per_chunk 1.")
+    parser.add_argument("--output_format", choices=["json", "parquet", "grid"], default="json",
+                        help = "Reference format: compact JSON, kerchunk's lazily loaded Parquet, "
+                        "or closed-form grid JSON.")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help = "Maximum number of concurrent header requests.")
+    parser.add_argument("--processes", type=int, default=None,
+                        help = "Number of worker processes. Default: number of CPUs.")
+    parser.add_argument("--header_cache_dir", type=str, default=None,
+                        help = "Directory for caching parsed headers between runs.")
+    parser.add_argument("--update_mosaic", type=str, default=None,
+                        help = "Instead of building per-file references, update this existing "
+                        "time-stacked mosaic reference file with new or changed headers.")
+    parser.add_argument("--stats", type=str, default=None,
+                        help = "Write I/O and timing statistics, with a Chrome trace, to this JSON file.")
+
+    args = parser.parse_args()
+    if args.update_mosaic is not None:
+        with dump_stats(args.stats):
+            added, changed, removed, failures = update_shift_mosaic(
+                args.update_mosaic, args.prefix, args.suffix, concurrency=args.concurrency,
+                header_cache_dir=args.header_cache_dir
+            )
+        for path, err in failures.items():
+            print(f"  {path}: {err}")
+        raise SystemExit
+    # Builds run in worker processes, so only the listing and header phases are recorded
+    with dump_stats(args.stats):
+        outputs, failures = build_prefix(args.prefix, args.suffix, args.output_dir,
+                                         lines_per_chunk=args.lines_per_chunk,
+                                         bands_per_chunk=args.bands_per_chunk,
+                                         output_format=args.output_format,
+                                         concurrency=args.concurrency,
+                                         processes=args.processes,
+                                         header_cache_dir=args.header_cache_dir)
+    print(f"Successfully created {len(outputs)} output files. {len(failures)} failed.")
+    for path, err in failures.items():
+        print(f"  {path}: {err}")
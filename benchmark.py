@@ -0,0 +1,312 @@
+import os
+import time
+import json
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+import numpy as np
+import fsspec
+import xarray as xr
+
+from utils import envi_dtypes, interleave_dims, envi_data_path
+from envi_store import EnviReferenceStore
+from envi_backend import EnviBackendEntrypoint
+from make_envi_kerchunk import make_envi_kerchunk
+from shift_kerchunk import kerchunk_shift_rfl
+
+# Synthetic data
+
+def write_envi_header(hdr_path, fields):
+    '''
+    Write an ENVI header. List values are written as `{a, b, ...}`.
+    '''
+    with open(hdr_path, "w") as f:
+        f.write("ENVI\n")
+        for key, val in fields.items():
+            if isinstance(val, (list, tuple, np.ndarray)):
+                val = "{" + ", ".join(str(v) for v in val) + "}"
+            f.write(f"{key} = {val}\n")
+
+def write_envi(data_path, nlines, nbands, nsamp, dtype="<f4", interleave="bil", seed=0,
+               block_bytes=16 * 2**20, **fields):
+    '''
+    Write a synthetic ENVI file (binary plus ".hdr") of random values,
+    in blocks of about `block_bytes` so that large files can be generated
+    in bounded memory. Extra header `fields` are passed through.
+    '''
+    dtype = np.dtype(dtype)
+    data_type = next(k for k, v in envi_dtypes.items() if v == dtype.newbyteorder("="))
+    sizes = {"line": nlines, "band": nbands, "sample": nsamp}
+    shape = tuple(sizes[d] for d in interleave_dims[interleave])
+    rng = np.random.default_rng(seed)
+    mm = np.memmap(data_path, dtype=dtype, mode="w+", shape=shape)
+    rows = max(1, block_bytes // (int(np.prod(shape[2:])) * dtype.itemsize))
+    for i in range(shape[0]):
+        for j in range(0, shape[1], rows):
+            block = rng.random((min(rows, shape[1] - j),) + shape[2:]) * 1000
+            mm[i, j:j + rows] = block.astype(dtype)
+    mm.flush()
+    del mm
+    write_envi_header(data_path + ".hdr", {
+        "description": "{Synthetic benchmark data}",
+        "samples": nsamp,
+        "lines": nlines,
+        "bands": nbands,
+        "header offset": 0,
+        "file type": "ENVI Standard",
+        "data type": data_type,
+        "interleave": interleave,
+        "byte order": 0 if dtype.byteorder in "<=|" else 1,
+        **fields
+    })
+    return data_path + ".hdr"
+
+def write_synthetic_scene(workdir, nlines, nbands, nsamp, dtype="<f4", interleave="bil", seed=0):
+    '''
+    Write a synthetic radiance/location pair (for `make_envi_kerchunk`) and
+    a SHIFT-style gridded reflectance file (for `kerchunk_shift_rfl`) to
+    `workdir`. Returns `(rdn_hdr, loc_hdr, rfl_hdr)`.
+    '''
+    waves = np.round(np.linspace(380, 2500, nbands), 4)
+    spectral = {"wavelength units": "Nanometers", "wavelength": waves, "fwhm": np.full(nbands, 7.5)}
+    base = f"{workdir}/20220224_{interleave}_{np.dtype(dtype).name}"
+    rdn_hdr = write_envi(f"{base}_rdn", nlines, nbands, nsamp, dtype, interleave, seed, **spectral)
+    loc_hdr = write_envi(f"{base}_loc", nlines, 3, nsamp, "<f8", "bil", seed + 1,
+                         **{"band names": ["Longitude (WGS-84)", "Latitude (WGS-84)", "Elevation (m)"]})
+    rfl_hdr = write_envi(f"{base}_rfl", nlines, nbands, nsamp, dtype, interleave, seed + 2, **spectral, **{
+        "map info": ["UTM", 1, 1, 730000, 3811000, 5, 5, 10, "North", "WGS-84", "units=Meters"],
+        "coordinate system string": ['PROJCS["WGS_1984_UTM_Zone_10N",GEOGCS["GCS_WGS_1984",'
+                                     'DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+                                     'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],'
+                                     'PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",500000.0],'
+                                     'PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-123.0],'
+                                     'PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],'
+                                     'UNIT["Meter",1.0]]']
+    })
+    return rdn_hdr, loc_hdr, rfl_hdr
+
+# Measurements
+
+def measure(f, *args, **kwargs):
+    '''
+    Run `f` once. Returns `(result, seconds, peak traced memory in bytes)`.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def reference_nbytes(output_file):
+    fs, path = fsspec.core.url_to_fs(output_file)
+    return fs.du(path) if fs.isdir(path) else fs.size(path)
+
+def open_references(output_file, output_format):
+    '''
+    Open a reference set the way a user would: stock `reference://` for
+    JSON and Parquet, `EnviReferenceStore` for grid files.
+    '''
+    if output_format == "grid":
+        return xr.open_dataset(EnviReferenceStore(output_file), engine="zarr", consolidated=False)
+    return xr.open_dataset("reference://", engine="zarr", backend_kwargs={
+        "consolidated": False,
+        "storage_options": {"fo": output_file, "remote_protocol": "file"}
+    })
+
+def access_patterns(dims, shape, window, rng):
+    '''
+    Random `isel` selections for each access pattern, given the dimension
+    names and sizes `(line, band, sample)` of a cube.
+    '''
+    line, band, sample = dims
+    nlines, nbands, nsamp = shape
+    wl, ws = min(window, nlines), min(window, nsamp)
+    return {
+        "pixel_spectrum": lambda: {line: rng.integers(nlines), sample: rng.integers(nsamp)},
+        "line": lambda: {line: rng.integers(nlines)},
+        "band_slice": lambda: {band: rng.integers(nbands)},
+        "spatial_window": lambda: {
+            line: slice(i := rng.integers(nlines - wl + 1), i + wl),
+            sample: slice(j := rng.integers(nsamp - ws + 1), j + ws)
+        }
+    }
+
+def benchmark_reads(ds, var, dims, repeat=5, window=64, seed=0):
+    '''
+    Time `repeat` random reads of each access pattern from `ds[var]`.
+    '''
+    rng = np.random.default_rng(seed)
+    shape = tuple(ds.sizes[d] for d in dims)
+    results = []
+    for pattern, selection in access_patterns(dims, shape, window, rng).items():
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            values = ds[var].isel(selection()).values
+            seconds.append(time.perf_counter() - start)
+        median = float(np.median(seconds))
+        results.append({
+            "benchmark": "read",
+            "pattern": pattern,
+            "seconds_first": seconds[0],
+            "seconds_median": median,
+            "bytes": int(values.nbytes),
+            "mb_per_s": values.nbytes / 2**20 / median if median > 0 else None
+        })
+    return results
+
+generators = {
+    # generator: (variable, (line, band, sample) dimension names)
+    "make_envi_kerchunk": ("radiance", ("line", "wavelength", "sample")),
+    "kerchunk_shift_rfl": ("reflectance", ("y", "wavelength", "x"))
+}
+
+def run_benchmarks(workdir, nlines=1000, nbands=285, nsamp=600, dtypes=("<f4",),
+                   interleaves=("bil", "bsq", "bip"), formats=("json", "parquet", "grid"),
+                   lines_per_chunk="1", repeat=5, window=64, progress=print, bands_per_chunk=None):
+    '''
+    Synthesize one scene per dtype and interleave in `workdir`, then build
+    references in every output format and time reference loading and
+    reads. `bands_per_chunk` splits the lines of BIL scenes into band
+    groups. Reads of the radiance through the memory-mapped ENVI backend
+    are timed as format "memmap". Returns the results as a list of
+    dictionaries.
+    '''
+    results = []
+    for dtype in dtypes:
+        for interleave in interleaves:
+            rdn_hdr, loc_hdr, rfl_hdr = write_synthetic_scene(workdir, nlines, nbands, nsamp, dtype, interleave)
+            bands = bands_per_chunk if interleave == "bil" else None
+            case = {"dtype": np.dtype(dtype).str, "interleave": interleave,
+                    "shape": [nlines, nbands, nsamp], "lines_per_chunk": lines_per_chunk,
+                    "bands_per_chunk": bands}
+            for output_format in formats:
+                ext = {"json": ".json", "parquet": ".parq", "grid": ".grid.json"}[output_format]
+                builds = {
+                    "make_envi_kerchunk": lambda: make_envi_kerchunk(
+                        rdn_hdr, loc_hdr, None, envi_data_path(rdn_hdr) + ext,
+                        lines_per_chunk=lines_per_chunk, output_format=output_format,
+                        bands_per_chunk=bands),
+                    "kerchunk_shift_rfl": lambda: kerchunk_shift_rfl(
+                        rfl_hdr, envi_data_path(rfl_hdr) + ext,
+                        lines_per_chunk=lines_per_chunk, output_format=output_format,
+                        bands_per_chunk=bands)
+                }
+                for generator, build in builds.items():
+                    label = {**case, "generator": generator, "format": output_format}
+                    output_file, build_seconds, peak = measure(build)
+                    results.append({**label, "benchmark": "build", "seconds": build_seconds,
+                                    "peak_memory_bytes": peak, "reference_bytes": reference_nbytes(output_file)})
+                    ds, load_seconds, peak = measure(open_references, output_file, output_format)
+                    results.append({**label, "benchmark": "load", "seconds": load_seconds, "peak_memory_bytes": peak})
+                    var, dims = generators[generator]
+                    for result in benchmark_reads(ds, var, dims, repeat, window):
+                        results.append({**label, **result})
+                    ds.close()
+                    progress(f"{generator} {interleave} {np.dtype(dtype).str} {output_format}: "
+                             f"build {build_seconds:.3f} s, load {load_seconds:.3f} s")
+            label = {**case, "generator": "envi_backend", "format": "memmap"}
+            ds, load_seconds, peak = measure(xr.open_dataset, rdn_hdr, engine=EnviBackendEntrypoint,
+                                             name="radiance")
+            results.append({**label, "benchmark": "load", "seconds": load_seconds, "peak_memory_bytes": peak})
+            for result in benchmark_reads(ds, *generators["make_envi_kerchunk"], repeat, window):
+                results.append({**label, **result})
+            ds.close()
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    import zarr
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "fsspec": fsspec.__version__,
+        "xarray": xr.__version__,
+        "zarr": zarr.__version__
+    }
+
+# Results are only compared between runs of the same case: the same scene
+# size and chunking, not just the same generator and format
+result_keys = ("benchmark", "generator", "format", "dtype", "interleave", "shape", "lines_per_chunk",
+               "bands_per_chunk", "pattern")
+
+def compare_results(baseline, current):
+    '''
+    Ratio current/baseline of the time (and peak memory) of every
+    benchmark present in both result files. Values above 1 are slower.
+    '''
+    def key(r):
+        # `shape` is a list
+        return tuple(tuple(v) if isinstance(v, list) else v for v in (r.get(k) for k in result_keys))
+    base = {key(r): r for r in baseline["results"]}
+    ratios = []
+    for r in current["results"]:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        metric = "seconds_median" if r["benchmark"] == "read" else "seconds"
+        ratio = {**dict(zip(result_keys, key(r))), "time_ratio": r[metric] / b[metric] if b[metric] else None}
+        if "peak_memory_bytes" in r:
+            ratio["memory_ratio"] = r["peak_memory_bytes"] / b["peak_memory_bytes"] if b["peak_memory_bytes"] else None
+        ratios.append(ratio)
+    return ratios
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Benchmark reference generation and read-back on synthetic ENVI files")
+    parser.add_argument("--output", type=str, default="benchmark-results.json",
+                        help = "Path to the JSON results file.")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help = "Directory for the synthetic files. Default: a temporary directory.")
+    parser.add_argument("--lines", type=int, default=1000,
+                        help = "Number of lines of the synthetic scenes.")
+    parser.add_argument("--bands", type=int, default=285,
+                        help = "Number of bands of the synthetic scenes.")
+    parser.add_argument("--samples", type=int, default=600,
+                        help = "Number of samples of the synthetic scenes.")
+    parser.add_argument("--dtype", type=str, nargs="+", default=["<f4"],
+                        help = "NumPy dtypes of the synthetic scenes (e.g. <f4 <i2 >f4).")
+    parser.add_argument("--interleave", choices=["bil", "bsq", "bip"], nargs="+", default=["bil", "bsq", "bip"],
+                        help = "Interleaves of the synthetic scenes.")
+    parser.add_argument("--output_format", choices=["json", "parquet", "grid"], nargs="+",
+                        default=["json", "parquet", "grid"],
+                        help = "Reference formats to benchmark.")
+    parser.add_argument("--lines_per_chunk", type=str, default="1",
+                        help = "Number of lines per chunk (must divide the number of lines, except with grid output), or 'auto'.")
+    parser.add_argument("--bands_per_chunk", type=int, default=None,
+                        help = "Number of bands per chunk of BIL scenes (with lines_per_chunk 1).")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help = "Number of random reads per access pattern.")
+    parser.add_argument("--window", type=int, default=64,
+                        help = "Size in lines and samples of the spatial window reads.")
+    parser.add_argument("--compare", type=str, default=None,
+                        help = "Results file of a previous run to compare against.")
+
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+        results = run_benchmarks(workdir, args.lines, args.bands, args.samples, args.dtype,
+                                 args.interleave, args.output_format, args.lines_per_chunk,
+                                 args.repeat, args.window, bands_per_chunk=args.bands_per_chunk)
+    output = {"environment": environment(), "config": vars(args), "results": results}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            output["comparison"] = compare_results(json.load(f), output)
+        for ratio in output["comparison"]:
+            print(" ".join(str(v) for v in ratio.values() if v is not None))
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}.")
@@ -0,0 +1,201 @@
+import numpy as np
+import fsspec
+import pyproj
+
+from utils import parse_date, default_output_file, envi_data_path, EnviHeaderCache
+from batch_kerchunk import list_headers, fetch_headers, fetch_infos
+
+# Reference files looked for next to each header, in order of preference
+REFERENCE_FORMATS = ("grid", "json", "parquet")
+
+# Scenes per Parquet row group. Each row group holds scenes that are close
+# in space (see `zorder`), so its bounding-box statistics prune queries.
+DEFAULT_ROW_GROUP_SIZE = 256
+
+def header_crs(meta):
+    '''
+    CRS of a map-projected ENVI header, from its `coordinate system string`
+    or else its `map info`, or None.
+    '''
+    if "coordinate system string" in meta:
+        return pyproj.CRS(",".join(meta["coordinate system string"]))
+    map_info = meta.get("map info")
+    if map_info is None:
+        return None
+    if map_info[0] == "UTM":
+        return pyproj.CRS.from_dict({"proj": "utm", "zone": int(map_info[7]),
+                                     "south": map_info[8].strip().lower() == "south"})
+    if map_info[0].startswith("Geographic"):
+        return pyproj.CRS.from_epsg(4326)
+    return None
+
+def map_info_bounds(meta):
+    '''
+    `(x_min, y_min, x_max, y_max)` of the pixel edges of a map-projected
+    ENVI file, in its CRS, from `map info` (rotation is not supported).
+    '''
+    map_info = meta["map info"]
+    ref_x, ref_y = float(map_info[1]), float(map_info[2])
+    x_size, y_size = float(map_info[5]), float(map_info[6])
+    # The reference pixel is 1-based
+    x_min = float(map_info[3]) - (ref_x - 1)*x_size
+    y_max = float(map_info[4]) + (ref_y - 1)*y_size
+    return x_min, y_max - meta.lines*y_size, x_min + meta.samples*x_size, y_max
+
+def zorder(lon, lat, bits=16):
+    '''
+    Z-order (Morton) keys of lon/lat points, so that sorting by key keeps
+    nearby points together. NaN points sort last.
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    scale = 2**bits - 1
+    x = np.nan_to_num((lon + 180) / 360 * scale, nan=scale).astype(np.uint64)
+    y = np.nan_to_num((lat + 90) / 180 * scale, nan=scale).astype(np.uint64)
+    keys = np.zeros(x.shape, dtype=np.uint64)
+    for bit in range(bits):
+        keys |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit)
+        keys |= ((y >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit + 1)
+    return keys
+
+def scene_record(path, meta, version=None, reference=None):
+    '''
+    Catalog row of the scene with header `path`: file paths, date, grid,
+    CRS, bounds in that CRS and in lon/lat, and the footprint as a WKT
+    polygon in lon/lat. Headers without map info get NaN bounds.
+    '''
+    try:
+        date = parse_date(path)
+    except AssertionError:
+        date = np.datetime64("NaT")
+    record = {
+        "path": path,
+        "data_path": envi_data_path(path),
+        "reference": reference,
+        "version": version,
+        "date": date,
+        "samples": meta.samples,
+        "lines": meta.lines,
+        "bands": meta.bands,
+        "interleave": meta.interleave,
+        "dtype": meta.dtype.str,
+        "crs": None,
+        "x_size": np.nan, "y_size": np.nan,
+        "x_min": np.nan, "y_min": np.nan, "x_max": np.nan, "y_max": np.nan,
+        "lon_min": np.nan, "lat_min": np.nan, "lon_max": np.nan, "lat_max": np.nan,
+        "footprint": None
+    }
+    crs = header_crs(meta)
+    if crs is None:
+        return record
+    x_min, y_min, x_max, y_max = map_info_bounds(meta)
+    to_lonlat = pyproj.Transformer.from_crs(crs, 4326, always_xy=True)
+    lon_min, lat_min, lon_max, lat_max = to_lonlat.transform_bounds(x_min, y_min, x_max, y_max, densify_pts=21)
+    corners = to_lonlat.transform([x_min, x_max, x_max, x_min, x_min], [y_min, y_min, y_max, y_max, y_min])
+    record.update({
+        "crs": crs.to_string(),
+        "x_size": float(meta["map info"][5]), "y_size": float(meta["map info"][6]),
+        "x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max,
+        "lon_min": lon_min, "lat_min": lat_min, "lon_max": lon_max, "lat_max": lat_max,
+        "footprint": "POLYGON ((" + ", ".join(f"{lon} {lat}" for lon, lat in zip(*corners)) + "))"
+    })
+    return record
+
+def build_catalog(prefix, output_file, suffix="rfl_phase.hdr", concurrency=64, storage_options=None,
+                  header_cache_dir=None, row_group_size=DEFAULT_ROW_GROUP_SIZE, progress=print):
+    '''
+    Build a Parquet catalog of the scenes (ENVI headers ending with
+    `suffix`) under `prefix`, one row per scene (see `scene_record`), with
+    the reference set found next to each header (`REFERENCE_FORMATS`) in
+    the `reference` column.
+
+    Headers are fetched concurrently (and cached with `header_cache_dir`,
+    as in `batch_kerchunk.build_prefix`). Rows are sorted by the Z-order of
+    their lon/lat centers and written in row groups of `row_group_size`,
+    so that the row group statistics act as a spatial index for
+    `query_catalog`. Returns `(output_file, failures)`.
+    '''
+    import pandas as pd
+
+    infos = list_headers(prefix, suffix, storage_options, detail=True)
+    cache = EnviHeaderCache(header_cache_dir) if header_cache_dir is not None else None
+    headers = fetch_headers(list(infos), concurrency, storage_options, cache=cache, infos=infos)
+    candidates = {p: [default_output_file(p, fmt) for fmt in REFERENCE_FORMATS] for p in infos}
+    reference_infos = fetch_infos([r for refs in candidates.values() for r in refs], concurrency, storage_options)
+
+    records = []
+    failures = {}
+    for path, meta in headers.items():
+        try:
+            if isinstance(meta, Exception):
+                raise meta
+            reference = next((r for r in candidates[path] if not isinstance(reference_infos[r], Exception)), None)
+            records.append(scene_record(path, meta, EnviHeaderCache.version(infos[path]), reference))
+        except Exception as e:
+            failures[path] = repr(e)
+            progress(f"FAILED {path}: {failures[path]}")
+
+    df = pd.DataFrame.from_records(records)
+    if len(df):
+        df["date"] = pd.to_datetime(df["date"])
+        keys = zorder((df["lon_min"] + df["lon_max"]) / 2, (df["lat_min"] + df["lat_max"]) / 2)
+        df = df.iloc[np.lexsort((df["date"].values, keys))].reset_index(drop=True)
+    write_catalog(df, output_file, storage_options, row_group_size)
+    progress(f"Wrote {output_file}: {len(df)} scenes, {len(failures)} failed.")
+    return output_file, failures
+
+def write_catalog(df, output_file, storage_options=None, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with fsspec.open(output_file, "wb", **(storage_options or {})) as f:
+        pq.write_table(table, f, row_group_size=row_group_size)
+    return output_file
+
+def query_catalog(catalog, bbox=None, point=None, start=None, end=None, storage_options=None):
+    '''
+    Scenes of a catalog (see `build_catalog`) that intersect `bbox`
+    (`(lon_min, lat_min, lon_max, lat_max)`) or contain `point`
+    (`(lon, lat)`), acquired between the dates `start` and `end`
+    (inclusive; anything `numpy.datetime64` accepts), as a DataFrame in
+    date order. Only the row groups whose statistics can match are read.
+
+    The `reference` column holds the reference set of each scene, and
+    `path` its header, e.g. for `shift_kerchunk.kerchunk_shift_mosaic`.
+    '''
+    import pandas as pd
+
+    if point is not None:
+        bbox = (point[0], point[1], point[0], point[1])
+    filters = []
+    if bbox is not None:
+        lon_min, lat_min, lon_max, lat_max = bbox
+        filters += [("lon_min", "<=", lon_max), ("lon_max", ">=", lon_min),
+                    ("lat_min", "<=", lat_max), ("lat_max", ">=", lat_min)]
+    if start is not None:
+        filters.append(("date", ">=", pd.Timestamp(np.datetime64(start))))
+    if end is not None:
+        filters.append(("date", "<=", pd.Timestamp(np.datetime64(end))))
+    df = pd.read_parquet(catalog, engine="pyarrow", filters=filters or None, storage_options=storage_options)
+    return df.sort_values(["date", "path"]).reset_index(drop=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Build a Parquet catalog of the ENVI scenes under a prefix")
+    parser.add_argument("prefix", metavar="Prefix", type=str,
+                        help = "Path or S3 URL of the directory containing the HDR files.")
+    parser.add_argument("output_file", metavar="Catalog path", type=str,
+                        help = "Path or S3 URL of the output Parquet file.")
+    parser.add_argument("--suffix", type=str, default="rfl_phase.hdr",
+                        help = "Only catalog HDR files whose names end with this suffix.")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help = "Maximum number of concurrent requests.")
+    parser.add_argument("--header_cache_dir", type=str, default=None,
+                        help = "Directory for caching parsed headers between runs.")
+
+    args = parser.parse_args()
+    output_file, failures = build_catalog(args.prefix, args.output_file, args.suffix, args.concurrency,
+                                          header_cache_dir=args.header_cache_dir)
+    for path, err in failures.items():
+        print(f"  {path}: {err}")
@@ -0,0 +1,78 @@
+import numpy as np
+import fsspec
+import xarray as xr
+from fsspec.implementations.local import LocalFileSystem
+from xarray.backends import BackendArray, BackendEntrypoint
+from xarray.core import indexing
+
+from utils import read_envi_header, envi_data_path, envi_memmap, interleave_dims
+
+class EnviBackendArray(BackendArray):
+    '''
+    Lazily indexed ENVI cube over a memory map of a local binary file, in
+    the file's interleave order. Reads are views of the map, so only the
+    pages that hold the selected elements are touched.
+    '''
+
+    def __init__(self, data_path, meta):
+        self.data_path = data_path
+        self.meta = meta
+        sizes = {"line": meta.lines, "band": meta.bands, "sample": meta.samples}
+        self.shape = tuple(sizes[d] for d in interleave_dims[meta.interleave])
+        self.dtype = meta.dtype
+        self._mm = None
+
+    def __getstate__(self):
+        # Pickle (e.g. for dask workers) without the mapped data
+        return {**self.__dict__, "_mm": None}
+
+    def _raw_indexing_method(self, key):
+        if self._mm is None:
+            self._mm = envi_memmap(self.data_path, self.meta)
+        return np.asarray(self._mm[key])
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC,
+                                                  self._raw_indexing_method)
+
+class EnviBackendEntrypoint(BackendEntrypoint):
+    '''
+    xarray backend opening a local ENVI file directly from its header,
+    without any reference file:
+
+        xr.open_dataset("test-data/ang20170323t202244_rdn_7000-7010.hdr",
+                        engine=EnviBackendEntrypoint, name="radiance")
+
+    The cube becomes variable `name` with dimensions `line`, `sample` and
+    `wavelength` (or `band` without wavelengths) in the file's interleave
+    order; `wavelength` and `fwhm` become coordinates and the header the
+    dataset attributes. Remote files can be opened through
+    `EnviReferenceStore.from_header` instead.
+    '''
+
+    description = "Open local ENVI files (header plus binary) through a memory map"
+    open_dataset_parameters = ("filename_or_obj", "drop_variables", "name")
+
+    def open_dataset(self, filename_or_obj, *, drop_variables=None, name="data"):
+        hdr_path = str(filename_or_obj)
+        if not hdr_path.endswith(".hdr"):
+            hdr_path = hdr_path + ".hdr"
+        fs, path = fsspec.core.url_to_fs(hdr_path)
+        assert isinstance(fs, LocalFileSystem), f"The ENVI backend only reads local files. Got {hdr_path}."
+        with fs.open(path, "r") as f:
+            meta = read_envi_header(f)
+
+        band_dim = "wavelength" if meta.wavelength is not None else "band"
+        dim_names = {"line": "line", "band": band_dim, "sample": "sample"}
+        dims = [dim_names[d] for d in interleave_dims[meta.interleave]]
+        data = indexing.LazilyIndexedArray(EnviBackendArray(envi_data_path(path), meta))
+        coords = {}
+        if meta.wavelength is not None:
+            coords["wavelength"] = ("wavelength", meta.wavelength.astype(np.float32))
+            if meta.fwhm is not None:
+                coords["fwhm"] = ("wavelength", meta.fwhm.astype(np.float32))
+        ds = xr.Dataset({name: xr.Variable(dims, data)}, coords=coords, attrs={**meta})
+        return ds.drop_vars(drop_variables or [], errors="ignore")
+
+    def guess_can_open(self, filename_or_obj):
+        return str(filename_or_obj).endswith(".hdr")
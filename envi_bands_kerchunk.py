@@ -0,0 +1,81 @@
+import numpy as np
+import fsspec
+import ujson
+
+from utils import read_envi_header, string_encode, zarray_common, band_variables, \
+    default_output_file, envi_data_path
+from reference_writer import write_references
+
+def kerchunk_envi_bands(hdr_path, output_file=None, lines_per_chunk=1, output_format="json",
+                        validate=False):
+    '''
+    Create references exposing every band of a multi-band ENVI file (e.g.
+    location, observation geometry, uncertainty or mask products) as its
+    own `(line, sample)` variable, named from the header's band names.
+    See `utils.band_variables` for the chunking of each interleave. With
+    `validate`, a sample of chunks is checked against the binary file.
+    '''
+    if output_file is None:
+        output_file = default_output_file(hdr_path, output_format)
+
+    assert hdr_path.endswith(".hdr"), f"Need path to HDR file, not binary. Got {hdr_path}."
+    with fsspec.open(hdr_path, "r") as f:
+        meta = read_envi_header(f)
+
+    nlines = meta.lines
+    nsamp = meta.samples
+    coords = {}
+    for name, n in (("line", nlines), ("sample", nsamp)):
+        coords[f"{name}/.zarray"] = ujson.dumps({
+            **zarray_common,
+            "chunks": [n],
+            "dtype": "<i4",
+            "shape": [n],
+        })
+        coords[f"{name}/.zattrs"] = ujson.dumps({
+            "_ARRAY_DIMENSIONS": [name]
+        })
+        coords[f"{name}/0"] = string_encode(np.arange(n, dtype="<i4"))
+
+    band_refs, band_grids = band_variables(envi_data_path(hdr_path), meta, lines_per_chunk=lines_per_chunk,
+                                           taken=("line", "sample"), allow_short=output_format == "grid")
+    output = {
+        "version": 1,
+        "refs": {
+            ".zgroup": ujson.dumps({"zarr_format": 2}),
+            ".zattrs": ujson.dumps({**meta}),
+            **coords, **band_refs
+        },
+        "grids": band_grids
+    }
+
+    output_file = write_references(output, output_file, output_format)
+
+    if validate:
+        from envi_store import EnviReferenceStore, spot_check_bands
+        data_path = envi_data_path(hdr_path)
+        mismatches = spot_check_bands(EnviReferenceStore(output_file), band_grids, meta, data_path)
+        assert not mismatches, f"References in {output_file} do not match {data_path} at {mismatches}."
+
+    return output_file
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Create Kerchunk metadata with one variable per band of an ENVI file")
+    parser.add_argument("hdr_path", metavar="HDR path", type=str,
+                        help = "Path or S3 URL to the HDR file.")
+    parser.add_argument("--output_file", metavar="Outut JSON path", type=str, default=None,
+                        help = "Path to target output JSON file.")
+    parser.add_argument("--lines_per_chunk", metavar="Lines per chunk", type=str, default="1",
+                        help = "Number of lines per chunk of BSQ and BIP files (must divide the number of lines, except with grid output), or 'auto' to target ~32 MiB chunks. "
+                        "BIL bands are always referenced one line at a time.")
+    parser.add_argument("--output_format", choices=["json", "parquet", "grid"], default="json",
+                        help = "Reference format: compact JSON, kerchunk's lazily loaded Parquet, "
+                        "or closed-form grid JSON.")
+    parser.add_argument("--validate", action="store_true",
+                        help = "Spot-check a sample of chunks of every band against the binary file.")
+
+    args = parser.parse_args()
+    output_file = kerchunk_envi_bands(args.hdr_path, args.output_file, lines_per_chunk=args.lines_per_chunk,
+                                      output_format=args.output_format, validate=args.validate)
+    print(f"Successfully created output file {output_file}.")
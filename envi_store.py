@@ -0,0 +1,655 @@
+import os
+import time
+import base64
+import hashlib
+import threading
+import contextlib
+import collections
+
+import numpy as np
+import fsspec
+import ujson
+import zarr
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.reference import LazyReferenceMapper
+from fsspec.utils import merge_offset_ranges
+from zarr.storage import BaseStore
+
+from utils import read_envi_header, string_encode, zarray_common, \
+    envi_cube_grid, grid_chunk_ref, grid_nchunks, read_envi_region, interleave_dims, \
+    envi_data_path, grid_paths, EnviHeaderCache, GRID_REFERENCE_VERSION
+from iostats import active_stats, timed_cat_ranges
+
+def load_references(fo, storage_options=None):
+    '''
+    Load a reference set from a path (JSON, grid JSON or Parquet directory)
+    or pass through an already loaded dictionary. Returns `(refs, grids)`.
+    '''
+    if not isinstance(fo, str):
+        return fo["refs"], fo.get("grids", {})
+    fs, path = fsspec.core.url_to_fs(fo, **(storage_options or {}))
+    if ".json" not in path and (path.endswith(("parq", "parquet", "/")) or fs.isdir(path)):
+        return LazyReferenceMapper(path, fs=fs), {}
+    with fs.open(path, "rb") as f:
+        output = ujson.load(f)
+    version = output.get("version")
+    assert version in (1, GRID_REFERENCE_VERSION), f"Unknown reference version {version}."
+    return output["refs"], output.get("grids", {})
+
+class ChunkCache:
+    '''
+    Byte ranges of remote files, keyed by path, offset, length and the
+    file's version (ETag, or modification time and size; see
+    `EnviHeaderCache.version`), so that a changed file is never served
+    from the cache. Ranges are kept as files in `cache_dir`, up to
+    `max_bytes` in total, and optionally in memory, up to `memory_bytes`.
+    Both evict the least recently used ranges first. The disk cache
+    persists across runs and can be shared by threads and processes; its
+    recency is the files' modification time, and every write rescans the
+    directory, so that the size limit covers the files of all processes.
+
+    `stats` counts hits (memory and disk), misses and evictions, and the
+    bytes read from the cache and fetched.
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 2**30, memory_bytes=0):
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir is not None else None
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.stats = dict.fromkeys(["memory_hits", "disk_hits", "misses", "evictions",
+                                    "hit_bytes", "miss_bytes"], 0)
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk = collections.OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        # Rebuild the disk index from the cache directory, oldest first
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".chunk"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._disk = collections.OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._disk_size = sum(self._disk.values())
+
+    @staticmethod
+    def _name(path, version, offset, length):
+        key = "\0".join([path, str(version), str(offset), str(length)])
+        return hashlib.sha1(key.encode()).hexdigest() + ".chunk"
+
+    def get(self, path, version, offset, length):
+        name = self._name(path, version, offset, length)
+        with self._lock:
+            data = self._memory.get(name)
+            if data is not None:
+                self._memory.move_to_end(name)
+                self.stats["memory_hits"] += 1
+                self.stats["hit_bytes"] += len(data)
+                return data
+        if self.cache_dir is not None:
+            file = os.path.join(self.cache_dir, name)
+            try:
+                with open(file, "rb") as f:
+                    data = f.read()
+                os.utime(file)
+            except FileNotFoundError:
+                data = None
+        with self._lock:
+            if data is None:
+                # Never cached, or evicted, possibly by another process
+                self._disk_size -= self._disk.pop(name, 0)
+                self.stats["misses"] += 1
+                return None
+            # The file may have been written by another process
+            self._disk_size += len(data) - self._disk.pop(name, 0)
+            self._disk[name] = len(data)
+            self.stats["disk_hits"] += 1
+            self.stats["hit_bytes"] += len(data)
+            self._put_memory(name, data)
+        return data
+
+    def put(self, path, version, offset, length, data):
+        name = self._name(path, version, offset, length)
+        data = bytes(data)
+        with self._lock:
+            self.stats["miss_bytes"] += len(data)
+            self._put_memory(name, data)
+        if self.cache_dir is None or len(data) > self.max_bytes:
+            return
+        file = os.path.join(self.cache_dir, name)
+        # Write under a name unique to this process and thread, so that
+        # readers never see partial chunks and writers never collide
+        tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, file)
+        with self._lock:
+            self._scan()
+            evict = []
+            while self._disk_size > self.max_bytes:
+                old, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                self.stats["evictions"] += 1
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(os.path.join(self.cache_dir, old))
+            except FileNotFoundError:
+                pass
+
+    def _put_memory(self, name, data):
+        # Called with the lock held
+        if len(data) > self.memory_bytes:
+            return
+        self._memory_size += len(data) - len(self._memory.pop(name, b""))
+        self._memory[name] = data
+        while self._memory_size > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            if self.cache_dir is not None:
+                self._scan()
+            for name in list(self._disk):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+            self._disk.clear()
+            self._disk_size = 0
+
+class EnviReferenceStore(BaseStore):
+    '''
+    Read-only Zarr store over ENVI reference sets.
+
+    Chunk keys of variables in `grids` are resolved to byte ranges on
+    demand, so memory use does not depend on the number of chunks. Explicit
+    references (JSON or Parquet) are served as well. Short last chunks are
+    zero-padded to the full chunk size that Zarr expects.
+
+    Reads of many chunks (`getitems`, which Zarr uses for every selection)
+    merge the byte ranges of each file that are at most `max_gap` bytes
+    apart into requests of up to `max_block` bytes, issue them
+    concurrently (at most `concurrency` at a time, on async filesystems
+    such as s3fs) and split the results back into chunks. Adjacent line
+    chunks of a window read thus become a few large requests.
+
+    With `memmap=True`, binaries on local disk (or a mounted shared
+    filesystem) are memory-mapped once each, and their chunks are served as
+    zero-copy views of the map instead of an open/seek/read per chunk.
+
+    With a `cache` (a `ChunkCache`), chunks of remote files are kept
+    locally after the first read, so that repeated reads of the same
+    windows skip the network.
+
+    Reads are recorded in `stats` (an `iostats.IOStats`), or in the
+    statistics of an enclosing `iostats.collect_stats` block.
+
+    Usage:
+
+        store = EnviReferenceStore("output.grid.json")
+        xr.open_dataset(store, engine="zarr", consolidated=False)
+    '''
+
+    _readable = True
+    _listable = True
+    _erasable = False
+    _writeable = False
+
+    def __init__(self, fo, remote_options=None, storage_options=None, memmap=False,
+                 max_gap=64000, max_block=256000000, concurrency=None, cache=None, stats=None):
+        self.refs, self.grids = load_references(fo, storage_options)
+        self.remote_options = remote_options or {}
+        self.memmap = memmap
+        self.max_gap = max_gap
+        self.max_block = max_block
+        self.concurrency = concurrency
+        self.cache = cache
+        self.stats = stats
+        self._versions = {}
+        self._fss = {}
+        self._zarrays = {}
+        self._memmaps = {}
+
+    @classmethod
+    def from_header(cls, hdr_path, name="data", lines_per_chunk=1, remote_options=None, memmap=False,
+                    bands_per_chunk=None, **kwargs):
+        '''
+        Build a store directly from an ENVI header, without writing or
+        reading any reference file. Other keyword arguments go to the
+        constructor.
+        '''
+        with fsspec.open(hdr_path, "r", **(remote_options or {})) as f:
+            meta = read_envi_header(f)
+        dtype = meta.dtype
+        dims, shape, chunks, grid = envi_cube_grid(envi_data_path(hdr_path), meta, lines_per_chunk, bands_per_chunk,
+                                                   allow_short=True)
+        band_dim = "wavelength" if "wavelength" in meta else "band"
+        dim_names = {"line": "line", "band": band_dim, "sample": "sample"}
+        refs = {
+            ".zgroup": ujson.dumps({"zarr_format": 2}),
+            ".zattrs": ujson.dumps({**meta}),
+            f"{name}/.zarray": ujson.dumps({
+                **zarray_common,
+                "chunks": chunks,
+                "dtype": dtype.str,
+                "shape": shape,
+            }),
+            f"{name}/.zattrs": ujson.dumps({
+                "_ARRAY_DIMENSIONS": [dim_names[d] for d in dims]
+            })
+        }
+        if band_dim == "wavelength":
+            waves = meta.wavelength.astype(np.float32)
+            refs["wavelength/.zarray"] = ujson.dumps({
+                **zarray_common,
+                "chunks": [len(waves)],
+                "dtype": "<f4",
+                "shape": [len(waves)],
+            })
+            refs["wavelength/.zattrs"] = ujson.dumps({
+                "_ARRAY_DIMENSIONS": ["wavelength"]
+            })
+            refs["wavelength/0"] = string_encode(waves)
+        return cls({"refs": refs, "grids": {name: grid}}, remote_options=remote_options, memmap=memmap,
+                   **kwargs)
+
+    def _fs(self, path):
+        protocol = fsspec.core.split_protocol(path)[0] or "file"
+        if protocol not in self._fss:
+            self._fss[protocol] = fsspec.filesystem(protocol, **self.remote_options)
+        return self._fss[protocol]
+
+    def _memmap(self, path):
+        # Byte map of a local file, or None if the file is not local
+        if path not in self._memmaps:
+            fs = self._fs(path)
+            mm = None
+            if isinstance(fs, LocalFileSystem):
+                mm = np.memmap(fs._strip_protocol(path), dtype=np.uint8, mode="r")
+            self._memmaps[path] = mm
+        return self._memmaps[path]
+
+    def _cached(self, ref):
+        # Whether chunk `ref` goes through the cache: byte ranges of remote files
+        return self.cache is not None and len(ref) == 3 and not isinstance(self._fs(ref[0]), LocalFileSystem)
+
+    def _version(self, path):
+        if path not in self._versions:
+            self._versions[path] = EnviHeaderCache.version(self._fs(path).info(path))
+        return self._versions[path]
+
+    def _stats(self):
+        return self.stats if self.stats is not None else active_stats()
+
+    def _read(self, ref, var=None, stats=None):
+        if self.memmap:
+            mm = self._memmap(ref[0])
+            if mm is not None:
+                data = mm if len(ref) == 1 else mm[ref[1]:ref[1] + ref[2]]
+                if stats is not None:
+                    stats.chunk(var, "memmap", len(data))
+                return data
+        path = ref[0]
+        if len(ref) == 3 and self._cached(ref):
+            data = self.cache.get(path, self._version(path), ref[1], ref[2])
+            if data is not None:
+                if stats is not None:
+                    stats.chunk(var, "cache", len(data))
+                return data
+        start = time.perf_counter()
+        if len(ref) == 1:
+            data = self._fs(path).cat_file(path)
+        else:
+            data = self._fs(path).cat_file(path, start=ref[1], end=ref[1] + ref[2])
+        if stats is not None:
+            stats.request(var, path, len(data), start, time.perf_counter())
+            stats.chunk(var, "remote", len(data))
+        if len(ref) == 3 and self._cached(ref):
+            self.cache.put(path, self._version(path), ref[1], ref[2], data)
+        return data
+
+    def _zarray(self, var):
+        if var not in self._zarrays:
+            self._zarrays[var] = ujson.loads(self._meta(f"{var}/.zarray"))
+        return self._zarrays[var]
+
+    def _meta(self, key):
+        val = self.refs[key]
+        return val if isinstance(val, (str, bytes)) else val[0]
+
+    def _split_chunk_key(self, key):
+        var, _, chunk_key = key.rpartition("/")
+        if var not in self.grids or chunk_key.startswith(".z"):
+            return None
+        zarray = self._zarray(var)
+        try:
+            index = tuple(int(i) for i in chunk_key.split("."))
+        except ValueError:
+            return None
+        nchunks = grid_nchunks(zarray["shape"], zarray["chunks"])
+        if len(index) != len(nchunks) or not all(0 <= i < n for i, n in zip(index, nchunks)):
+            return None
+        return var, index
+
+    def resolve(self, key):
+        '''
+        Reference of `key`: inline bytes, or a `[path]` / `[path, offset,
+        length]` list. Raises `KeyError` for unknown keys.
+        '''
+        split = self._split_chunk_key(key)
+        if split is not None:
+            var, index = split
+            zarray = self._zarray(var)
+            return grid_chunk_ref(self.grids[var], zarray["shape"], zarray["chunks"], index)
+        val = self.refs[key]
+        if isinstance(val, bytes):
+            return val
+        if isinstance(val, str):
+            if val.startswith("base64:"):
+                return base64.b64decode(val[7:])
+            return val.encode()
+        return list(val)
+
+    def _chunk_nbytes(self, key):
+        var, _, chunk_key = key.rpartition("/")
+        if chunk_key.startswith(".z") or f"{var}/.zarray" not in self:
+            return None
+        zarray = self._zarray(var)
+        return int(np.prod(zarray["chunks"])) * np.dtype(zarray["dtype"]).itemsize
+
+    def _pad(self, key, data):
+        nbytes = self._chunk_nbytes(key)
+        if nbytes is None or len(data) >= nbytes:
+            return data
+        return bytes(data) + bytes(nbytes - len(data))
+
+    def __getitem__(self, key):
+        var, _, chunk_key = key.rpartition("/")
+        stats = None if chunk_key.startswith(".z") else self._stats()
+        ref = self.resolve(key)
+        if isinstance(ref, bytes):
+            if stats is not None:
+                stats.chunk(var, "inline", len(ref))
+            return ref
+        return self._pad(key, self._read(ref, var, stats))
+
+    def getitems(self, keys, *, contexts=None):
+        stats = self._stats()
+        with stats.phase("read") if stats is not None else contextlib.nullcontext():
+            return self._getitems(keys, stats)
+
+    def _getitems(self, keys, stats):
+        out = {}
+        ranges = collections.defaultdict(list)
+        for key in keys:
+            try:
+                ref = self.resolve(key)
+            except KeyError:
+                continue
+            if isinstance(ref, bytes) or len(ref) == 1 or (self.memmap and self._memmap(ref[0]) is not None):
+                out[key] = self[key]
+                continue
+            if self._cached(ref):
+                data = self.cache.get(ref[0], self._version(ref[0]), ref[1], ref[2])
+                if data is not None:
+                    if stats is not None:
+                        stats.chunk(key.rpartition("/")[0], "cache", len(data))
+                    out[key] = self._pad(key, data)
+                    continue
+            ranges[self._fs(ref[0])].append((key, *ref))
+        for fs, items in ranges.items():
+            datas = self._cat_coalesced(fs, items, stats)
+            for key, path, offset, length in items:
+                if self._cached([path, offset, length]):
+                    self.cache.put(path, self._version(path), offset, length, datas[key])
+                out[key] = self._pad(key, datas[key])
+        return out
+
+    def _cat_coalesced(self, fs, items, stats=None):
+        # `items` are (key, path, offset, length) of one filesystem
+        items = sorted(items, key=lambda r: (r[1], r[2]))
+        paths, starts, ends = merge_offset_ranges(
+            [r[1] for r in items], [r[2] for r in items], [r[2] + r[3] for r in items],
+            max_gap=self.max_gap, max_block=self.max_block, sort=False
+        )
+        if stats is not None:
+            timed = timed_cat_ranges(fs, paths, starts, ends, self.concurrency)
+            blocks = [data for data, _, _ in timed]
+        else:
+            kwargs = {"batch_size": self.concurrency} if fs.async_impl and self.concurrency else {}
+            blocks = fs.cat_ranges(paths, starts, ends, **kwargs)
+        out = {}
+        block = 0
+        block_vars = {}
+        for key, path, offset, length in items:
+            while not (paths[block] == path and starts[block] <= offset and offset + length <= ends[block]):
+                block += 1
+            data = blocks[block]
+            if isinstance(data, Exception):
+                raise data
+            start = offset - starts[block]
+            out[key] = memoryview(data)[start:start + length]
+            if stats is not None:
+                var = key.rpartition("/")[0]
+                block_vars.setdefault(block, var)
+                stats.chunk(var, "remote", length)
+        for block, var in block_vars.items():
+            data, start, end = timed[block]
+            stats.request(var, paths[block], len(data), start, end)
+        return out
+
+    def __contains__(self, key):
+        return self._split_chunk_key(key) is not None or key in self.refs
+
+    def _grid_keys(self, var):
+        zarray = self._zarray(var)
+        for index in np.ndindex(*grid_nchunks(zarray["shape"], zarray["chunks"])):
+            yield f"{var}/" + ".".join(str(i) for i in index)
+
+    def __iter__(self):
+        yield from self.refs
+        for var in self.grids:
+            yield from self._grid_keys(var)
+
+    def __len__(self):
+        nchunks = 0
+        for var in self.grids:
+            zarray = self._zarray(var)
+            nchunks += int(np.prod(grid_nchunks(zarray["shape"], zarray["chunks"])))
+        return len(self.refs) + nchunks
+
+    def _metadata_keys(self):
+        # Iterating a lazily loaded Parquet reference set loads every record,
+        # so its metadata keys come from its consolidated metadata instead
+        if isinstance(self.refs, LazyReferenceMapper):
+            keys = list(self.refs.zmetadata)
+        else:
+            keys = [key for key in self.refs if key.rpartition("/")[2].startswith(".z")]
+        return keys + [f"{var}/.zarray" for var in self.grids]
+
+    def listdir(self, path=""):
+        # Computed from metadata keys only, so chunks are never enumerated
+        prefix = path.rstrip("/") + "/" if path else ""
+        names = set()
+        for key in self._metadata_keys():
+            if key.startswith(prefix):
+                names.add(key[len(prefix):].split("/")[0])
+        return sorted(names)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("EnviReferenceStore is read-only.")
+
+    def __delitem__(self, key):
+        raise PermissionError("EnviReferenceStore is read-only.")
+
+
+# Store options by protocol of the referenced binaries: memory maps for
+# local files; on object stores, large coalesced ranges, many in flight
+LOCAL_STORE_OPTIONS = {"memmap": True}
+REMOTE_STORE_OPTIONS = {"max_gap": 2**20, "max_block": 64 * 2**20, "concurrency": 64}
+
+def target_protocols(refs, grids):
+    '''
+    Protocols ("file" for local paths) of the binaries a reference set
+    (`refs` and `grids`, see `load_references`) points to. Parquet
+    reference sets are sampled from the first chunk of each variable, so
+    that their records are not all loaded.
+    '''
+    paths = [path for grid in grids.values() for path in grid_paths(grid)]
+    if isinstance(refs, LazyReferenceMapper):
+        for key in refs.zmetadata:
+            var, _, name = key.rpartition("/")
+            if name == ".zarray":
+                ndim = len(ujson.loads(refs[key])["shape"])
+                ref = refs.get(f"{var}/" + ".".join(["0"]*max(ndim, 1)))
+                if isinstance(ref, list):
+                    paths.append(ref[0])
+    else:
+        paths += [val[0] for val in refs.values() if isinstance(val, list) and val]
+    return {fsspec.core.split_protocol(path)[0] or "file" for path in set(paths)}
+
+# Target size of the Dask chunks of `open_envi_dataset`
+DEFAULT_DASK_CHUNK_BYTES = 128 * 2**20
+
+def aligned_chunks(ds, target_bytes=DEFAULT_DASK_CHUNK_BYTES):
+    '''
+    Dask chunks (`{dim: size}`) for a dataset opened from references, in
+    which every chunk is a whole number of reference chunks of every
+    variable, so that each reference chunk is read by exactly one task.
+
+    The size along each dimension starts at the least common multiple of
+    the reference chunk sizes of the data variables using it. Along the
+    dimensions of the largest variable, innermost first, it then grows by
+    whole multiples until chunks of that variable reach `target_bytes`.
+    '''
+    variables = [v for v in ds.data_vars.values() if v.ndim > 1]
+    sizes = dict(ds.sizes)
+    chunks = {}
+    for var in variables:
+        for dim, size in var.encoding.get("preferred_chunks", {}).items():
+            chunks[dim] = min(sizes[dim], np.lcm(chunks.get(dim, 1), size))
+    if not variables:
+        return chunks
+    largest = max(variables, key=lambda v: v.size * v.dtype.itemsize)
+    nbytes = largest.dtype.itemsize * int(np.prod([chunks.get(d, sizes[d]) for d in largest.dims]))
+    for dim in reversed(largest.dims):
+        base = chunks.get(dim, sizes[dim])
+        multiple = max(1, target_bytes // nbytes)
+        if multiple == 1:
+            break
+        chunks[dim] = min(sizes[dim], base*multiple)
+        nbytes = nbytes // base * chunks[dim]
+    return {dim: int(size) for dim, size in chunks.items()}
+
+def open_envi_dataset(fo, chunks="auto", target_bytes=DEFAULT_DASK_CHUNK_BYTES, storage_options=None,
+                      remote_options=None, cache=None, **kwargs):
+    '''
+    Open a reference set (JSON, grid JSON or Parquet path, or a loaded
+    reference dictionary) as an xarray dataset through `EnviReferenceStore`.
+
+    Store options default by where the referenced binaries are
+    (`LOCAL_STORE_OPTIONS` if they are all local files,
+    `REMOTE_STORE_OPTIONS` otherwise, see `target_protocols`); keyword
+    arguments override them. `cache` is a `ChunkCache`, or True for one in
+    "~/.cache/envi-chunks".
+
+    With `chunks="auto"`, variables are Dask arrays whose chunks are
+    multiples of the reference chunks (see `aligned_chunks`), so parallel
+    computations read every byte once. `chunks` may also be a `{dim: size}`
+    dictionary, or None for lazily loaded NumPy arrays without Dask.
+
+    `line` and `sample` coordinates are added where missing, and a
+    `spatial_ref` variable becomes a coordinate referenced by the
+    `grid_mapping` of the map-projected variables.
+    '''
+    import xarray as xr
+
+    refs, grids = load_references(fo, storage_options)
+    local = target_protocols(refs, grids) <= {"file", "local"}
+    options = dict(LOCAL_STORE_OPTIONS if local else REMOTE_STORE_OPTIONS)
+    options.update(kwargs)
+    if cache is True:
+        cache = ChunkCache("~/.cache/envi-chunks")
+    store = EnviReferenceStore({"refs": refs, "grids": grids}, remote_options=remote_options, cache=cache,
+                               **options)
+    ds = xr.open_dataset(store, engine="zarr", consolidated=False)
+    if chunks == "auto":
+        chunks = aligned_chunks(ds, target_bytes)
+    if chunks is not None:
+        ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+
+    for dim in ("line", "sample"):
+        if dim in ds.dims and dim not in ds.coords:
+            ds = ds.assign_coords({dim: np.arange(ds.sizes[dim], dtype=np.int32)})
+    if "spatial_ref" in ds.data_vars:
+        ds = ds.set_coords("spatial_ref")
+        for var in ds.data_vars.values():
+            if {"x", "y"} <= set(var.dims):
+                var.attrs["grid_mapping"] = "spatial_ref"
+    return ds
+
+def spot_check(store, var, meta, data_path, dims=None, band=None, nchunks=8, seed=0,
+               remote_options=None):
+    '''
+    Compare `nchunks` randomly chosen chunks of `var` in `store` (any Zarr
+    store, e.g. an `EnviReferenceStore`) with a direct read of the ENVI
+    binary `data_path` described by the header `meta`. `dims` are the
+    ENVI dimensions ("line", "band", "sample") of the array axes and
+    default to the file's interleave order; with `band` set, the array is
+    that single band as `(line, sample)`. Returns the keys of the chunks
+    that differ.
+    '''
+    array = zarr.open_array(store, path=var, mode="r")
+    if band is not None:
+        dims = ("line", "sample")
+    elif dims is None:
+        dims = interleave_dims[meta.interleave]
+    assert len(dims) == array.ndim, f"Got dimensions {dims} for {array.ndim}-D variable {var}."
+    nchunks_all = grid_nchunks(array.shape, array.chunks)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, nchunks_all, size=(min(nchunks, int(np.prod(nchunks_all))), len(nchunks_all)))
+    # Always include the last chunk, where short chunks and file ends show up
+    picks = np.unique(np.vstack([picks, np.array(nchunks_all) - 1]), axis=0)
+
+    mismatches = []
+    with fsspec.open(data_path, "rb", **(remote_options or {})) as f:
+        for index in picks:
+            slices = tuple(slice(i*c, min((i + 1)*c, n)) for i, c, n in zip(index, array.chunks, array.shape))
+            region = {"band": [band] if band is not None else range(meta.bands)}
+            region.update({d: range(s.start, s.stop) for d, s in zip(dims, slices)})
+            expected = read_envi_region(f, meta, region["line"], region["band"], region["sample"])
+            order = [("line", "band", "sample").index(d) for d in dims]
+            if band is not None:
+                expected = expected[:, 0, :]
+                order = [0, 1]
+            expected = expected.transpose(order)
+            actual = array[slices]
+            equal_nan = expected.dtype.kind in "fc"
+            if actual.dtype != expected.dtype or not np.array_equal(actual, expected, equal_nan=equal_nan):
+                mismatches.append(f"{var}/" + ".".join(str(i) for i in index))
+    return mismatches
+
+def spot_check_bands(store, grids, meta, data_path, **kwargs):
+    '''
+    `spot_check` the per-band variables made by `utils.band_variables`
+    (`grids` is its second return value). Returns the differing chunk keys.
+    '''
+    if meta.interleave == "bip":
+        return spot_check(store, next(iter(grids)), meta, data_path, **kwargs)
+    mismatches = []
+    for band, var in enumerate(grids):
+        mismatches += spot_check(store, var, meta, data_path, band=band, **kwargs)
+    return mismatches
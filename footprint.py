@@ -0,0 +1,138 @@
+import numpy as np
+import fsspec
+import ujson
+
+from utils import read_envi_region, string_encode, zarray_common, DEFAULT_CHUNK_BYTES
+
+# Order of the values of each bounding box
+BBOX_FIELDS = ["lon_min", "lat_min", "lon_max", "lat_max"]
+
+# Fill value of loc files without a "data ignore value"; never a valid coordinate
+DEFAULT_NODATA = -9999.0
+
+def _read_lon_lat(f, meta, lines, lon_band, lat_band):
+    samples = range(meta.samples)
+    if meta.interleave == "bsq":
+        # Bands are far apart in BSQ, so each is read on its own
+        lon = read_envi_region(f, meta, lines, [lon_band], samples)[:, 0, :]
+        lat = read_envi_region(f, meta, lines, [lat_band], samples)[:, 0, :]
+        return lon, lat
+    block = read_envi_region(f, meta, lines, [lon_band, lat_band], samples)
+    return block[:, 0, :], block[:, 1, :]
+
+def valid_lon_lat(lon, lat, nodata=DEFAULT_NODATA):
+    '''
+    `lon` and `lat` as float64, and where both are finite and not `nodata`.
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    valid = np.isfinite(lon) & np.isfinite(lat) & (lon != nodata) & (lat != nodata)
+    return lon, lat, valid
+
+def _edge(lon, lat, valid, last=False):
+    # First (or last) valid pixel of a line, or None
+    index = np.flatnonzero(valid)
+    if len(index) == 0:
+        return None
+    i = index[-1] if last else index[0]
+    return [float(lon[i]), float(lat[i])]
+
+def line_block_bounds(loc_data, loc_meta, lon_band=0, lat_band=1, lines_per_block=16,
+                      storage_options=None, read_bytes=DEFAULT_CHUNK_BYTES):
+    '''
+    Lon/lat bounding boxes of the blocks of `lines_per_block` lines of a
+    location file, and the footprint of the whole flightline, in a single
+    streaming pass over the file (`read_bytes` at a time).
+
+    Returns `(bounds, footprint)`: a `(nblocks, 4)` float64 array of
+    `BBOX_FIELDS` (NaN for blocks without valid pixels) and a GeoJSON
+    polygon tracing the first and last valid pixel of the first line of
+    every block and of the last line. Pixels equal to the header's
+    `data ignore value` (or -9999) or not finite are ignored.
+    '''
+    nlines = loc_meta.lines
+    nblocks = -(-nlines // lines_per_block)
+    nodata = float(loc_meta.get("data ignore value", DEFAULT_NODATA))
+    line_bytes = loc_meta.bands*loc_meta.samples*loc_meta.dtype.itemsize
+    lines_per_read = lines_per_block*max(1, read_bytes // (lines_per_block*line_bytes))
+
+    bounds = np.full((nblocks, 4), np.nan)
+    left = []
+    right = []
+    with fsspec.open(loc_data, "rb", **(storage_options or {})) as f:
+        for start in range(0, nlines, lines_per_read):
+            lines = range(start, min(start + lines_per_read, nlines))
+            lon, lat, valid = valid_lon_lat(*_read_lon_lat(f, loc_meta, lines, lon_band, lat_band), nodata)
+            for block_start in range(0, len(lines), lines_per_block):
+                block = slice(block_start, block_start + lines_per_block)
+                block_valid = valid[block]
+                if block_valid.any():
+                    block_lon = lon[block][block_valid]
+                    block_lat = lat[block][block_valid]
+                    bounds[(start + block_start) // lines_per_block] = [block_lon.min(), block_lat.min(),
+                                                                          block_lon.max(), block_lat.max()]
+            edge_lines = list(range(0, len(lines), lines_per_block))
+            if lines[-1] == nlines - 1 and len(lines) - 1 not in edge_lines:
+                edge_lines.append(len(lines) - 1)
+            for i in edge_lines:
+                first = _edge(lon[i], lat[i], valid[i])
+                if first is not None:
+                    left.append(first)
+                    right.append(_edge(lon[i], lat[i], valid[i], last=True))
+
+    ring = left + right[::-1]
+    footprint = {"type": "Polygon", "coordinates": [ring + ring[:1]]} if ring else None
+    return bounds, footprint
+
+def line_bounds_refs(bounds, lines_per_block, name="line_bbox"):
+    '''
+    Inline references of a `line_block_bounds` array as variable `name`,
+    with dimensions `(line_block, bbox)`.
+    '''
+    bounds = bounds.astype("<f8")
+    return {
+        f"{name}/.zarray": ujson.dumps({
+            **zarray_common,
+            "chunks": list(bounds.shape),
+            "dtype": bounds.dtype.str,
+            "shape": list(bounds.shape),
+        }),
+        f"{name}/.zattrs": ujson.dumps({
+            "_ARRAY_DIMENSIONS": ["line_block", "bbox"],
+            "lines_per_block": lines_per_block,
+            "bbox": BBOX_FIELDS
+        }),
+        f"{name}/0.0": string_encode(np.ascontiguousarray(bounds))
+    }
+
+def bbox_line_ranges(bounds, bbox, lines_per_block, nlines):
+    '''
+    Minimal `[(start, stop), ...]` line ranges whose blocks (see
+    `line_block_bounds`) intersect `bbox`, given as `(lon_min, lat_min,
+    lon_max, lat_max)`. Consecutive blocks are merged into one range.
+    '''
+    lon_min, lat_min, lon_max, lat_max = bbox
+    bounds = np.asarray(bounds)
+    with np.errstate(invalid="ignore"):
+        hits = (bounds[:, 0] <= lon_max) & (bounds[:, 2] >= lon_min) & \
+            (bounds[:, 1] <= lat_max) & (bounds[:, 3] >= lat_min)
+    ranges = []
+    for block in np.flatnonzero(hits).tolist():
+        start, stop = block*lines_per_block, min((block + 1)*lines_per_block, nlines)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+def select_bbox(ds, bbox, name="line_bbox"):
+    '''
+    Lines of a flightline dataset (from `make_envi_kerchunk` with
+    `bbox_lines`) whose blocks intersect `bbox`; only the chunks of those
+    lines are read. Pixels of the selected lines can still lie outside
+    `bbox`; mask them with the `lat` and `lon` variables if needed.
+    '''
+    index = ds[name]
+    ranges = bbox_line_ranges(index.values, bbox, index.attrs["lines_per_block"], ds.sizes["line"])
+    lines = np.concatenate([np.arange(start, stop) for start, stop in ranges] or [np.arange(0)])
+    return ds.isel(line=lines)
@@ -3,18 +3,23 @@ import fsspec
 
 import ujson
 
-from utils import read_envi_header, string_encode, zarray_common, envi_dtypes
+from utils import read_envi_header, string_encode, zarray_common, \
+    envi_cube_grid, envi_data_path
+from reference_writer import write_references
 
 rfl_path = "s3://gleon-west2-shared/ang20160831t201002_rfl_v1n2/ang20160831t201002_corr_v1n2_img.hdr"
-output_file = rfl_path.replace(".hdr", ".json")
+output_file = envi_data_path(rfl_path) + ".json"
+lines_per_chunk = "auto"
+# Set to split lines into groups of this many bands (BIL only, with lines_per_chunk = 1)
+bands_per_chunk = None
 
 with fsspec.open(rfl_path, "r") as f:
     rfl_meta = read_envi_header(f)
 
-nsamp = int(rfl_meta["samples"])
-nlines = int(rfl_meta["lines"])
+nsamp = rfl_meta.samples
+nlines = rfl_meta.lines
 
-waves = np.array(rfl_meta["wavelength"], np.float32)
+waves = rfl_meta.wavelength.astype(np.float32)
 waves_b64 = string_encode(waves)
 
 waves_dict = {
@@ -60,26 +65,21 @@ samps_dict = {
     "sample/0": samps_b64
 }
 
-rfl_data = rfl_path.rstrip(".hdr")
-rfl_byte_order = {"0": "<", "1": ">"}[rfl_meta["byte order"]]
-rfl_dtype = envi_dtypes[rfl_meta["data type"]].newbyteorder(rfl_byte_order)
-rdn_interleave = rfl_meta["interleave"]
-assert rdn_interleave == "bil", f"Interleave {rdn_interleave} unsupported. Only BIL interleave currently supported."
-ra = rfl_dtype.alignment
-reflectance_chunks = {
-    f"reflectance/{i}.0.0": [rfl_data, i*nsamp*len(waves)*ra, nsamp*len(waves)*ra] for i in range(nlines)
-}
+rfl_data = envi_data_path(rfl_path)
+rfl_dtype = rfl_meta.dtype
+rfl_dims, rfl_shape, rfl_chunks, reflectance_grid = envi_cube_grid(rfl_data, rfl_meta, lines_per_chunk,
+                                                                        bands_per_chunk)
+rfl_dim_names = {"line": "line", "band": "wavelength", "sample": "sample"}
 reflectance_dict = {
     "reflectance/.zarray": ujson.dumps({
         **zarray_common,
-        "chunks": [1, len(waves), nsamp],
+        "chunks": rfl_chunks,
         "dtype": rfl_dtype.str,  # < = Byte order 0; f4 = data type 4
-        "shape": [nlines, len(waves), nsamp],
+        "shape": rfl_shape,
     }),
     "reflectance/.zattrs": ujson.dumps({
-        "_ARRAY_DIMENSIONS": ["line", "wavelength", "sample"]
-    }),
-    **reflectance_chunks
+        "_ARRAY_DIMENSIONS": [rfl_dim_names[d] for d in rfl_dims]
+    })
 }
 
 output = {
@@ -89,17 +89,14 @@ output = {
         ".zattrs": ujson.dumps({**rfl_meta}),
         **waves_dict, **samps_dict, **lines_dict,
         **reflectance_dict
-    }
+    },
+    "grids": {"reflectance": reflectance_grid}
 }
 
-with fsspec.open(output_file, "w") as of:
-    of.write(ujson.dumps(output, indent=2))
+write_references(output, output_file)
 
 ## Test that the output can be read
-import xarray as xr
-dat = xr.open_dataset("reference://", engine="zarr", backend_kwargs={
-    "consolidated": False,
-    "storage_options": {"fo": output_file}
-})
+from envi_store import open_envi_dataset
+dat = open_envi_dataset(output_file)
 
 dat.isel(sample=300, line=3500).reflectance.values
@@ -0,0 +1,323 @@
+import numpy as np
+import pyproj
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+from utils import DEFAULT_CHUNK_BYTES
+from envi_store import EnviReferenceStore
+from footprint import DEFAULT_NODATA, valid_lon_lat
+
+GLT_CHUNKS = [512, 512]
+
+# Cells per side of the map tiles `build_glt` builds and writes at a time
+GLT_TILE_SIZE = 2048
+
+def default_glt_path(fo):
+    '''
+    GLT store next to a reference set: "output.json" -> "output.glt.zarr".
+    '''
+    fo = fo.rstrip("/")
+    for suffix in (".grid.json", ".json", ".parq"):
+        if fo.endswith(suffix):
+            return fo[:-len(suffix)] + ".glt.zarr"
+    return fo + ".glt.zarr"
+
+def _read_lonlat(ds, start, stop, nodata):
+    # Lon/lat of lines `start:stop` of `ds`, and where they are valid
+    lon = ds["lon"].isel(line=slice(start, stop)).transpose("line", "sample").values
+    lat = ds["lat"].isel(line=slice(start, stop)).transpose("line", "sample").values
+    return valid_lon_lat(lon, lat, nodata)
+
+def _line_blocks(ds, lines_per_block, nodata):
+    # `(start, stop)` and lon/lat bounds (NaN if empty) of the line blocks
+    # of `ds`, from its `line_bbox` index if any, else from a streaming pass
+    nlines = ds.sizes["line"]
+    if "line_bbox" in ds:
+        index = ds["line_bbox"]
+        step = index.attrs["lines_per_block"]
+        return [((i*step, min((i + 1)*step, nlines)), bbox) for i, bbox in enumerate(index.values)]
+    blocks = []
+    for start in range(0, nlines, lines_per_block):
+        stop = min(start + lines_per_block, nlines)
+        lon, lat, valid = _read_lonlat(ds, start, stop, nodata)
+        bbox = np.full(4, np.nan)
+        if valid.any():
+            bbox[:] = lon[valid].min(), lat[valid].min(), lon[valid].max(), lat[valid].max()
+        blocks.append(((start, stop), bbox))
+    return blocks
+
+def _estimate_resolution(ds, blocks, to_map, nodata):
+    # Median distance between valid neighbouring samples of the first
+    # block that has any
+    for (start, stop), bbox in blocks:
+        if not np.isfinite(bbox).all():
+            continue
+        lon, lat, valid = _read_lonlat(ds, start, stop, nodata)
+        both = valid[:, 1:] & valid[:, :-1]
+        if both.any():
+            x, y = to_map.transform(lon, lat)
+            with np.errstate(invalid="ignore"):
+                spacing = np.hypot(np.diff(x, axis=1), np.diff(y, axis=1))
+            return float(np.median(spacing[both]))
+    raise AssertionError("No pair of neighbouring samples with valid lon/lat to estimate the GLT resolution from. "
+                         "Set the resolution.")
+
+def _glt_tile(lines, samples, d2, rows, cols, shape, fill_radius):
+    # Line and sample of the nearest point in each cell of a tile (points
+    # in tile coordinates), holes filled from mapped neighbours
+    glt_line = np.full(shape, -1, dtype=np.int32)
+    glt_sample = np.full(shape, -1, dtype=np.int32)
+    # Of several points in one cell, the closest is assigned last and wins
+    order = np.argsort(-d2, kind="stable")
+    glt_line[rows[order], cols[order]] = lines[order]
+    glt_sample[rows[order], cols[order]] = samples[order]
+
+    # Fill holes from the nearest mapped neighbours, closest offsets first
+    ny, nx = shape
+    mapped = glt_line >= 0
+    offsets = [(dy, dx) for dy in range(-fill_radius, fill_radius + 1) for dx in range(-fill_radius, fill_radius + 1)
+               if (dy, dx) != (0, 0)]
+    for dy, dx in sorted(offsets, key=lambda o: o[0]**2 + o[1]**2):
+        target = (slice(max(dy, 0), ny + min(dy, 0)), slice(max(dx, 0), nx + min(dx, 0)))
+        source = (slice(max(-dy, 0), ny + min(-dy, 0)), slice(max(-dx, 0), nx + min(-dx, 0)))
+        fill = (glt_line[target] < 0) & mapped[source]
+        glt_line[target][fill] = glt_line[source][fill]
+        glt_sample[target][fill] = glt_sample[source][fill]
+    return glt_line, glt_sample
+
+def utm_crs(lon, lat):
+    '''
+    WGS 84 UTM CRS of the zone containing `(lon, lat)`.
+    '''
+    from pyproj.aoi import AreaOfInterest
+    from pyproj.database import query_utm_crs_info
+    info = query_utm_crs_info(datum_name="WGS 84", area_of_interest=AreaOfInterest(lon, lat, lon, lat))
+    return pyproj.CRS.from_epsg(info[0].code)
+
+def build_glt(fo, resolution=None, crs=None, output=None, lines_per_block=256, fill_radius=1,
+              nodata=DEFAULT_NODATA, storage_options=None, remote_options=None, output_options=None,
+              tile_size=GLT_TILE_SIZE):
+    '''
+    Build the geographic lookup table (GLT) of a flightline reference set
+    (from `make_envi_kerchunk`, with `lat` and `lon` variables) and write it
+    to the Zarr store `output` (default: next to the references, see
+    `default_glt_path`).
+
+    The GLT is a north-up grid in `crs` (default: the UTM zone of the
+    flightline center) with square pixels of `resolution` CRS units
+    (default: the median distance between neighbouring samples). Each cell
+    holds the line and sample of the nearest source pixel whose center
+    falls in it (`glt_line` and `glt_sample`, -1 if none). Cells left empty
+    are filled from neighbours up to `fill_radius` cells away.
+
+    The GLT is built and written in map tiles of `tile_size` cells, so
+    memory is bounded by a tile and the source pixels of a row of tiles,
+    not by the bounding grid (which is mostly empty for a diagonal
+    flightline); tiles without any mapped cell are not written. The
+    lon/lat bounds of every block of `lines_per_block` lines come from the
+    `line_bbox` index of the references, or else from one streaming pass,
+    and each row of tiles only reads the blocks that overlap it. Returns
+    the path of the GLT store.
+    '''
+    assert tile_size % GLT_CHUNKS[0] == 0 and tile_size % GLT_CHUNKS[1] == 0, \
+        f"tile_size must be a multiple of the GLT chunks {GLT_CHUNKS}. Got {tile_size}."
+    store = EnviReferenceStore(fo, remote_options=remote_options, storage_options=storage_options)
+    ds = xr.open_dataset(store, engine="zarr", consolidated=False)
+    output = output or default_glt_path(fo)
+
+    blocks = [(lines, bbox) for lines, bbox in _line_blocks(ds, lines_per_block, nodata) if np.isfinite(bbox).all()]
+    assert blocks, f"No valid lon/lat in {fo}."
+    bounds = np.array([bbox for _, bbox in blocks])
+    lon_min, lat_min = bounds[:, :2].min(axis=0)
+    lon_max, lat_max = bounds[:, 2:].max(axis=0)
+
+    crs = utm_crs((lon_min + lon_max) / 2, (lat_min + lat_max) / 2) if crs is None else pyproj.CRS(crs)
+    to_map = pyproj.Transformer.from_crs(4326, crs, always_xy=True)
+    x_min, y_min, x_max, y_max = to_map.transform_bounds(lon_min, lat_min, lon_max, lat_max, densify_pts=21)
+    # Map y range of each block, to find the blocks overlapping a row of tiles
+    block_y = np.array([to_map.transform_bounds(*bbox, densify_pts=21)[1::2] for _, bbox in blocks])
+
+    if resolution is None:
+        resolution = _estimate_resolution(ds, blocks, to_map, nodata)
+    nx = int(np.ceil((x_max - x_min) / resolution)) + 1
+    ny = int(np.ceil((y_max - y_min) / resolution)) + 1
+
+    codec = Blosc(cname="zstd", clevel=5, shuffle=Blosc.SHUFFLE)
+    group = zarr.open_group(output, mode="w", storage_options=output_options)
+    group.attrs.update({"references": fo, "resolution": resolution, "crs": crs.to_string()})
+    arrays = {}
+    for name in ("glt_line", "glt_sample"):
+        arrays[name] = group.create_dataset(name, shape=(ny, nx), dtype=np.int32, chunks=GLT_CHUNKS,
+                                            compressor=codec, fill_value=-1)
+        arrays[name].attrs["_ARRAY_DIMENSIONS"] = ["y", "x"]
+
+    # Tiles are built with a margin of `fill_radius` cells, so that holes
+    # at their edges are filled from the neighbouring tiles' pixels
+    margin = fill_radius
+    for r0 in range(0, ny, tile_size):
+        r1 = min(r0 + tile_size, ny)
+        y_top = y_max - (r0 - margin - 1)*resolution
+        y_bottom = y_max - (r1 + margin + 1)*resolution
+        points = [[] for _ in range(5)]
+        for ((start, stop), _), (b_min, b_max) in zip(blocks, block_y):
+            if b_min > y_top or b_max < y_bottom:
+                continue
+            lon, lat, valid = _read_lonlat(ds, start, stop, nodata)
+            lines, samples = np.nonzero(valid)
+            x, y = to_map.transform(lon[valid], lat[valid])
+            col = np.floor((x - x_min) / resolution).astype(np.int64)
+            row = np.floor((y_max - y) / resolution).astype(np.int64)
+            keep = (col >= 0) & (col < nx) & (row >= max(r0 - margin, 0)) & (row < min(r1 + margin, ny))
+            d2 = (x - x_min - (col + 0.5)*resolution)**2 + (y_max - y - (row + 0.5)*resolution)**2
+            for values, a in zip(points, (lines + start, samples, d2, row, col)):
+                values.append(a[keep])
+        if not points[0]:
+            continue
+        lines, samples, d2, row, col = (np.concatenate(values) for values in points)
+        order = np.argsort(col, kind="stable")
+        lines, samples, d2, row, col = (a[order] for a in (lines, samples, d2, row, col))
+        for c0 in range(0, nx, tile_size):
+            c1 = min(c0 + tile_size, nx)
+            i0, i1 = np.searchsorted(col, [c0 - margin, c1 + margin])
+            if i0 == i1:
+                continue
+            tile_line, tile_sample = _glt_tile(
+                lines[i0:i1].astype(np.int32), samples[i0:i1].astype(np.int32), d2[i0:i1],
+                row[i0:i1] - (r0 - margin), col[i0:i1] - (c0 - margin),
+                (r1 - r0 + 2*margin, c1 - c0 + 2*margin), fill_radius
+            )
+            crop = (slice(margin, margin + r1 - r0), slice(margin, margin + c1 - c0))
+            if (tile_line[crop] >= 0).any():
+                arrays["glt_line"][r0:r1, c0:c1] = tile_line[crop]
+                arrays["glt_sample"][r0:r1, c0:c1] = tile_sample[crop]
+
+    ycoords = y_max - resolution*(np.arange(ny) + 0.5)
+    xcoords = x_min + resolution*(np.arange(nx) + 0.5)
+    for name, data in (("y", ycoords), ("x", xcoords)):
+        group.create_dataset(name, data=data, chunks=[len(data)], compressor=None)
+        group[name].attrs["_ARRAY_DIMENSIONS"] = [name]
+    spatial_ref = group.create_dataset("spatial_ref", data=np.int64(0), shape=(), dtype=np.int64, fill_value=None)
+    spatial_ref.attrs.update({
+        **crs.to_cf(),
+        "spatial_ref": crs.to_wkt(),
+        "GeoTransform": f"{x_min} {resolution} -0.0 {y_max} -0.0 -{resolution}",
+        "_ARRAY_DIMENSIONS": []
+    })
+    zarr.consolidate_metadata(group.store)
+    return output
+
+class GltBackendArray(BackendArray):
+    '''
+    Orthorectified view of a `(line, sample, ...)` source variable through
+    a GLT. Indexing a map window reads the GLT window, then only the source
+    lines it references, in line blocks of about `read_bytes` aligned to
+    the source chunks, and gathers the pixels with vectorized indexing.
+    '''
+
+    def __init__(self, source, glt_line, glt_sample, fill_value, line_chunk=1, read_bytes=DEFAULT_CHUNK_BYTES):
+        self.source = source
+        self.glt_line = glt_line
+        self.glt_sample = glt_sample
+        self.other_dims = [d for d in source.dims if d not in ("line", "sample")]
+        self.shape = tuple(glt_line.shape) + tuple(source.sizes[d] for d in self.other_dims)
+        self.dtype = np.dtype(source.dtype)
+        if self.dtype.kind not in "fc" and fill_value != fill_value:
+            # NaN fill of an integer variable
+            self.dtype = np.result_type(self.dtype, np.float32)
+        self.fill_value = fill_value
+        self.line_chunk = line_chunk
+        self.read_bytes = read_bytes
+
+    def _raw_indexing_method(self, key):
+        lines = np.asarray(self.glt_line[key[0], key[1]])
+        samples = np.asarray(self.glt_sample[key[0], key[1]])
+        source = self.source.isel(dict(zip(self.other_dims, key[2:])))
+        source = source.transpose("line", "sample", ...)
+        rest_shape = source.shape[2:]
+        out = np.full(lines.shape + rest_shape, self.fill_value, dtype=self.dtype)
+        valid = lines >= 0
+        if not valid.any():
+            return out
+        lines, samples = lines[valid], samples[valid]
+        s0, s1 = int(samples.min()), int(samples.max()) + 1
+        line_bytes = max(1, (s1 - s0)*int(np.prod(rest_shape))*source.dtype.itemsize)
+        block = max(1, self.read_bytes // line_bytes // self.line_chunk)*self.line_chunk
+        pixels = np.empty((len(lines),) + rest_shape, dtype=self.dtype)
+        blocks = lines // block
+        for b in np.unique(blocks):
+            sel = blocks == b
+            l0, l1 = int(lines[sel].min()), int(lines[sel].max()) + 1
+            data = source.isel(line=slice(l0, l1), sample=slice(s0, s1)).values
+            pixels[sel] = data[lines[sel] - l0, samples[sel] - s0]
+        out[valid] = pixels
+        return out
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC,
+                                                  self._raw_indexing_method)
+
+def ortho_view(ds, glt, variables=None, fill_value=None):
+    '''
+    Lazily orthorectified dataset of the `(line, sample, ...)` variables of
+    `ds` (default: all of them), with dimensions `(y, x, ...)` on the GLT
+    grid of `glt` (a GLT store path or an open Zarr group, see
+    `build_glt`). Nothing is read until values are needed, and a map
+    window only reads the source lines it covers. Empty cells hold
+    `fill_value` (default: NaN, or 0 for integer variables).
+    '''
+    if not isinstance(glt, zarr.hierarchy.Group):
+        glt = zarr.open_group(glt, mode="r")
+    if variables is None:
+        variables = [name for name, var in ds.data_vars.items() if {"line", "sample"} <= set(var.dims)]
+    glt_ds = xr.open_zarr(glt.store)
+    data_vars = {}
+    for name in variables:
+        var = ds[name]
+        fill = fill_value
+        if fill is None:
+            fill = np.nan if np.dtype(var.dtype).kind in "fc" else 0
+        line_chunk = var.encoding.get("preferred_chunks", {}).get("line", 1)
+        array = GltBackendArray(var.variable, glt["glt_line"], glt["glt_sample"], fill, line_chunk)
+        data_vars[name] = xr.Variable(["y", "x", *array.other_dims], indexing.LazilyIndexedArray(array),
+                                      attrs=var.attrs)
+    coords = {"y": glt_ds["y"], "x": glt_ds["x"], "spatial_ref": glt_ds["spatial_ref"]}
+    for name in variables:
+        for coord in ds[name].coords.values():
+            if not {"line", "sample"} & set(coord.dims):
+                coords[coord.name] = coord
+    return xr.Dataset(data_vars, coords=coords, attrs=ds.attrs)
+
+def open_ortho(fo, glt=None, variables=None, fill_value=None, storage_options=None, remote_options=None,
+               **kwargs):
+    '''
+    Open a flightline reference set with its GLT (default: next to the
+    references) as a lazily orthorectified dataset (see `ortho_view`).
+    Other arguments go to `EnviReferenceStore`.
+    '''
+    store = EnviReferenceStore(fo, remote_options=remote_options, storage_options=storage_options, **kwargs)
+    ds = xr.open_dataset(store, engine="zarr", consolidated=False)
+    return ortho_view(ds, glt or default_glt_path(fo), variables, fill_value)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Build the geographic lookup table of a flightline reference set")
+    parser.add_argument("reference_file", metavar="Reference path", type=str,
+                        help = "Path or S3 URL of the JSON, grid JSON or Parquet references (with lat and lon).")
+    parser.add_argument("--output", type=str, default=None,
+                        help = "Path of the output GLT Zarr store. Default: next to the references.")
+    parser.add_argument("--resolution", type=float, default=None,
+                        help = "Pixel size in CRS units. Default: the median source pixel spacing.")
+    parser.add_argument("--crs", type=str, default=None,
+                        help = "Output CRS, e.g. EPSG:32611. Default: the UTM zone of the flightline center.")
+    parser.add_argument("--fill_radius", type=int, default=1,
+                        help = "Fill empty cells from mapped cells up to this many cells away.")
+    parser.add_argument("--tile_size", type=int, default=GLT_TILE_SIZE,
+                        help = "Cells per side of the map tiles built and written at a time (a multiple of 512).")
+
+    args = parser.parse_args()
+    output = build_glt(args.reference_file, args.resolution, args.crs, args.output, fill_radius=args.fill_radius,
+                       tile_size=args.tile_size)
+    print(f"Successfully created GLT {output}.")
@@ -0,0 +1,230 @@
+import time
+import asyncio
+import functools
+import threading
+import contextlib
+import collections
+
+import numpy as np
+import fsspec
+import ujson
+from fsspec.asyn import sync
+
+# Statistics collected by `phase` and by stores without their own `stats`
+_active = None
+
+class IOStats:
+    '''
+    Opt-in I/O and build statistics:
+
+    - per variable: chunks served by source (inline, memmap, cache,
+      remote), bytes used by those chunks, range requests and bytes
+      fetched (a coalesced request serving several variables counts for
+      the first);
+    - per-request latencies, summarized as a histogram with power-of-two
+      millisecond buckets and percentiles;
+    - timings of named build and read phases (see `phase`), nested by
+      thread, with total and self (excluding sub-phases) seconds.
+
+    With `trace=True`, every request and phase is also kept as a Chrome
+    trace event, written by `dump` (open the file in chrome://tracing or
+    Perfetto).
+
+    Usage:
+
+        with collect_stats() as stats:
+            ds = open_envi_dataset("output.json")
+            ds.radiance.isel(line=slice(0, 100)).values
+        stats.summary()
+        stats.dump("stats.json")
+    '''
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.variables = collections.defaultdict(lambda: collections.Counter())
+        self.latencies = []
+        self.phases = collections.defaultdict(lambda: {"count": 0, "total_s": 0.0, "self_s": 0.0})
+        self.events = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _event(self, name, category, start, end, args=None):
+        if self.trace:
+            self.events.append({"name": name, "cat": category, "ph": "X", "pid": 0,
+                                "tid": threading.get_ident(), "ts": (start - self._start)*1e6,
+                                "dur": (end - start)*1e6, "args": args or {}})
+
+    def chunk(self, var, source, nbytes):
+        '''
+        Record a chunk of `var` of `nbytes` bytes served from `source`.
+        '''
+        with self._lock:
+            counter = self.variables[var]
+            counter["chunks"] += 1
+            counter[f"{source}_chunks"] += 1
+            counter["bytes_used"] += nbytes
+
+    def request(self, var, path, nbytes, start, end):
+        '''
+        Record a range request of `nbytes` bytes of `path` for `var`, that
+        ran from `start` to `end` (`time.perf_counter` seconds).
+        '''
+        with self._lock:
+            counter = self.variables[var]
+            counter["requests"] += 1
+            counter["bytes_fetched"] += nbytes
+            self.latencies.append(end - start)
+            self._event(var, "request", start, end, {"path": path, "bytes": nbytes})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time the enclosed block as phase `name`, nested under the phases
+        already open in this thread ("build/header fetch").
+        '''
+        stack = self._local.__dict__.setdefault("stack", [])
+        path = "/".join([p for p, _ in stack] + [name])
+        stack.append((name, [0.0]))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            _, children = stack.pop()
+            with self._lock:
+                entry = self.phases[path]
+                entry["count"] += 1
+                entry["total_s"] += end - start
+                entry["self_s"] += end - start - children[0]
+                self._event(name, "phase", start, end, {"path": path})
+            if stack:
+                stack[-1][1][0] += end - start
+
+    def latency_summary(self):
+        if not self.latencies:
+            return {"count": 0}
+        ms = np.array(self.latencies) * 1e3
+        buckets = np.maximum(0, np.ceil(np.log2(np.maximum(ms, 1e-9)))).astype(int)
+        return {
+            "count": len(ms),
+            "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p90_ms": float(np.percentile(ms, 90)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "max_ms": float(ms.max()),
+            "histogram_ms": {f"<={2**int(b)}": int(n) for b, n in zip(*np.unique(buckets, return_counts=True))}
+        }
+
+    def summary(self):
+        '''
+        All statistics as a JSON-serializable dictionary, with totals over
+        the variables.
+        '''
+        with self._lock:
+            variables = {var: dict(counter) for var, counter in sorted(self.variables.items())}
+            total = collections.Counter()
+            for counter in self.variables.values():
+                total.update(counter)
+            return {
+                "total": dict(total),
+                "variables": variables,
+                "latency": self.latency_summary(),
+                "phases": {path: dict(entry) for path, entry in sorted(self.phases.items())}
+            }
+
+    def dump(self, path, storage_options=None):
+        '''
+        Write `summary()` as JSON to `path`, with the trace events (if
+        any) under "traceEvents", the key Chrome trace viewers read.
+        '''
+        output = self.summary()
+        if self.trace:
+            output["traceEvents"] = list(self.events)
+        with fsspec.open(path, "w", **(storage_options or {})) as f:
+            f.write(ujson.dumps(output, indent=1))
+        return path
+
+def active_stats():
+    return _active
+
+@contextlib.contextmanager
+def collect_stats(stats=None, trace=False):
+    '''
+    Collect statistics of all phases and reference reads in the enclosed
+    block (in this process) into `stats` (default: a new `IOStats`).
+    '''
+    global _active
+    previous = _active
+    _active = stats if stats is not None else IOStats(trace)
+    try:
+        yield _active
+    finally:
+        _active = previous
+
+@contextlib.contextmanager
+def dump_stats(path=None, trace=True):
+    '''
+    Collect statistics (see `collect_stats`) in the enclosed block and dump
+    them to `path` at the end; a no-op if `path` is None. Used by the
+    command line `--stats` options.
+    '''
+    if path is None:
+        yield None
+        return
+    with collect_stats(trace=trace) as stats:
+        try:
+            yield stats
+        finally:
+            stats.dump(path)
+
+def phase(name):
+    '''
+    Time the enclosed block as phase `name` of the active statistics, if
+    any (see `collect_stats`); otherwise a no-op.
+    '''
+    return _active.phase(name) if _active is not None else contextlib.nullcontext()
+
+def timed_phase(name):
+    '''
+    Decorator timing every call of a function as phase `name` (see `phase`).
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def _timed_fetch_all(fs, paths, starts, ends, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(path, start, end):
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                data = await fs._cat_file(path, start=start, end=end)
+            except Exception as e:
+                data = e
+            return data, t0, time.perf_counter()
+
+    return await asyncio.gather(*[fetch(*args) for args in zip(paths, starts, ends)])
+
+def timed_cat_ranges(fs, paths, starts, ends, concurrency=None):
+    '''
+    `fs.cat_ranges` with the timing of every request: a list of
+    `(data or exception, start, end)`. Requests to async filesystems run
+    concurrently, at most `concurrency` at a time.
+    '''
+    if fs.async_impl:
+        return sync(fs.loop, _timed_fetch_all, fs, paths, starts, ends, concurrency or len(paths) or 1)
+    results = []
+    for path, start, end in zip(paths, starts, ends):
+        t0 = time.perf_counter()
+        try:
+            data = fs.cat_file(path, start=start, end=end)
+        except Exception as e:
+            data = e
+        results.append((data, t0, time.perf_counter()))
+    return results
@@ -2,28 +2,48 @@ import numpy as np
 import fsspec
 
 import ujson
-import base64
 
-from utils import read_envi_header, string_encode, zarray_common, envi_dtypes
-
-def make_envi_kerchunk(rdn_path, loc_path, obs_path, output_file):
+from utils import read_envi_header, string_encode, zarray_common, \
+    envi_cube_grid, band_variable_names, band_variables, \
+    envi_data_path
+from reference_writer import write_references
+from iostats import timed_phase, phase, dump_stats
+
+# Band order of location files without band names
+loc_band_names = ["Longitude (WGS-84)", "Latitude (WGS-84)", "Elevation (m)"]
+
+@timed_phase("make_envi_kerchunk")
+def make_envi_kerchunk(rdn_path, loc_path, obs_path, output_file, lines_per_chunk=1,
+                       output_format="json", validate=False, bands_per_chunk=None, bbox_lines=None):
+    '''
+    Create references for a radiance file with its location (lon, lat,
+    elevation) and, unless `obs_path` is None, observation geometry bands.
+    `bands_per_chunk` splits BIL radiance lines into band groups (see
+    `utils.interleave_chunk_grid`). With `validate`, a sample of chunks of every variable is read back
+    through the written references and compared with the binary files.
+    `lines_per_chunk` and `bands_per_chunk` must divide the numbers of
+    lines and bands, except for "grid" output, whose short last chunks
+    `envi_store.EnviReferenceStore` pads.
+
+    With `bbox_lines`, the location file is read once to index the lon/lat
+    bounding boxes of every block of `bbox_lines` lines (a small inline
+    `line_bbox` variable) and the flightline footprint (the `footprint`
+    attribute); see `footprint.select_bbox`.
+    '''
 
     # assert fsi.exists(rdn_path)
     # assert fsi.exists(obs_path)
     # assert fsi.exists(loc_path)
 
-    # obs = envi.open(obs_path)
-
     assert rdn_path.endswith(".hdr"), f"Need path to radiance HDR file, not binary. Got {rdn_path}."
     assert loc_path.endswith(".hdr"), f"Need path to location HDR file, not binary. Got {loc_path}."
-    # assert obs_path.endswith(".hdr"), f"Need path to observation HDR file, not binary. Got {obs_path}."
     with fsspec.open(rdn_path, "r") as f:
         rdn_meta = read_envi_header(f)
 
-    nsamp = int(rdn_meta["samples"])
-    nlines = int(rdn_meta["lines"])
+    nsamp = rdn_meta.samples
+    nlines = rdn_meta.lines
 
-    waves = np.array(rdn_meta["wavelength"], np.float32)
+    waves = rdn_meta.wavelength.astype(np.float32)
     waves_b64 = string_encode(waves)
 
     waves_dict = {
@@ -69,81 +89,80 @@ def make_envi_kerchunk(rdn_path, loc_path, obs_path, output_file):
         "sample/0": samps_b64
     }
 
-    rdn_data = rdn_path.rstrip(".hdr")
-    rdn_byte_order = {"0": "<", "1": ">"}[rdn_meta["byte order"]]
-    rdn_dtype = envi_dtypes[rdn_meta["data type"]].newbyteorder(rdn_byte_order)
-    rdn_interleave = rdn_meta["interleave"]
-    assert rdn_interleave == "bil", f"Interleave {rdn_interleave} unsupported. Only BIL interleave currently supported."
-    ra = rdn_dtype.alignment
-    radiance_chunks = {
-        f"radiance/{i}.0.0": [rdn_data, i*nsamp*len(waves)*ra, nsamp*len(waves)*ra] for i in range(nlines)
-    }
+    rdn_data = envi_data_path(rdn_path)
+    rdn_dtype = rdn_meta.dtype
+    # Only EnviReferenceStore (grid output) pads short last chunks
+    allow_short = output_format == "grid"
+    rdn_dims, rdn_shape, rdn_chunks, radiance_grid = envi_cube_grid(rdn_data, rdn_meta, lines_per_chunk,
+                                                                      bands_per_chunk, allow_short)
+    rdn_dim_names = {"line": "line", "band": "wavelength", "sample": "sample"}
     radiance_dict = {
         "radiance/.zarray": ujson.dumps({
             **zarray_common,
-            "chunks": [1, len(waves), nsamp],
+            "chunks": rdn_chunks,
             "dtype": rdn_dtype.str,  # < = Byte order 0; f4 = data type 4
-            "shape": [nlines, len(waves), nsamp],
+            "shape": rdn_shape,
         }),
         "radiance/.zattrs": ujson.dumps({
-            "_ARRAY_DIMENSIONS": ["line", "wavelength", "sample"]
-        }),
-        **radiance_chunks
+            "_ARRAY_DIMENSIONS": [rdn_dim_names[d] for d in rdn_dims]
+        })
     }
 
-    # Location file
+    # Location and observation files: one variable per band, named from the header's band names
     with fsspec.open(loc_path, "r") as f:
         loc_meta = read_envi_header(f)
-    loc_data = loc_path.rstrip(".hdr")
-    loc_byte_order = {"0": "<", "1": ">"}[loc_meta["byte order"]]
-    loc_dtype = envi_dtypes[loc_meta["data type"]].newbyteorder(loc_byte_order)
-    loc_interleave = loc_meta["interleave"]
-    assert loc_interleave == "bil", f"Interleave {loc_interleave} unsupported. Only BIL interleave currently supported."
-    la = loc_dtype.alignment
-    lat_chunks = {
-        f"lat/{i}.0": [loc_data, (i*nsamp*3)*la, nsamp*la] for i in range(nlines)
-    }
-    lat_dict = {
-        "lat/.zarray": ujson.dumps({
-            **zarray_common,
-            "chunks": [1, nsamp],
-            "dtype": loc_dtype.str,
-            "shape": [nlines, nsamp],
-        }),
-        "lat/.zattrs": ujson.dumps({
-            "_ARRAY_DIMENSIONS": ["line", "sample"],
-        }),
-        **lat_chunks
-    }
-
-    lon_chunks = {
-        f"lon/{i}.0": [loc_data, (i*nsamp*3 + nsamp)*la, nsamp*la] for i in range(nlines)
-    }
-    lon_dict = {
-        "lon/.zarray": ujson.dumps({
-            **zarray_common,
-            "chunks": [1, nsamp],
-            "dtype": loc_dtype.str,
-            "shape": [nlines, nsamp],
-        }),
-        "lon/.zattrs": ujson.dumps({
-            "_ARRAY_DIMENSIONS": ["line", "sample"]
-        }),
-        **lon_chunks
-    }
+    assert (loc_meta.lines, loc_meta.samples) == (nlines, nsamp), \
+        f"Location file is {loc_meta.lines}x{loc_meta.samples}, radiance is {nlines}x{nsamp}."
+    # Location files list Longitude, Latitude, Elevation; lat/lon keep their short names
+    loc_names = band_variable_names(loc_meta.band_names or loc_band_names, loc_meta.bands)
+    loc_names = [{"longitude": "lon", "latitude": "lat"}.get(n, n) for n in loc_names]
+    loc_refs, loc_grids = band_variables(envi_data_path(loc_path), loc_meta, loc_names,
+                                         lines_per_chunk=lines_per_chunk, bip_name="location",
+                                         allow_short=allow_short)
+
+    attrs = {"loc": {**loc_meta}, "rdn": {**rdn_meta}}
+    bbox_refs = {}
+    if bbox_lines is not None:
+        from footprint import line_block_bounds, line_bounds_refs
+        bounds, attrs["footprint"] = line_block_bounds(envi_data_path(loc_path), loc_meta, loc_names.index("lon"),
+                                                       loc_names.index("lat"), int(bbox_lines))
+        bbox_refs = line_bounds_refs(bounds, int(bbox_lines))
+    obs_refs = {}
+    obs_grids = {}
+    if obs_path is not None:
+        assert obs_path.endswith(".hdr"), f"Need path to observation HDR file, not binary. Got {obs_path}."
+        with fsspec.open(obs_path, "r") as f:
+            obs_meta = read_envi_header(f)
+        assert (obs_meta.lines, obs_meta.samples) == (nlines, nsamp), \
+            f"Observation file is {obs_meta.lines}x{obs_meta.samples}, radiance is {nlines}x{nsamp}."
+        attrs["obs"] = {**obs_meta}
+        taken = ["radiance", "wavelength", "line", "sample", *{key.split("/")[0] for key in {**loc_refs, **bbox_refs}}]
+        obs_refs, obs_grids = band_variables(envi_data_path(obs_path), obs_meta, taken=taken,
+                                             lines_per_chunk=lines_per_chunk, bip_name="obs",
+                                             allow_short=allow_short)
 
     output = {
         "version": 1,
         "refs": {
             ".zgroup": ujson.dumps({"zarr_format": 2}),
-            ".zattrs": ujson.dumps({"loc": {**loc_meta}, "rdn": {**rdn_meta}}),
+            ".zattrs": ujson.dumps(attrs),
             **waves_dict, **samps_dict, **lines_dict,
-            **radiance_dict, **lat_dict, **lon_dict
-        }
+            **radiance_dict, **loc_refs, **obs_refs, **bbox_refs
+        },
+        "grids": {"radiance": radiance_grid, **loc_grids, **obs_grids}
     }
 
-    with fsspec.open(output_file, "w") as of:
-        of.write(ujson.dumps(output, indent=2))
+    output_file = write_references(output, output_file, output_format)
+
+    if validate:
+        from envi_store import EnviReferenceStore, spot_check, spot_check_bands
+        with phase("validation"):
+            store = EnviReferenceStore(output_file)
+            mismatches = spot_check(store, "radiance", rdn_meta, rdn_data)
+            mismatches += spot_check_bands(store, loc_grids, loc_meta, envi_data_path(loc_path))
+            if obs_path is not None:
+                mismatches += spot_check_bands(store, obs_grids, obs_meta, envi_data_path(obs_path))
+        assert not mismatches, f"References in {output_file} do not match the binary files at {mismatches}."
 
     return output_file
 
@@ -153,11 +172,26 @@ if __name__ == "__main__":
     parser.add_argument("rdn_path", metavar="Radiance HDR path", type=str,
                         help = "Path to radiance HDR file.")
     parser.add_argument("output_file", metavar="Outut JSON path", type=str,
-                        help = "Path to target output JSON file.")
+                        help = "Path to target output JSON file (or Parquet directory).")
     parser.add_argument("--loc_path", metavar="Location HDR path", type=str,
                         help = "Path to location HDR file.")
     parser.add_argument("--obs_path", metavar="Observation HDR path", type=str,
-                        help = "Path to observation HDR file.")
+                        help = "Path to observation HDR file. Each band becomes a variable named from its band name.")
+    parser.add_argument("--lines_per_chunk", metavar="Lines per chunk", type=str, default="1",
+                        help = "Number of radiance lines per chunk (must divide the number of lines, except with grid output), or 'auto' to target ~32 MiB chunks.")
+    parser.add_argument("--bands_per_chunk", metavar="Bands per chunk", type=int, default=None,
+                        help = "Split each BIL radiance line into chunks of this many bands, so that reads of a few "
+                        "bands only fetch those bands. Requires lines_per_chunk 1.")
+    parser.add_argument("--output_format", choices=["json", "parquet", "grid"], default="json",
+                        help = "Reference format: compact JSON, kerchunk's lazily loaded Parquet, "
+                        "or closed-form grid JSON.")
+    parser.add_argument("--validate", action="store_true",
+                        help = "Spot-check a sample of chunks of every variable against the binary files.")
+    parser.add_argument("--bbox_lines", metavar="Lines per bounding box", type=int, default=None,
+                        help = "Index the lon/lat bounding box of every block of this many lines, "
+                        "so that subsets of a study area only read the lines that intersect it.")
+    parser.add_argument("--stats", type=str, default=None,
+                        help = "Write I/O and timing statistics, with a Chrome trace, to this JSON file.")
 
     args = parser.parse_args()
     rdn_path = args.rdn_path
@@ -168,6 +202,16 @@ if __name__ == "__main__":
         print(f"Loc path not set. Assuming {loc_path}.")
     if obs_path is None:
         obs_path = rdn_path.replace("rdn", "obs")
-        print(f"Obs path not set. Assuming {obs_path}.")
-    output_file = make_envi_kerchunk(rdn_path, loc_path, obs_path, args.output_file)
+        if fsspec.core.url_to_fs(obs_path)[0].exists(obs_path):
+            print(f"Obs path not set. Assuming {obs_path}.")
+        else:
+            print(f"Obs path not set and {obs_path} does not exist. Skipping observation variables.")
+            obs_path = None
+    with dump_stats(args.stats):
+        output_file = make_envi_kerchunk(rdn_path, loc_path, obs_path, args.output_file,
+                                         lines_per_chunk=args.lines_per_chunk,
+                                         output_format=args.output_format,
+                                         validate=args.validate,
+                                         bands_per_chunk=args.bands_per_chunk,
+                                         bbox_lines=args.bbox_lines)
     print(f"Successfully created output file {output_file}.")
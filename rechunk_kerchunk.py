@@ -0,0 +1,203 @@
+import math
+import itertools
+import concurrent.futures
+
+import numpy as np
+import zarr
+import ujson
+from numcodecs import Blosc
+
+from envi_store import EnviReferenceStore
+
+# Marker keys of finished tasks in the output store. When all tasks of a
+# variable are done, its markers are replaced by its name in the record
+# under DONE_KEY.
+PROGRESS_PREFIX = ".rechunk"
+DONE_KEY = f"{PROGRESS_PREFIX}/done"
+
+DEFAULT_TASK_BYTES = 256 * 2**20
+
+def target_chunks(dims, shape, source_chunks, chunks):
+    '''
+    Chunks of a rechunked array: `chunks` maps dimension names to chunk
+    sizes (-1 or None for the whole dimension); other dimensions keep
+    their source chunks.
+    '''
+    out = []
+    for dim, n, c in zip(dims, shape, source_chunks):
+        size = chunks.get(dim, c)
+        out.append(n if size is None or size == -1 else min(int(size), n))
+    return out
+
+def task_shape(shape, source_chunks, chunks, itemsize, max_task_bytes=DEFAULT_TASK_BYTES):
+    '''
+    Shape of the regions copied by one task. Regions are whole target
+    chunks, so that no two tasks write the same chunk, and as far as
+    possible whole source chunks, so that every source chunk is read once.
+    Regions larger than `max_task_bytes` are halved, along the axis with
+    the most target chunks, until they fit (or are a single chunk).
+    '''
+    task = [min(n, math.lcm(s, c)) for n, s, c in zip(shape, source_chunks, chunks)]
+    while int(np.prod(task)) * itemsize > max_task_bytes:
+        counts = [-(-k // c) for k, c in zip(task, chunks)]
+        axis = int(np.argmax(counts))
+        if counts[axis] == 1:
+            break
+        task[axis] = counts[axis] // 2 * chunks[axis]
+    return task
+
+def task_regions(shape, task):
+    '''
+    `{task_id: region}` of the tasks covering an array, with regions as
+    tuples of slices.
+    '''
+    ntasks = [-(-n // t) for n, t in zip(shape, task)]
+    regions = {}
+    for index in itertools.product(*(range(n) for n in ntasks)):
+        region = tuple(slice(i*t, min((i + 1)*t, n)) for i, t, n in zip(index, task, shape))
+        regions[".".join(str(i) for i in index) or "0"] = region
+    return regions
+
+_sources = {}
+
+def _source(fo, storage_options, remote_options):
+    # One source store per worker process
+    if fo not in _sources:
+        store = EnviReferenceStore(fo, remote_options=remote_options, storage_options=storage_options)
+        _sources[fo] = zarr.open_group(store, mode="r")
+    return _sources[fo]
+
+def _copy_task(fo, output, var, task_id, region, storage_options, remote_options, output_options):
+    source = _source(fo, storage_options, remote_options)
+    target = zarr.open_group(output, mode="r+", storage_options=output_options)
+    data = source[var][region]
+    target[var][region] = data
+    target.store[f"{PROGRESS_PREFIX}/{var}/{task_id}"] = b""
+    return data.nbytes
+
+def _done_tasks(store, var):
+    try:
+        return set(store.listdir(f"{PROGRESS_PREFIX}/{var}"))
+    except (FileNotFoundError, KeyError):
+        return set()
+
+def _done_variables(store):
+    try:
+        return set(ujson.loads(store[DONE_KEY]))
+    except KeyError:
+        return set()
+
+def rechunk_references(fo, output, chunks=None, variables=None, compressor="zstd", clevel=5,
+                       processes=None, max_task_bytes=DEFAULT_TASK_BYTES, storage_options=None,
+                       remote_options=None, output_options=None, progress=print):
+    '''
+    Copy the arrays of a reference set (JSON, grid JSON or Parquet; read
+    through `EnviReferenceStore`) into a compressed Zarr store at
+    `output`, with new chunks, e.g. `{"time": -1, "y": 1, "wavelength": -1,
+    "x": 64}` for time series of pixels (see `target_chunks`).
+
+    `variables` selects the arrays to copy (default: all); 0-d and 1-d
+    arrays (coordinates) are always copied, as a single chunk.
+    `compressor` is a Blosc compressor name ("zstd", "lz4", ...) or None
+    for uncompressed chunks.
+
+    The copy is split into tasks of at most about `max_task_bytes` (see
+    `task_shape`), which run in a pool of `processes` worker processes, so
+    memory use is bounded by the task size times the number of workers.
+    Each finished task leaves a marker in the output store; re-running
+    after an interruption skips finished tasks. When all tasks are done,
+    the copied variables are recorded as done (`DONE_KEY`, replacing their
+    task markers) and the metadata consolidated, so that re-running on a
+    finished store copies nothing.
+    '''
+    chunks = chunks or {}
+    source = _source(fo, storage_options, remote_options)
+    codec = None if compressor is None else Blosc(cname=compressor, clevel=clevel, shuffle=Blosc.SHUFFLE)
+    target = zarr.open_group(output, mode="a", storage_options=output_options)
+    target.attrs.update(source.attrs.asdict())
+
+    tasks = []
+    copied = _done_variables(target.store)
+    todo = []
+    for var, array in source.arrays():
+        if variables is not None and var not in variables and array.ndim > 1:
+            continue
+        dims = array.attrs.get("_ARRAY_DIMENSIONS", [])
+        # Coordinates are small and read whole
+        new_chunks = target_chunks(dims, array.shape, array.chunks, chunks) if array.ndim > 1 else list(array.shape)
+        if var in target:
+            existing = target[var]
+            # Zarr stores 0-d arrays uncompressed
+            assert (existing.shape, existing.chunks, existing.dtype) == (array.shape, tuple(new_chunks), array.dtype) \
+                and (array.ndim == 0 or existing.compressor == codec), \
+                f"{output}/{var} exists with other shape, chunks, dtype or compressor. Remove it or choose another output."
+        else:
+            target.create_dataset(var, shape=array.shape, chunks=new_chunks, dtype=array.dtype,
+                                  compressor=codec, fill_value=None, write_empty_chunks=True)
+        target[var].attrs.update(array.attrs.asdict())
+        if var in copied:
+            progress(f"{var}: already copied.")
+            continue
+        todo.append(var)
+        task = task_shape(array.shape, array.chunks, new_chunks, array.dtype.itemsize, max_task_bytes)
+        done = _done_tasks(target.store, var)
+        regions = task_regions(array.shape, task)
+        tasks += [(var, task_id, region) for task_id, region in regions.items() if task_id not in done]
+        if done:
+            progress(f"{var}: {len(done)} of {len(regions)} tasks already done.")
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = {
+            pool.submit(_copy_task, fo, output, var, task_id, region, storage_options,
+                        remote_options, output_options): (var, task_id)
+            for var, task_id, region in tasks
+        }
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            var, task_id = futures[future]
+            nbytes = future.result()
+            progress(f"[{i + 1}/{len(tasks)}] {var} {task_id}: {nbytes / 2**20:.1f} MiB")
+
+    target.store[DONE_KEY] = ujson.dumps(sorted(copied | set(todo))).encode()
+    for var in todo:
+        if _done_tasks(target.store, var):
+            target.store.rmdir(f"{PROGRESS_PREFIX}/{var}")
+    zarr.consolidate_metadata(target.store)
+    return output
+
+def parse_chunks(specs):
+    '''
+    `{dim: size}` from command line specifications like `x=64` or `time=-1`.
+    '''
+    chunks = {}
+    for spec in specs:
+        dim, _, size = spec.partition("=")
+        assert size, f"Chunk specification must look like dim=size. Got {spec}."
+        chunks[dim] = int(size)
+    return chunks
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Rechunk and compress ENVI data referenced by Kerchunk metadata into a Zarr store")
+    parser.add_argument("reference_file", metavar="Reference path", type=str,
+                        help = "Path or S3 URL of the JSON, grid JSON or Parquet reference set.")
+    parser.add_argument("output", metavar="Output Zarr path", type=str,
+                        help = "Path or S3 URL of the output Zarr store. Re-running resumes an interrupted copy.")
+    parser.add_argument("--chunks", type=str, nargs="+", default=[],
+                        help = "New chunk sizes per dimension, e.g. time=-1 y=1 wavelength=-1 x=64 "
+                        "(-1 for the whole dimension). Other dimensions keep their chunks.")
+    parser.add_argument("--variables", type=str, nargs="+", default=None,
+                        help = "Variables to copy. Default: all. Coordinates are always copied.")
+    parser.add_argument("--compressor", type=str, default="zstd",
+                        help = "Blosc compressor (zstd, lz4, lz4hc, zlib, blosclz), or 'none'.")
+    parser.add_argument("--clevel", type=int, default=5,
+                        help = "Compression level.")
+    parser.add_argument("--processes", type=int, default=None,
+                        help = "Number of worker processes. Default: number of CPUs.")
+    parser.add_argument("--max_task_mb", type=float, default=DEFAULT_TASK_BYTES / 2**20,
+                        help = "Approximate size in MiB of the region copied by one task.")
+
+    args = parser.parse_args()
+    output = rechunk_references(args.reference_file, args.output, parse_chunks(args.chunks), args.variables,
+                                None if args.compressor == "none" else args.compressor, args.clevel,
+                                args.processes, int(args.max_task_mb * 2**20))
+    print(f"Successfully created Zarr store {output}.")
@@ -0,0 +1,184 @@
+import numpy as np
+import fsspec
+import ujson
+
+from utils import grid_chunk_refs, grid_chunk_arrays, grid_nchunks, grid_paths, \
+    GRID_REFERENCE_VERSION
+from iostats import timed_phase
+
+class JSONReferenceWriter:
+    '''
+    Stream a version 1 kerchunk reference set to a compact JSON file.
+    References are serialized as they are written; grids are expanded one
+    chunk at a time. The target is any fsspec URL (for S3, fsspec uploads
+    the file in multipart blocks as the buffer fills).
+    '''
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self._f = fsspec.open(output_file, "w").open()
+        self._f.write('{"version":1,"refs":{')
+        self._first = True
+
+    def write(self, key, value):
+        sep = "" if self._first else ","
+        self._f.write(f"{sep}{ujson.dumps(key)}:{ujson.dumps(value)}")
+        self._first = False
+
+    def write_grid(self, key, grid, shape, chunks):
+        for chunk_key, ref in grid_chunk_refs(key, grid, shape, chunks):
+            self.write(chunk_key, ref)
+
+    def close(self):
+        self._f.write("}}")
+        self._f.close()
+
+    def abort(self):
+        _remove_partial(self._f, self.output_file)
+
+class GridReferenceWriter:
+    '''
+    Stream a compact "grid" reference set: explicit references are
+    serialized as they are written, grids are kept closed-form.
+    '''
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self._f = fsspec.open(output_file, "w").open()
+        self._f.write(f'{{"version":{ujson.dumps(GRID_REFERENCE_VERSION)},"refs":{{')
+        self._first = True
+        self._grids = {}
+
+    def write(self, key, value):
+        sep = "" if self._first else ","
+        self._f.write(f"{sep}{ujson.dumps(key)}:{ujson.dumps(value)}")
+        self._first = False
+
+    def write_grid(self, key, grid, shape, chunks):
+        self._grids[key] = grid
+
+    def close(self):
+        self._f.write(f'}},"grids":{ujson.dumps(self._grids)}}}')
+        self._f.close()
+
+    def abort(self):
+        _remove_partial(self._f, self.output_file)
+
+class ParquetReferenceWriter:
+    '''
+    Stream references into kerchunk's partitioned Parquet format. Chunk
+    references are held until a record batch of `record_size` is full and
+    then written out; grids are written straight from offset arrays, one
+    record batch at a time.
+    '''
+
+    def __init__(self, output_file, record_size=100000):
+        from fsspec.implementations.reference import LazyReferenceMapper
+        self.output_file = output_file
+        self.record_size = record_size
+        self.fs, self.root = fsspec.core.url_to_fs(output_file)
+        self._refs = LazyReferenceMapper.create(self.root, fs=self.fs, record_size=record_size)
+
+    def write(self, key, value):
+        # A variable's .zarray must be written before its chunks
+        self._refs[key] = value
+
+    def write_grid(self, key, grid, shape, chunks):
+        write_parquet_grid(self.fs, self.root, key, grid, shape, chunks, self.record_size)
+
+    def close(self):
+        self._refs.flush()
+
+    def abort(self):
+        if self.fs.exists(self.root):
+            self.fs.rm(self.root, recursive=True)
+
+def _remove_partial(f, output_file):
+    # Close a half-written reference file (finishing any upload) and delete it
+    f.close()
+    fs, path = fsspec.core.url_to_fs(output_file)
+    if fs.exists(path):
+        fs.rm(path)
+
+reference_writers = {
+    "json": JSONReferenceWriter,
+    "parquet": ParquetReferenceWriter,
+    "grid": GridReferenceWriter
+}
+
+def open_reference_writer(output_file, output_format="json", **kwargs):
+    '''
+    Open a streaming writer. Use `write(key, value)` (or `write_refs`) for
+    explicit references, `write_grid(key, grid, shape, chunks)` for grid
+    variables and `close()` at the end, or `abort()` to delete the partial
+    output after an error:
+
+        writer = open_reference_writer("output.json")
+        try:
+            write_refs(writer, radiance_references())
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+    '''
+    assert output_format in reference_writers, f"Unknown output format {output_format}."
+    return reference_writers[output_format](output_file, **kwargs)
+
+def write_refs(writer, refs):
+    '''
+    Write references from a dict or any iterable of `(key, value)` pairs,
+    e.g. a generator emitting one variable at a time.
+    '''
+    if isinstance(refs, dict):
+        refs = refs.items()
+    for key, value in refs:
+        writer.write(key, value)
+
+@timed_phase("serialization")
+def write_references(output, output_file, output_format="json", record_size=100000):
+    '''
+    Write a reference set (`{"version": 1, "refs": {...}}`, optionally with
+    closed-form `grids`) to `output_file`.
+
+    "json" writes compact (non-indented) JSON. "parquet" writes kerchunk's
+    partitioned Parquet format (a directory with one set of record batches
+    of `record_size` references per variable), which readers load lazily.
+    Both expand the grids into per-chunk references while writing. "grid"
+    keeps them closed-form; such files are read with
+    `envi_store.EnviReferenceStore`. If writing fails, the partial output is
+    deleted.
+    '''
+    kwargs = {"record_size": record_size} if output_format == "parquet" else {}
+    writer = open_reference_writer(output_file, output_format, **kwargs)
+    try:
+        write_refs(writer, output["refs"])
+        for key, grid in output.get("grids", {}).items():
+            zarray = ujson.loads(output["refs"][f"{key}/.zarray"])
+            writer.write_grid(key, grid, zarray["shape"], zarray["chunks"])
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return output_file
+
+def write_parquet_grid(fs, root, key, grid, shape, chunks, record_size, start_record=0):
+    '''
+    Write the chunk references of one grid variable as kerchunk Parquet
+    record batches (`{root}/{key}/refs.{record}.parq`), starting at
+    `start_record` (earlier records are left as they are).
+    '''
+    import pandas as pd
+    fs.makedirs(f"{root}/{key}", exist_ok=True)
+    nchunks = int(np.prod(grid_nchunks(shape, chunks)))
+    for record in range(start_record, -(-nchunks // record_size)):
+        start = record*record_size
+        path_index, offsets, lengths = grid_chunk_arrays(grid, shape, chunks, start, start + record_size)
+        df = pd.DataFrame({
+            "path": pd.Categorical.from_codes(path_index, categories=grid_paths(grid)),
+            "offset": offsets,
+            "size": lengths,
+            "raw": pd.Series([None]*len(offsets), dtype="O")
+        })
+        with fs.open(f"{root}/{key}/refs.{record}.parq", "wb") as f:
+            df.to_parquet(f, engine="fastparquet", compression="zstd", index=False, stats=False,
+                          object_encoding={"raw": "bytes", "path": "utf8"}, has_nulls=["path", "raw"])
@@ -1,26 +1,24 @@
 import numpy as np
 import fsspec
 import ujson
-import os
-import re
-import datetime
 
 import pyproj
 
-from utils import read_envi_header, string_encode, zarray_common, envi_dtypes
+from utils import read_envi_header, string_encode, zarray_common, \
+    envi_cube_grid, default_output_file, envi_data_path, chunk_grid, parse_date, EnviHeaderCache
+from reference_writer import write_references
+from iostats import timed_phase, phase, dump_stats
 
-def kerchunk_shift_rfl(rfl_path, output_file=None):
-    if output_file is None:
-        output_file = rfl_path.replace(".hdr", ".json")
-
-    assert rfl_path.endswith(".hdr"), f"Need path to HDR file, not binary. Got {rfl_path}."
-    with fsspec.open(rfl_path, "r") as f:
-        rfl_meta = read_envi_header(f)
+def shift_coordinate_refs(rfl_meta):
+    '''
+    Inline references of the coordinates of a SHIFT reflectance mosaic
+    (`wavelength`, `x`, `y` and `spatial_ref`, and `fwhm` if the header
+    has it), from its header.
+    '''
+    nsamp = rfl_meta.samples
+    nlines = rfl_meta.lines
 
-    nsamp = int(rfl_meta["samples"])
-    nlines = int(rfl_meta["lines"])
-
-    waves = np.array(rfl_meta["wavelength"], np.float32)
+    waves = rfl_meta.wavelength.astype(np.float32)
     waves_b64 = string_encode(waves)
 
     waves_dict = {
@@ -36,32 +34,27 @@ def kerchunk_shift_rfl(rfl_path, output_file=None):
         "wavelength/0": waves_b64
     }
 
-    fwhm = np.array(rfl_meta["fwhm"], np.float32)
-    fwhm_b64 = string_encode(fwhm)
-    fwhm_dict = {
-        "fwhm/.zarray": ujson.dumps({
-            **zarray_common,
-            "chunks": [len(waves)],
-            "dtype": "<f4",
-            "shape": [len(waves)]
-        }),
-        "fwhm/.zattrs": ujson.dumps({
-            "_ARRAY_DIMENSIONS": ["wavelength"]
-        }),
-        "fwhm/0": fwhm_b64
-    }
+    fwhm_dict = {}
+    if rfl_meta.fwhm is not None:
+        fwhm = rfl_meta.fwhm.astype(np.float32)
+        fwhm_dict = {
+            "fwhm/.zarray": ujson.dumps({
+                **zarray_common,
+                "chunks": [len(fwhm)],
+                "dtype": "<f4",
+                "shape": [len(fwhm)]
+            }),
+            "fwhm/.zattrs": ujson.dumps({
+                "_ARRAY_DIMENSIONS": ["wavelength"]
+            }),
+            "fwhm/0": string_encode(fwhm)
+        }
 
     # Parse map information to generate X,Y coordinates
-    proj_name = rfl_meta["map info"][0]
-    ref_x = int(rfl_meta["map info"][1])
-    ref_y = int(rfl_meta["map info"][2])
     px_easting = float(rfl_meta["map info"][3])
     px_northing = float(rfl_meta["map info"][4])
     x_size = float(rfl_meta["map info"][5])
     y_size = float(rfl_meta["map info"][6])
-    utm_zone = rfl_meta["map info"][7]
-    north_south = rfl_meta["map info"][8]
-    datum = rfl_meta["map info"][9]
 
     # Project line/sample into X/Y using projection information
     lines = np.arange(nlines)
@@ -115,26 +108,38 @@ def kerchunk_shift_rfl(rfl_path, output_file=None):
         "spatial_ref/0": string_encode(np.int64(0))
     }
 
-    rfl_data = rfl_path.rstrip(".hdr")
-    byte_order = {"0": "<", "1": ">"}[rfl_meta["byte order"]]
-    rfl_dtype = envi_dtypes[rfl_meta["data type"]].newbyteorder(byte_order)
-    rfl_interleave = rfl_meta["interleave"]
-    assert rfl_interleave == "bil", f"Interleave {rfl_interleave} unsupported. Only BIL interleave currently supported."
-    ra = rfl_dtype.alignment
-    reflectance_chunks = {
-        f"reflectance/{i}.0.0": [rfl_data, i*nsamp*len(waves)*ra, nsamp*len(waves)*ra] for i in range(nlines)
-    }
+    return {**waves_dict, **fwhm_dict, **x_dict, **y_dict, **spref_dict}
+
+@timed_phase("kerchunk_shift_rfl")
+def kerchunk_shift_rfl(rfl_path, output_file=None, lines_per_chunk=1, output_format="json",
+                       rfl_meta=None, validate=False, bands_per_chunk=None):
+    if output_file is None:
+        output_file = default_output_file(rfl_path, output_format)
+
+    assert rfl_path.endswith(".hdr"), f"Need path to HDR file, not binary. Got {rfl_path}."
+    # Batch builders fetch headers up front and pass them in
+    if rfl_meta is None:
+        with fsspec.open(rfl_path, "r") as f:
+            rfl_meta = read_envi_header(f)
+
+    coordinate_refs = shift_coordinate_refs(rfl_meta)
+
+    rfl_data = envi_data_path(rfl_path)
+    rfl_dtype = rfl_meta.dtype
+    rfl_dims, rfl_shape, rfl_chunks, reflectance_grid = envi_cube_grid(rfl_data, rfl_meta, lines_per_chunk,
+                                                                            bands_per_chunk,
+                                                                            allow_short=output_format == "grid")
+    rfl_dim_names = {"line": "y", "band": "wavelength", "sample": "x"}
     reflectance_dict = {
         "reflectance/.zarray": ujson.dumps({
             **zarray_common,
-            "chunks": [1, len(waves), nsamp],
+            "chunks": rfl_chunks,
             "dtype": rfl_dtype.str,
-            "shape": [nlines, len(waves), nsamp],
+            "shape": rfl_shape,
         }),
         "reflectance/.zattrs": ujson.dumps({
-            "_ARRAY_DIMENSIONS": ["y", "wavelength", "x"]
-        }),
-        **reflectance_chunks
+            "_ARRAY_DIMENSIONS": [rfl_dim_names[d] for d in rfl_dims]
+        })
     }
 
     output = {
@@ -142,14 +147,121 @@ def kerchunk_shift_rfl(rfl_path, output_file=None):
         "refs": {
             ".zgroup": ujson.dumps({"zarr_format": 2}),
             ".zattrs": ujson.dumps({**rfl_meta}),
-            **waves_dict, **x_dict, **y_dict,
-            **spref_dict,
+            **coordinate_refs,
             **reflectance_dict
-        }
+        },
+        "grids": {"reflectance": reflectance_grid}
+    }
+
+    output_file = write_references(output, output_file, output_format)
+
+    if validate:
+        from envi_store import EnviReferenceStore, spot_check
+        with phase("validation"):
+            mismatches = spot_check(EnviReferenceStore(output_file), "reflectance", rfl_meta, rfl_data)
+        assert not mismatches, f"References in {output_file} do not match {rfl_data} at {mismatches}."
+
+    return output_file
+
+def check_mosaic_compatible(base, header, path):
+    '''
+    Assert that `header` has the same grid, bands and data layout as the
+    mosaic header `base`.
+    '''
+    for field in ("samples", "lines", "bands", "dtype", "interleave"):
+        val, expected = getattr(header, field), getattr(base, field)
+        assert val == expected, f"{path}: {field} {val} does not match the mosaic ({expected})."
+    assert header.get("map info") == base.get("map info"), f"{path}: map info does not match the mosaic."
+    assert np.allclose(header.wavelength, base.wavelength), f"{path}: wavelengths do not match the mosaic."
+
+@timed_phase("kerchunk_shift_mosaic")
+def kerchunk_shift_mosaic(rfl_paths, output_file, lines_per_chunk=1, output_format="json", headers=None,
+                          infos=None, concurrency=64, storage_options=None, validate=False,
+                          bands_per_chunk=None):
+    '''
+    Time-stacked references of the SHIFT reflectance mosaics `rfl_paths`
+    (HDR paths), one time step per file in the order of the dates in their
+    names (see `parse_date`), with `reflectance` dimensions `time` plus
+    those of `kerchunk_shift_rfl`.
+
+    Headers are fetched concurrently unless passed in as `headers`
+    (`{hdr_path: EnviHeader}`), and every header must match the grid,
+    bands and data layout of the first (`check_mosaic_compatible`); no data
+    is read. The stack is written straight to `output_file` in one pass,
+    with the source versions (from `infos`, or fetched) recorded in the
+    root attributes for `batch_kerchunk.update_shift_mosaic`.
+    '''
+    from batch_kerchunk import fetch_headers, fetch_infos
+
+    assert rfl_paths, "Need at least one HDR file."
+    for path in rfl_paths:
+        assert path.endswith(".hdr"), f"Need path to HDR file, not binary. Got {path}."
+    flist = sorted(rfl_paths, key=lambda p: (parse_date(p), p))
+    if headers is None:
+        headers = fetch_headers(flist, concurrency, storage_options)
+    if infos is None:
+        infos = fetch_infos(flist, concurrency, storage_options)
+    failed = {p: headers[p] for p in flist if isinstance(headers[p], Exception)}
+    failed.update({p: infos[p] for p in flist if isinstance(infos[p], Exception)})
+    assert not failed, f"Cannot read the headers of {failed}."
+    rfl_meta = headers[flist[0]]
+    for path in flist[1:]:
+        check_mosaic_compatible(rfl_meta, headers[path], path)
+
+    dates = np.array([parse_date(f) for f in flist])
+    time_dict = {
+        "time/.zarray": ujson.dumps({
+            **zarray_common,
+            "chunks": [len(dates)],
+            "dtype": np.dtype(dates[0]).str,
+            "shape": [len(dates)]
+        }),
+        "time/.zattrs": ujson.dumps({
+            "_ARRAY_DIMENSIONS": ["time"]
+        }),
+        "time/0": string_encode(dates)
+    }
+
+    rfl_data = [envi_data_path(f) for f in flist]
+    rfl_dims, rfl_shape, rfl_chunks, rfl_grid = envi_cube_grid(rfl_data[0], rfl_meta, lines_per_chunk,
+                                                               bands_per_chunk, allow_short=output_format == "grid")
+    rfl_dim_names = {"line": "y", "band": "wavelength", "sample": "x"}
+    # One file per time step, prepended as the first axis
+    reflectance_grid = chunk_grid(rfl_data, rfl_grid["offset"], [0] + rfl_grid["strides"], rfl_grid["length"],
+                                  path_axis=0)
+    reflectance_dict = {
+        "reflectance/.zarray": ujson.dumps({
+            **zarray_common,
+            "chunks": [1] + rfl_chunks,
+            "dtype": rfl_meta.dtype.str,
+            "shape": [len(dates)] + rfl_shape,
+        }),
+        "reflectance/.zattrs": ujson.dumps({
+            "_ARRAY_DIMENSIONS": ["time"] + [rfl_dim_names[d] for d in rfl_dims]
+        })
+    }
+
+    sources = {f: EnviHeaderCache.version(infos[f]) for f in flist}
+    output = {
+        "version": 1,
+        "refs": {
+            ".zgroup": ujson.dumps({"zarr_format": 2}),
+            ".zattrs": ujson.dumps({**rfl_meta, "sources": sources}),
+            **shift_coordinate_refs(rfl_meta), **time_dict,
+            **reflectance_dict
+        },
+        "grids": {"reflectance": reflectance_grid}
     }
 
-    with fsspec.open(output_file, "w") as of:
-        of.write(ujson.dumps(output, indent=2))
+    output_file = write_references(output, output_file, output_format)
+
+    if validate:
+        from validate_kerchunk import validate_references
+        with phase("validation"):
+            report = validate_references(output_file, concurrency=concurrency, storage_options=storage_options,
+                                         remote_options=storage_options)
+        assert report["ok"], f"References in {output_file} do not match their files: " \
+            f"{report['problems']} {report['mismatches']}."
 
     return output_file
 
@@ -163,7 +275,22 @@ if __name__ == "__main__":
                         help = "Path or S3 URL to radiance HDR file.")
     parser.add_argument("--output_file", metavar="Outut JSON path", type=str, default=None,
                         help = "Path to target output JSON file.")
+    parser.add_argument("--lines_per_chunk", metavar="Lines per chunk", type=str, default="1",
+                        help = "Number of reflectance lines per chunk (must divide the number of lines, except with grid output), or 'auto' to target ~32 MiB chunks.")
+    parser.add_argument("--bands_per_chunk", metavar="Bands per chunk", type=int, default=None,
+                        help = "Split each BIL line into chunks of this many bands, so that reads of a few "
+                        "bands only fetch those bands. Requires lines_per_chunk 1.")
+    parser.add_argument("--output_format", choices=["json", "parquet", "grid"], default="json",
+                        help = "Reference format: compact JSON, kerchunk's lazily loaded Parquet, "
+                        "or closed-form grid JSON.")
+    parser.add_argument("--validate", action="store_true",
+                        help = "Spot-check a sample of reflectance chunks against the binary file.")
+    parser.add_argument("--stats", type=str, default=None,
+                        help = "Write I/O and timing statistics, with a Chrome trace, to this JSON file.")
 
     args = parser.parse_args()
-    output_file = kerchunk_shift_rfl(args.rfl_path, args.output_file)
+    with dump_stats(args.stats):
+        output_file = kerchunk_shift_rfl(args.rfl_path, args.output_file, lines_per_chunk=args.lines_per_chunk,
+                                         output_format=args.output_format, validate=args.validate,
+                                         bands_per_chunk=args.bands_per_chunk)
     print(f"Successfully created output file {output_file}.")
@@ -1,20 +1,13 @@
 import xarray as xr
 import rioxarray
+from envi_store import open_envi_dataset
 
-dtest = xr.open_dataset("reference://", engine="zarr", backend_kwargs={
-    "consolidated": False,
-    "storage_options": {
-        "fo": "s3://dh-shift-curated/aviris/v1/gridded/zarr.json"
-    }
-})
+dtest = open_envi_dataset("s3://dh-shift-curated/aviris/v1/gridded/zarr.json")
 
 dsub = dtest.isel(x=5000,y=5000)
 %time dsubv = dsub.reflectance.values
 
-dat = xr.open_dataset("reference://", engine="zarr", backend_kwargs={
-    "consolidated": False,
-    "storage_options": {"fo": "s3://dh-shift-curated/aviris/v1/gridded/20220224_box_rfl_phase.json"}
-})
+dat = open_envi_dataset("s3://dh-shift-curated/aviris/v1/gridded/20220224_box_rfl_phase.json")
 
 dat.y.max()
 dat.y.min()
@@ -0,0 +1,72 @@
+import os
+import concurrent.futures
+
+import numpy as np
+
+from envi_store import ChunkCache
+
+def chunk(i, size=100):
+    return bytes([i % 256]) * size
+
+def disk_bytes(cache_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".chunk"))
+
+def test_size_cap(tmp_path):
+    cache = ChunkCache(tmp_path, max_bytes=1000)
+    for i in range(10):
+        cache.put("s3://bucket/file", "v1", i*100, 100, chunk(i))
+    assert disk_bytes(tmp_path) == 1000
+    # Reading the oldest chunk makes it the most recent, so the next one is evicted instead
+    os.utime(os.path.join(tmp_path, cache._name("s3://bucket/file", "v1", 0, 100)), (0, 0))
+    assert cache.get("s3://bucket/file", "v1", 0, 100) == chunk(0)
+    cache.put("s3://bucket/file", "v1", 1000, 100, chunk(10))
+    assert disk_bytes(tmp_path) == 1000
+    assert cache.get("s3://bucket/file", "v1", 0, 100) == chunk(0)
+    assert cache.get("s3://bucket/file", "v1", 100, 100) is None
+    assert cache.get("s3://bucket/file", "v2", 0, 100) is None
+    assert cache._disk_size == disk_bytes(tmp_path)
+
+def test_size_cap_shared(tmp_path):
+    # Separate instances keep separate indexes, as separate processes do
+    caches = [ChunkCache(tmp_path, max_bytes=1000) for _ in range(2)]
+    for i in range(10):
+        for j, cache in enumerate(caches):
+            cache.put(f"s3://bucket/file{j}", "v1", i*100, 100, chunk(i))
+    assert disk_bytes(tmp_path) <= 1000
+
+def test_disk_hit_from_other_instance(tmp_path):
+    reader = ChunkCache(tmp_path, max_bytes=1000)
+    writer = ChunkCache(tmp_path, max_bytes=1000)
+    writer.put("s3://bucket/file", "v1", 0, 100, chunk(1))
+    assert reader.get("s3://bucket/file", "v1", 0, 100) == chunk(1)
+    assert reader._disk_size == 100
+    assert reader.stats["disk_hits"] == 1
+
+def test_threads(tmp_path):
+    cache = ChunkCache(tmp_path, max_bytes=50*100, memory_bytes=20*100)
+
+    def work(seed):
+        rng = np.random.default_rng(seed)
+        for i in rng.integers(0, 200, 300).tolist():
+            data = cache.get("s3://bucket/file", "v1", i*100, 100)
+            if data is None:
+                cache.put("s3://bucket/file", "v1", i*100, 100, chunk(i))
+            else:
+                assert data == chunk(i)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        for future in [pool.submit(work, seed) for seed in range(8)]:
+            future.result()
+    assert disk_bytes(tmp_path) <= 50*100
+    assert cache._memory_size == sum(len(data) for data in cache._memory.values()) <= 20*100
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+def test_processes(tmp_path):
+    with concurrent.futures.ProcessPoolExecutor(4) as pool:
+        list(pool.map(_fill, [str(tmp_path)]*4, range(4)))
+    assert disk_bytes(tmp_path) <= 1000
+
+def _fill(cache_dir, seed):
+    cache = ChunkCache(cache_dir, max_bytes=1000)
+    for i in range(30):
+        cache.put(f"s3://bucket/file{seed}", "v1", i*100, 100, chunk(i))
@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+import fsspec
+import ujson
+import zarr
+
+from utils import envi_dtypes, interleave_dims, read_envi_header, envi_cube_grid, envi_element_offsets, \
+    read_envi_region, band_variables, zarray_common, choose_lines_per_chunk
+from benchmark import write_envi
+from reference_writer import write_references
+from envi_store import EnviReferenceStore, target_protocols
+
+NLINES, NBANDS, NSAMP = 6, 4, 5
+
+# Every ENVI data type in both byte orders (single bytes have none)
+DTYPES = sorted({dtype.newbyteorder(order).str for dtype in envi_dtypes.values() for order in "<>"})
+
+def write_scene(tmp_path, dtype, interleave, header_offset=0, nbands=NBANDS):
+    '''
+    Synthetic ENVI file preceded by `header_offset` bytes of padding.
+    Returns its header, data path and contents in interleave order, read
+    with `np.fromfile`.
+    '''
+    data_path = str(tmp_path / f"scene_{interleave}")
+    hdr_path = write_envi(data_path, NLINES, nbands, NSAMP, dtype, interleave,
+                          **{"header offset": header_offset})
+    if header_offset:
+        with open(data_path, "rb") as f:
+            data = f.read()
+        with open(data_path, "wb") as f:
+            f.write(b"\xff"*header_offset + data)
+    with open(hdr_path) as f:
+        meta = read_envi_header(f)
+    sizes = {"line": NLINES, "band": nbands, "sample": NSAMP}
+    shape = [sizes[d] for d in interleave_dims[interleave]]
+    expected = np.fromfile(data_path, dtype=dtype, offset=header_offset).reshape(shape)
+    return meta, data_path, expected
+
+def read_references(tmp_path, refs, grids, var, output_format):
+    output = {"version": 1, "refs": {".zgroup": ujson.dumps({"zarr_format": 2}), **refs}, "grids": grids}
+    output_file = str(tmp_path / f"refs.{output_format}.json")
+    write_references(output, output_file, output_format)
+    if output_format == "grid":
+        store = EnviReferenceStore(output_file)
+    else:
+        store = fsspec.get_mapper("reference://", fo=output_file, remote_protocol="file")
+    return zarr.open_array(store, path=var, mode="r")[...]
+
+def cube_references(data_path, meta, lines_per_chunk=1, bands_per_chunk=None, allow_short=False):
+    dims, shape, chunks, grid = envi_cube_grid(data_path, meta, lines_per_chunk, bands_per_chunk, allow_short)
+    refs = {
+        "data/.zarray": ujson.dumps({**zarray_common, "chunks": chunks, "dtype": meta.dtype.str, "shape": shape}),
+        "data/.zattrs": ujson.dumps({"_ARRAY_DIMENSIONS": list(dims)})
+    }
+    return refs, {"data": grid}
+
+@pytest.mark.parametrize("header_offset", [0, 37])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_header_dtype(tmp_path, dtype, interleave, header_offset):
+    meta, _, _ = write_scene(tmp_path, dtype, interleave, header_offset)
+    assert meta.dtype == np.dtype(dtype)
+    assert meta.dtype.str == dtype
+    assert meta.header_offset == header_offset
+
+@pytest.mark.parametrize("output_format", ["json", "grid"])
+@pytest.mark.parametrize("header_offset", [0, 37])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_cube_references(tmp_path, dtype, interleave, header_offset, output_format):
+    meta, data_path, expected = write_scene(tmp_path, dtype, interleave, header_offset)
+    refs, grids = cube_references(data_path, meta)
+    actual = read_references(tmp_path, refs, grids, "data", output_format)
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+@pytest.mark.parametrize("lines_per_chunk", [1, 2, 3, 6, "auto"])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+def test_cube_lines_per_chunk(tmp_path, interleave, lines_per_chunk):
+    meta, data_path, expected = write_scene(tmp_path, ">i2", interleave, 16)
+    refs, grids = cube_references(data_path, meta, lines_per_chunk)
+    np.testing.assert_array_equal(read_references(tmp_path, refs, grids, "data", "json"), expected)
+
+@pytest.mark.parametrize("bands_per_chunk", [1, 2, 4])
+@pytest.mark.parametrize("dtype", ["<f4", ">c8", "|u1"])
+def test_cube_band_groups(tmp_path, dtype, bands_per_chunk):
+    meta, data_path, expected = write_scene(tmp_path, dtype, "bil", 16)
+    refs, grids = cube_references(data_path, meta, 1, bands_per_chunk)
+    np.testing.assert_array_equal(read_references(tmp_path, refs, grids, "data", "json"), expected)
+
+def test_non_divisor_chunks_rejected(tmp_path):
+    meta, data_path, _ = write_scene(tmp_path, "<f4", "bil")
+    with pytest.raises(AssertionError):
+        envi_cube_grid(data_path, meta, lines_per_chunk=4)
+    with pytest.raises(AssertionError):
+        envi_cube_grid(data_path, meta, bands_per_chunk=3)
+
+@pytest.mark.parametrize("lines_per_chunk", [4, 5])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+@pytest.mark.parametrize("dtype", ["<f4", ">c16", "|u1"])
+def test_cube_short_last_chunk(tmp_path, dtype, interleave, lines_per_chunk):
+    meta, data_path, expected = write_scene(tmp_path, dtype, interleave, 37)
+    refs, grids = cube_references(data_path, meta, lines_per_chunk, allow_short=True)
+    np.testing.assert_array_equal(read_references(tmp_path, refs, grids, "data", "grid"), expected)
+
+@pytest.mark.parametrize("bands_per_chunk", [3])
+@pytest.mark.parametrize("dtype", ["<f4", ">c8", "|u1"])
+def test_cube_short_band_group(tmp_path, dtype, bands_per_chunk):
+    meta, data_path, expected = write_scene(tmp_path, dtype, "bil", 16)
+    refs, grids = cube_references(data_path, meta, 1, bands_per_chunk, allow_short=True)
+    np.testing.assert_array_equal(read_references(tmp_path, refs, grids, "data", "grid"), expected)
+
+@pytest.mark.parametrize("output_format", ["json", "grid", "parquet"])
+def test_write_references_failure(tmp_path, output_format):
+    meta, data_path, _ = write_scene(tmp_path, "<f4", "bil")
+    refs, grids = cube_references(data_path, meta)
+    # A grid without its .zarray fails after the explicit references are written
+    output = {"version": 1, "refs": {".zgroup": ujson.dumps({"zarr_format": 2})}, "grids": grids}
+    output_file = tmp_path / f"refs.{output_format}"
+    with pytest.raises(KeyError):
+        write_references(output, str(output_file), output_format)
+    assert not output_file.exists()
+
+def test_target_protocols(tmp_path):
+    meta, data_path, _ = write_scene(tmp_path, "<f4", "bil")
+    refs, grids = cube_references(data_path, meta)
+    assert target_protocols(refs, grids) == {"file"}
+    assert target_protocols({"data/0.0.0": ["s3://bucket/scene", 0, 80]}, {}) == {"s3"}
+    grids["data"]["path"] = "s3://bucket/scene"
+    assert target_protocols(refs, grids) == {"s3"}
+
+def test_choose_lines_per_chunk():
+    assert choose_lines_per_chunk(100, 10, target_bytes=300) == 25
+    assert choose_lines_per_chunk(100, 10, target_bytes=300, allow_short=True) == 30
+    with pytest.warns(UserWarning):
+        assert choose_lines_per_chunk(20011, 425*1280*4) == 1
+    assert choose_lines_per_chunk(20011, 425*1280*4, allow_short=True) == 15
+
+@pytest.mark.parametrize("header_offset", [0, 37])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_element_offsets(tmp_path, dtype, interleave, header_offset):
+    meta, data_path, expected = write_scene(tmp_path, dtype, interleave, header_offset)
+    order = [interleave_dims[interleave].index(d) for d in ("line", "band", "sample")]
+    expected = expected.transpose(order)
+    lines, bands, samples = [1, 4, 5], [0, 3], [2, 3, 4]
+
+    offsets = envi_element_offsets(meta, lines, bands, samples)
+    flat = np.fromfile(data_path, dtype=np.uint8)
+    itemsize = np.dtype(dtype).itemsize
+    raw = flat[offsets[..., None] + np.arange(itemsize)]
+    np.testing.assert_array_equal(raw.view(dtype)[..., 0], expected[np.ix_(lines, bands, samples)])
+
+    with open(data_path, "rb") as f:
+        region = read_envi_region(f, meta, lines, bands, samples)
+    np.testing.assert_array_equal(region, expected[np.ix_(lines, bands, samples)])
+
+@pytest.mark.parametrize("lines_per_chunk,output_format", [(1, "json"), (3, "json"), ("auto", "json"), (4, "grid")])
+@pytest.mark.parametrize("interleave", ["bil", "bsq", "bip"])
+@pytest.mark.parametrize("dtype", ["<f8", ">f4", ">u2", "|u1", ">c16"])
+def test_band_variables(tmp_path, dtype, interleave, lines_per_chunk, output_format):
+    meta, data_path, expected = write_scene(tmp_path, dtype, interleave, 37)
+    if interleave == "bil":
+        lines_per_chunk = 1
+    allow_short = output_format == "grid"
+    if interleave == "bip":
+        with pytest.warns(UserWarning):
+            refs, grids = band_variables(data_path, meta, lines_per_chunk=lines_per_chunk, allow_short=allow_short)
+        assert list(grids) == ["bands"]
+        np.testing.assert_array_equal(read_references(tmp_path, refs, grids, "bands", output_format), expected)
+        return
+    refs, grids = band_variables(data_path, meta, lines_per_chunk=lines_per_chunk, allow_short=allow_short)
+    assert len(grids) == NBANDS
+    band_axis = interleave_dims[interleave].index("band")
+    for band, var in enumerate(grids):
+        actual = read_references(tmp_path, refs, grids, var, output_format)
+        np.testing.assert_array_equal(actual, np.take(expected, band, axis=band_axis))
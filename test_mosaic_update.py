@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmark import write_synthetic_scene
+from batch_kerchunk import list_headers, update_shift_mosaic
+from shift_kerchunk import kerchunk_shift_mosaic
+from envi_store import open_envi_dataset
+
+NLINES, NBANDS, NSAMP = 6, 4, 5
+
+def write_rfl(tmp_path, date, seed):
+    '''
+    Synthetic SHIFT reflectance file named after `date` in `tmp_path/rfl`.
+    Returns its binary path.
+    '''
+    rfl_hdr = write_synthetic_scene(str(tmp_path), NLINES, NBANDS, NSAMP, seed=seed)[2]
+    data_path = str(tmp_path / "rfl" / f"{date}_rfl")
+    os.rename(rfl_hdr[:-4], data_path)
+    os.rename(rfl_hdr, data_path + ".hdr")
+    return data_path
+
+def check_mosaic(output_file, data_paths):
+    ds = open_envi_dataset(output_file, chunks=None)
+    assert ds.reflectance.dims == ("time", "y", "wavelength", "x")
+    assert ds.sizes["time"] == len(data_paths)
+    for t, data_path in enumerate(data_paths):
+        expected = np.fromfile(data_path, dtype="<f4").reshape(NLINES, NBANDS, NSAMP)
+        np.testing.assert_array_equal(ds.reflectance[t].values, expected)
+    dates = [np.datetime64(f"{p[:4]}-{p[4:6]}-{p[6:8]}") for p in map(os.path.basename, data_paths)]
+    np.testing.assert_array_equal(ds.time.values.astype("datetime64[D]"), dates)
+
+@pytest.mark.parametrize("output_format", ["json", "grid", "parquet"])
+def test_update_shift_mosaic(tmp_path, output_format):
+    prefix = str(tmp_path / "rfl")
+    os.makedirs(prefix)
+    first = write_rfl(tmp_path, "20220301", 0)
+    last = write_rfl(tmp_path, "20220320", 3)
+    output_file = str(tmp_path / f"mosaic.{output_format}")
+    kerchunk_shift_mosaic(list_headers(prefix, suffix="rfl.hdr"), output_file, output_format=output_format)
+    check_mosaic(output_file, [first, last])
+
+    # A new date between the others, and a removed one
+    middle = write_rfl(tmp_path, "20220310", 6)
+    os.remove(first)
+    os.remove(first + ".hdr")
+    added, changed, removed, failures = update_shift_mosaic(output_file, prefix, suffix="rfl.hdr",
+                                                            progress=lambda message: None)
+    assert [os.path.basename(p) for p in added] == ["20220310_rfl.hdr"]
+    assert [os.path.basename(p) for p in removed] == ["20220301_rfl.hdr"]
+    assert not changed and not failures
+    check_mosaic(output_file, [middle, last])
+
+    assert update_shift_mosaic(output_file, prefix, suffix="rfl.hdr", progress=lambda message: None) == \
+        ([], [], [], {})
+    check_mosaic(output_file, [middle, last])
@@ -1,87 +1,255 @@
+import numpy as np
 import fsspec
+import ujson
 import warnings
+import itertools
+import hashlib
 import base64
-import numpy as np
+import os
+import re
+import datetime
+
+from iostats import phase
 
 def string_encode(x):
     bits = base64.b64encode(x)
-    s = str(bits).lstrip("b'").rstrip("'")
-    return f"base64:{s}"
+    return f"base64:{bits.decode()}"
 
-def read_envi_header(f):
+class EnviHeaderError(ValueError):
+    def __init__(self, msg, lineno=None, path=None):
+        self.lineno = lineno
+        self.path = path
+        location = path or "<ENVI header>"
+        if lineno is not None:
+            location = f"{location}, line {lineno}"
+        super().__init__(f"{location}: {msg}")
+
+# Header fields holding numeric lists, which are also parsed into NumPy arrays
+numeric_list_fields = (
+    "wavelength", "fwhm", "bbl", "data gain values", "data offset values",
+    "data reflectance gain values", "data reflectance offset values"
+)
+
+class EnviHeader(dict):
     '''
-    USAGE:
+    Parsed ENVI header.
 
-    with open(somefile, "r") as f:
-        read_envi_header(f)
+    As a dictionary it holds the raw values as strings (lowercase keys,
+    `{...}` lists as lists of strings), so it can be serialized as is.
+    Numeric lists are also available as NumPy arrays in `arrays`, and the
+    properties below return typed values of the common fields.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrays = {}
+
+    @classmethod
+    def from_dict(cls, raw, path=None):
+        header = cls(raw)
+        for key in numeric_list_fields:
+            if key in header:
+                header.arrays[key] = _numeric_list(key, header[key], None, path)
+        return header
+
+    def _required(self, key):
+        if key not in self:
+            raise EnviHeaderError(f"Missing required field '{key}'.")
+        return self[key]
+
+    def _int(self, key, default=None):
+        if key not in self and default is not None:
+            return default
+        val = self._required(key)
+        try:
+            return int(val)
+        except (TypeError, ValueError):
+            raise EnviHeaderError(f"Field '{key}' must be an integer. Got {val!r}.")
+
+    @property
+    def samples(self):
+        return self._int("samples")
 
-    Reads an ENVI ".hdr" file header and returns the parameters in a
-    dictionary as strings.  Header field names are treated as case
-    insensitive and all keys in the dictionary are lowercase.
+    @property
+    def lines(self):
+        return self._int("lines")
+
+    @property
+    def bands(self):
+        return self._int("bands")
+
+    @property
+    def header_offset(self):
+        return self._int("header offset", 0)
+
+    @property
+    def byte_order(self):
+        byte_order = self.get("byte order", "0")
+        if byte_order not in ("0", "1"):
+            raise EnviHeaderError(f"Field 'byte order' must be 0 or 1. Got {byte_order!r}.")
+        return {"0": "<", "1": ">"}[byte_order]
+
+    @property
+    def dtype(self):
+        data_type = self._required("data type")
+        if data_type not in envi_dtypes:
+            raise EnviHeaderError(f"Unsupported 'data type' {data_type!r}.")
+        return envi_dtypes[data_type].newbyteorder(self.byte_order)
+
+    @property
+    def interleave(self):
+        return self._required("interleave").lower()
+
+    @property
+    def wavelength(self):
+        return self.arrays.get("wavelength")
+
+    @property
+    def fwhm(self):
+        return self.arrays.get("fwhm")
+
+    @property
+    def band_names(self):
+        return self.get("band names")
+
+def _numeric_list(key, vals, lineno, path):
+    try:
+        return np.array(vals, dtype=np.float64)
+    except ValueError:
+        bad = next(v for v in vals if not _is_number(v))
+        raise EnviHeaderError(f"Invalid number {bad!r} in '{key}'.", lineno, path)
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+def parse_envi_header(text, path=None):
+    '''
+    Parse the text of an ENVI ".hdr" file into an `EnviHeader` in a single
+    pass. Raises `EnviHeaderError` with the offending line on bad input.
     '''
 
     # ENVI header description: 
     # https://www.l3harrisgeospatial.com/docs/enviheaderfiles.html
 
+    lines = text.splitlines()
+    if not lines or not lines[0].strip().startswith("ENVI"):
+        raise EnviHeaderError('File does not appear to be an ENVI header (missing "ENVI" '
+                              'at beginning of first line).', 1, path)
+
+    header = EnviHeader()
+    have_nonlowercase_param = False
+    i = 1
+    while i < len(lines):
+        line = lines[i]
+        lineno = i + 1
+        i += 1
+        if line.startswith(";"):
+            continue
+        (key, sep, val) = line.partition("=")
+        if not sep:
+            continue
+        key = key.strip()
+        if not key:
+            raise EnviHeaderError("Missing parameter name before '='.", lineno, path)
+        if not key.islower():
+            have_nonlowercase_param = True
+            key = key.lower()
+        val = val.strip()
+        if not val.startswith("{"):
+            header[key] = val
+            continue
+
+        # Multi-line {...} value: collect the pieces and join once
+        parts = [val]
+        while not parts[-1].endswith("}"):
+            if i >= len(lines):
+                raise EnviHeaderError(f"Unterminated '{{' in the value of '{key}'.", lineno, path)
+            line = lines[i]
+            i += 1
+            if line.startswith(";"):
+                continue
+            parts.append(line.strip())
+        val = "\n".join(parts)
+        if key == "description":
+            header[key] = val.strip("{}").strip()
+            continue
+        inner = val[1:-1]
+        vals = [v.strip() for v in inner.split(",")] if inner.strip() else []
+        header[key] = vals
+        if key in numeric_list_fields:
+            header.arrays[key] = _numeric_list(key, vals, lineno, path)
+
+    if have_nonlowercase_param:
+        warnings.warn("Parameters with non-lowercase names encountered and converted to lowercase.")
+    return header
+
+def read_envi_header(f):
+    '''
+    USAGE:
+
+    with open(somefile, "r") as f:
+        read_envi_header(f)
+
+    Reads an ENVI ".hdr" file header and returns an `EnviHeader`, a
+    dictionary of the parameters as strings with typed accessors. Header
+    field names are treated as case insensitive and all keys in the
+    dictionary are lowercase.
+    '''
+    path = getattr(f, "path", None) or getattr(f, "name", None)
     try:
-        starts_with_ENVI = f.readline().strip().startswith('ENVI')
+        with phase("header fetch"):
+            text = f.read()
     except UnicodeDecodeError:
-        msg = 'File does not appear to be an ENVI header (appears to be a ' \
-          'binary file).'
-        raise Exception(msg)
-    else:
-        if not starts_with_ENVI:
-            msg = 'File does not appear to be an ENVI header (missing "ENVI" \
-              at beginning of first line).'
-            raise Exception(msg)
+        raise EnviHeaderError("File does not appear to be an ENVI header (appears to be a "
+                              "binary file).", path=path)
+    with phase("header parse"):
+        return parse_envi_header(text, path)
+
+class EnviHeaderCache:
+    '''
+    Parsed headers keyed by path and object version: the ETag when the
+    filesystem reports one (S3), otherwise modification time and size.
+    Kept in memory and, when `cache_dir` is given, as small JSON files that
+    persist across runs.
+    '''
 
-    lines = f.readlines()
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._headers = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
 
-    dict = {}
-    have_nonlowercase_param = False
-    # support_nonlowercase_params = spy.settings.envi_support_nonlowercase_params
-    support_nonlowercase_params = False
-    try:
-        while lines:
-            line = lines.pop(0)
-            if line.find('=') == -1: continue
-            if line[0] == ';': continue
-
-            (key, sep, val) = line.partition('=')
-            key = key.strip()
-            if not key.islower():
-                have_nonlowercase_param = True
-                if not support_nonlowercase_params:
-                    key = key.lower()
-            val = val.strip()
-            if val and val[0] == '{':
-                str = val.strip()
-                while str[-1] != '}':
-                    line = lines.pop(0)
-                    if line[0] == ';': continue
-
-                    str += '\n' + line.strip()
-                if key == 'description':
-                    dict[key] = str.strip('{}').strip()
-                else:
-                    vals = str[1:-1].split(',')
-                    for j in range(len(vals)):
-                        vals[j] = vals[j].strip()
-                    dict[key] = vals
-            else:
-                dict[key] = val
-
-        if have_nonlowercase_param and not support_nonlowercase_params:
-            msg = 'Parameters with non-lowercase names encountered ' \
-                  'and converted to lowercase. To retain source file ' \
-                  'parameter name capitalization, set ' \
-                  'spectral.settings.envi_support_nonlowercase_params to ' \
-                  'True.'
-            warnings.warn(msg)
-            # logger.debug('ENVI header parameter names converted to lower case.')
-        return dict
-    except:
-        raise Exception()
+    @staticmethod
+    def version(info):
+        etag = info.get("ETag") or info.get("etag")
+        if etag:
+            return str(etag).strip('"')
+        mtime = info.get("mtime") or info.get("LastModified") or info.get("last_modified")
+        return f"{mtime}-{info.get('size')}"
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1("\0".join(key).encode()).hexdigest() + ".json")
+
+    def get(self, path, info):
+        key = (path, self.version(info))
+        if key not in self._headers and self.cache_dir is not None:
+            try:
+                with open(self._file(key)) as f:
+                    self._headers[key] = EnviHeader.from_dict(ujson.load(f), path)
+            except FileNotFoundError:
+                pass
+        return self._headers.get(key)
+
+    def put(self, path, info, header):
+        key = (path, self.version(info))
+        self._headers[key] = header
+        if self.cache_dir is not None:
+            with open(self._file(key), "w") as f:
+                f.write(ujson.dumps(header))
 
 zarray_common = {
     "compressor": None,
@@ -95,7 +263,7 @@ zarray_common = {
 # https://www.l3harrisgeospatial.com/docs/enviheaderfiles.html
 
 envi_dtypes = {
-    "1": np.dtype("int8"),
+    "1": np.dtype("uint8"),      # ENVI "byte" is unsigned
     "2": np.dtype("int16"),
     "3": np.dtype("int32"),
     "4": np.dtype("float32"),     # float32
@@ -107,3 +275,385 @@ envi_dtypes = {
     "14": np.dtype("int64"),
     "15": np.dtype("uint64")
 }
+
+# Default size targeted by `lines_per_chunk="auto"`
+DEFAULT_CHUNK_BYTES = 32 * 2**20
+
+def choose_lines_per_chunk(nlines, line_bytes, target_bytes=DEFAULT_CHUNK_BYTES, allow_short=False):
+    '''
+    Pick the number of consecutive lines per chunk, for chunks of at most
+    `target_bytes`. With `allow_short` (references read through
+    `envi_store.EnviReferenceStore`, which pads a short last chunk), that
+    is as many lines as fit. Otherwise it is the largest divisor of
+    `nlines` that fits (1 at worst), because stock Zarr readers expect
+    every chunk, including the last one, to be full size; a warning is
+    issued when that is less than half of what fits.
+    '''
+    max_lines = int(max(1, min(nlines, target_bytes // line_bytes)))
+    if allow_short:
+        return max_lines
+    lines_per_chunk = next(n for n in range(max_lines, 0, -1) if nlines % n == 0)
+    if lines_per_chunk < max_lines // 2:
+        warnings.warn(f"{nlines} lines have no divisor near the {max_lines} lines per chunk that fit "
+                      f"{target_bytes} bytes; using {lines_per_chunk}. Grid output allows a short last chunk.")
+    return lines_per_chunk
+
+def resolve_lines_per_chunk(lines_per_chunk, nlines, line_bytes, allow_short=False):
+    if lines_per_chunk == "auto":
+        return choose_lines_per_chunk(nlines, line_bytes, allow_short=allow_short)
+    lines_per_chunk = int(lines_per_chunk)
+    assert lines_per_chunk >= 1, f"lines_per_chunk must be positive. Got {lines_per_chunk}."
+    lines_per_chunk = min(lines_per_chunk, nlines)
+    assert allow_short or nlines % lines_per_chunk == 0, \
+        f"lines_per_chunk must divide the number of lines ({nlines}), or the last chunk is short and " \
+        f"stock Zarr readers cannot decode it (grid output allows it). Got {lines_per_chunk}."
+    return lines_per_chunk
+
+def resolve_bands_per_chunk(bands_per_chunk, nbands, allow_short=False):
+    if bands_per_chunk is None:
+        return None
+    bands_per_chunk = int(bands_per_chunk)
+    assert bands_per_chunk >= 1, f"bands_per_chunk must be positive. Got {bands_per_chunk}."
+    bands_per_chunk = min(bands_per_chunk, nbands)
+    assert allow_short or nbands % bands_per_chunk == 0, \
+        f"bands_per_chunk must divide the number of bands ({nbands}), or the last chunk of each line is short " \
+        f"and stock Zarr readers cannot decode it (grid output allows it). Got {bands_per_chunk}."
+    return bands_per_chunk
+
+def chunk_grid(path, offset, strides, length, path_axis=None):
+    '''
+    Closed-form description of the chunk references of one variable: chunk
+    `index` starts at `offset + sum(index * strides)` bytes and is `length`
+    bytes long. When `path_axis` is set, `path` is a list of files indexed
+    along that axis (e.g. one file per time step).
+    '''
+    grid = {
+        "path": path,
+        "offset": int(offset),
+        "strides": [int(s) for s in strides],
+        "length": int(length)
+    }
+    if path_axis is not None:
+        grid["path_axis"] = path_axis
+    return grid
+
+def line_chunk_grid(data_path, line_bytes, lines_per_chunk, ndim, offset=0):
+    '''
+    Grid for a BIL array split into blocks of `lines_per_chunk`
+    consecutive lines along its first axis.
+    '''
+    block_bytes = lines_per_chunk*line_bytes
+    return chunk_grid(data_path, offset, [block_bytes] + [0]*(ndim - 1), block_bytes)
+
+# Axis order of each ENVI interleave, outermost first
+interleave_dims = {
+    "bil": ("line", "band", "sample"),
+    "bip": ("line", "sample", "band"),
+    "bsq": ("band", "line", "sample")
+}
+
+def interleave_line_bytes(interleave, nbands, nsamp, itemsize):
+    '''
+    Bytes per line of one chunk: all bands of a line for BIL and BIP, a
+    single band of a line for BSQ.
+    '''
+    if interleave == "bsq":
+        return nsamp*itemsize
+    return nbands*nsamp*itemsize
+
+def interleave_chunk_grid(data_path, interleave, nlines, nbands, nsamp, itemsize,
+                          lines_per_chunk, offset=0, bands_per_chunk=None):
+    '''
+    Dimensions, shape, chunks and grid of an ENVI cube in its native axis
+    order (see `interleave_dims`), so that every chunk is contiguous on
+    disk. BIL and BIP chunks are blocks of `lines_per_chunk` whole lines
+    (`[L, nbands, nsamp]` and `[L, nsamp, nbands]`); BSQ chunks are blocks
+    of lines of a single band (`[1, L, nsamp]`).
+
+    With `bands_per_chunk` below `nbands`, BIL lines are split into groups
+    of that many bands (`[1, B, nsamp]`), each contiguous within its line,
+    so that reads of a few bands only fetch those bands. Groups span a
+    single line, since the next line's bands lie in between. BSQ chunks
+    already hold a single band; BIP bands are never contiguous.
+    '''
+    assert interleave in interleave_dims, f"Interleave {interleave} unsupported. Must be one of {list(interleave_dims)}."
+    dims = interleave_dims[interleave]
+    sizes = {"line": nlines, "band": nbands, "sample": nsamp}
+    shape = [sizes[d] for d in dims]
+    line_bytes = interleave_line_bytes(interleave, nbands, nsamp, itemsize)
+    if bands_per_chunk is not None and bands_per_chunk < nbands and interleave != "bsq":
+        assert interleave == "bil", f"Band groups need BIL or BSQ interleave. Got {interleave}."
+        assert lines_per_chunk == 1, f"BIL band groups can only span one line. Got lines_per_chunk={lines_per_chunk}."
+        chunks = [1, bands_per_chunk, nsamp]
+        group_bytes = bands_per_chunk*nsamp*itemsize
+        grid = chunk_grid(data_path, offset, [line_bytes, group_bytes, 0], group_bytes)
+    elif interleave == "bsq":
+        chunks = [1, lines_per_chunk, nsamp]
+        block_bytes = lines_per_chunk*line_bytes
+        grid = chunk_grid(data_path, offset, [nlines*line_bytes, block_bytes, 0], block_bytes)
+    else:
+        chunks = [lines_per_chunk] + shape[1:]
+        grid = line_chunk_grid(data_path, line_bytes, lines_per_chunk, 3, offset)
+    return dims, shape, chunks, grid
+
+def envi_cube_grid(data_path, meta, lines_per_chunk=1, bands_per_chunk=None, allow_short=False):
+    '''
+    Dimensions, shape, chunks and grid of the cube described by the ENVI
+    header `meta` (see `interleave_chunk_grid`). This is the one place
+    where generators turn a header into byte offsets: it uses the real
+    item size of the data type (not its alignment, which differs e.g. for
+    complex types), skips the `header offset`, and resolves
+    `lines_per_chunk` ("auto" or a number) and `bands_per_chunk` (None for
+    whole lines). The byte order is part of `meta.dtype`, which goes into
+    the `.zarray`. Short last chunks are only allowed with `allow_short`,
+    for references read through `envi_store.EnviReferenceStore` (grid
+    output), which pads them.
+    '''
+    itemsize = meta.dtype.itemsize
+    bands_per_chunk = resolve_bands_per_chunk(bands_per_chunk, meta.bands, allow_short)
+    if meta.interleave == "bil" and bands_per_chunk is not None and bands_per_chunk < meta.bands:
+        # Band groups are single-line chunks
+        lines_per_chunk = 1 if lines_per_chunk == "auto" else lines_per_chunk
+    line_bytes = interleave_line_bytes(meta.interleave, meta.bands, meta.samples, itemsize)
+    lines_per_chunk = resolve_lines_per_chunk(lines_per_chunk, meta.lines, line_bytes, allow_short)
+    return interleave_chunk_grid(data_path, meta.interleave, meta.lines, meta.bands, meta.samples,
+                                 itemsize, lines_per_chunk, meta.header_offset, bands_per_chunk)
+
+def envi_element_offsets(meta, lines, bands, samples):
+    '''
+    Byte offsets of the elements at the given line, band and sample
+    indices of an ENVI file, as an array of shape `(lines, bands,
+    samples)`. Computed directly from the header, independently of the
+    chunk grids, so it can be used to check them.
+    '''
+    index = dict(zip(("line", "band", "sample"), np.ix_(np.asarray(lines), np.asarray(bands), np.asarray(samples))))
+    sizes = {"line": meta.lines, "band": meta.bands, "sample": meta.samples}
+    outer, middle, inner = interleave_dims[meta.interleave]
+    flat = (index[outer]*sizes[middle] + index[middle])*sizes[inner] + index[inner]
+    return meta.header_offset + flat.astype(np.int64)*meta.dtype.itemsize
+
+def read_envi_region(f, meta, lines, bands, samples):
+    '''
+    Read the elements at the given line, band and sample indices from the
+    ENVI file open as `f` (any seekable binary file object), in
+    `(line, band, sample)` order. Only the byte span covering them is read.
+    '''
+    offsets = envi_element_offsets(meta, lines, bands, samples)
+    start = int(offsets.min())
+    f.seek(start)
+    buf = f.read(int(offsets.max()) + meta.dtype.itemsize - start)
+    return np.frombuffer(buf, dtype=meta.dtype)[(offsets - start) // meta.dtype.itemsize]
+
+def envi_memmap(data_path, meta, mode="r"):
+    '''
+    Memory map of a local ENVI binary file (header `meta`) in its native
+    interleave order (see `interleave_dims`).
+    '''
+    sizes = {"line": meta.lines, "band": meta.bands, "sample": meta.samples}
+    shape = tuple(sizes[d] for d in interleave_dims[meta.interleave])
+    return np.memmap(data_path, dtype=meta.dtype, mode=mode, offset=meta.header_offset, shape=shape)
+
+def band_variable_name(band_name):
+    '''
+    Variable name for an ENVI band name: parenthesized units and
+    descriptions are dropped, the rest is lowercased snake case, e.g.
+    "To-sun zenith (0 to 90 degrees from zenith)" -> "to_sun_zenith".
+    '''
+    name = re.sub(r"\(.*?\)", "", band_name)
+    return re.sub(r"[^0-9a-zA-Z]+", "_", name).strip("_").lower()
+
+def band_variable_names(band_names, nbands, taken=()):
+    '''
+    Unique variable names for the `nbands` bands of a file, from its
+    `band names` where available and `band_{i}` otherwise. Names that
+    collide with each other or with `taken` get the band index appended.
+    '''
+    names = []
+    for i in range(nbands):
+        name = band_variable_name(band_names[i]) if band_names and i < len(band_names) else ""
+        name = name or f"band_{i}"
+        if name in names or name in taken:
+            name = f"{name}_{i}"
+        names.append(name)
+    return names
+
+def band_chunk_grid(data_path, interleave, nlines, nbands, nsamp, itemsize, band,
+                    lines_per_chunk=1, offset=0):
+    '''
+    Chunks and grid of band `band` of an ENVI file as a `(line, sample)`
+    array. BSQ chunks are blocks of `lines_per_chunk` lines. In BIL the
+    lines of one band are not contiguous, so chunks are single lines.
+    '''
+    if interleave == "bsq":
+        block_bytes = lines_per_chunk*nsamp*itemsize
+        return [lines_per_chunk, nsamp], chunk_grid(data_path, offset + band*nlines*nsamp*itemsize,
+                                                     [block_bytes, 0], block_bytes)
+    assert interleave == "bil", f"Interleave {interleave} unsupported for per-band variables. Only BIL and BSQ interleave currently supported."
+    assert lines_per_chunk == 1, f"BIL bands can only be split into single-line chunks. Got lines_per_chunk={lines_per_chunk}."
+    return [1, nsamp], chunk_grid(data_path, offset + band*nsamp*itemsize, [nbands*nsamp*itemsize, 0],
+                                  nsamp*itemsize)
+
+def band_variables(data_path, meta, names=None, dims=("line", "sample"), lines_per_chunk=1,
+                   taken=(), bip_name="bands", allow_short=False):
+    '''
+    References exposing every band of an ENVI file (header `meta`) as its
+    own `dims` variable, named from the header's band names (see
+    `band_variable_names`) unless `names` are given. Returns
+    `(refs, grids)` to merge into a reference set.
+
+    BSQ bands are split into blocks of `lines_per_chunk` lines ("auto"
+    targets ~32 MiB chunks) and BIL bands into single lines. BIP bands are
+    not contiguous anywhere, so a BIP file becomes a single `bip_name`
+    variable (chunked by lines) with a trailing `{bip_name}_band`
+    dimension, whose coordinate holds the variable names. `allow_short`
+    is as in `envi_cube_grid`.
+    '''
+    nlines, nsamp, nbands = meta.lines, meta.samples, meta.bands
+    dtype = meta.dtype
+    itemsize = dtype.itemsize
+    band_names = meta.band_names or []
+    if names is None:
+        names = band_variable_names(band_names, nbands, taken)
+    assert len(names) == nbands, f"Got {len(names)} names for {nbands} bands."
+    refs = {}
+    grids = {}
+
+    if meta.interleave == "bip":
+        warnings.warn(f"BIP bands of {data_path} are not contiguous; exposing them as one "
+                      f"'{bip_name}' variable with a band dimension.")
+        lines_per_chunk = resolve_lines_per_chunk(lines_per_chunk, nlines, nbands*nsamp*itemsize, allow_short)
+        _, shape, chunks, grids[bip_name] = interleave_chunk_grid(
+            data_path, "bip", nlines, nbands, nsamp, itemsize, lines_per_chunk, meta.header_offset
+        )
+        band_labels = np.array(names)
+        band_dim = f"{bip_name}_band"
+        refs[f"{bip_name}/.zarray"] = ujson.dumps({
+            **zarray_common,
+            "chunks": chunks,
+            "dtype": dtype.str,
+            "shape": shape,
+        })
+        refs[f"{bip_name}/.zattrs"] = ujson.dumps({
+            "_ARRAY_DIMENSIONS": [*dims, band_dim],
+            "long_names": band_names
+        })
+        refs[f"{band_dim}/.zarray"] = ujson.dumps({
+            **zarray_common,
+            "chunks": [nbands],
+            "dtype": band_labels.dtype.str,
+            "shape": [nbands],
+        })
+        refs[f"{band_dim}/.zattrs"] = ujson.dumps({
+            "_ARRAY_DIMENSIONS": [band_dim]
+        })
+        refs[f"{band_dim}/0"] = string_encode(band_labels)
+        return refs, grids
+
+    if meta.interleave == "bsq":
+        lines_per_chunk = resolve_lines_per_chunk(lines_per_chunk, nlines, nsamp*itemsize, allow_short)
+    else:
+        lines_per_chunk = 1
+    for band, name in enumerate(names):
+        chunks, grids[name] = band_chunk_grid(
+            data_path, meta.interleave, nlines, nbands, nsamp, itemsize, band, lines_per_chunk, meta.header_offset
+        )
+        refs[f"{name}/.zarray"] = ujson.dumps({
+            **zarray_common,
+            "chunks": chunks,
+            "dtype": dtype.str,
+            "shape": [nlines, nsamp],
+        })
+        refs[f"{name}/.zattrs"] = ujson.dumps({
+            "_ARRAY_DIMENSIONS": list(dims),
+            "long_name": band_names[band] if band < len(band_names) else f"Band {band}"
+        })
+    return refs, grids
+
+def grid_chunk_ref(grid, shape, chunks, index):
+    '''
+    `[path, offset, length]` reference of chunk `index` of a grid. Chunks
+    are contiguous, so a short last chunk along the outermost multi-element
+    chunk axis only covers the remaining elements.
+    '''
+    path_axis = grid.get("path_axis")
+    path = grid["path"] if path_axis is None else grid["path"][index[path_axis]]
+    offset = grid["offset"] + sum(i*s for i, s in zip(index, grid["strides"]))
+    length = grid["length"]
+    for axis, (i, n, c) in enumerate(zip(index, shape, chunks)):
+        if axis == path_axis or c == 1:
+            continue
+        length = length * min(c, n - i*c) // c
+        break
+    return [path, offset, length]
+
+def grid_nchunks(shape, chunks):
+    return [-(-n // c) for n, c in zip(shape, chunks)]
+
+def grid_chunk_arrays(grid, shape, chunks, start=0, stop=None):
+    '''
+    Path indices, offsets and lengths of the chunks of a grid, as int64
+    arrays in C order of the chunk index (the order of kerchunk's Parquet
+    records). Vectorized equivalent of `grid_chunk_ref`. `start` and `stop`
+    select a range of flat chunk indices, so that large grids can be
+    processed in bounded memory.
+    '''
+    nchunks = grid_nchunks(shape, chunks)
+    total = int(np.prod(nchunks))
+    stop = total if stop is None else min(stop, total)
+    index = np.unravel_index(np.arange(start, stop, dtype=np.int64), nchunks)
+    strides = grid["strides"]
+    offsets = np.full(stop - start, grid["offset"], dtype=np.int64)
+    for axis_index, stride in zip(index, strides):
+        offsets += axis_index * stride
+    lengths = np.full(offsets.shape, grid["length"], dtype=np.int64)
+    path_axis = grid.get("path_axis")
+    for axis, (n, c) in enumerate(zip(shape, chunks)):
+        if axis == path_axis or c == 1:
+            continue
+        lengths = lengths * np.minimum(c, n - index[axis]*c) // c
+        break
+    if path_axis is None:
+        path_index = np.zeros(offsets.shape, dtype=np.int64)
+    else:
+        path_index = index[path_axis]
+    return path_index, offsets, lengths
+
+def grid_paths(grid):
+    return grid["path"] if "path_axis" in grid else [grid["path"]]
+
+def grid_chunk_refs(key, grid, shape, chunks, block_size=65536):
+    paths = grid_paths(grid)
+    nchunks = grid_nchunks(shape, chunks)
+    chunk_keys = itertools.product(*(range(n) for n in nchunks))
+    for start in range(0, int(np.prod(nchunks)), block_size):
+        path_index, offsets, lengths = grid_chunk_arrays(grid, shape, chunks, start, start + block_size)
+        # chunk_keys goes last so that zip does not consume an extra key per block
+        for p, offset, length, index in zip(path_index.tolist(), offsets.tolist(), lengths.tolist(), chunk_keys):
+            chunk_key = ".".join(str(i) for i in index)
+            yield f"{key}/{chunk_key}", [paths[p], offset, length]
+
+# Version tag of the compact "grid" reference format
+GRID_REFERENCE_VERSION = "envi-grid-1"
+
+def parse_date(fname):
+    '''
+    Acquisition date of a SHIFT file, from the `YYYYMMDD` at the start of
+    its base name.
+    '''
+    basename = os.path.basename(fname)
+    dstring = re.match(r'\d{8}', basename)
+    assert dstring, f"No date at the start of file name {basename}."
+    date = datetime.datetime.strptime(dstring.group(), "%Y%m%d")
+    return np.datetime64(date)
+
+def envi_data_path(hdr_path):
+    '''
+    Path of the binary file of an ENVI header: `hdr_path` without its
+    ".hdr" suffix. (`str.rstrip(".hdr")` strips any trailing ".", "h",
+    "d" and "r" characters, e.g. "..._rdr.hdr" -> "..._".)
+    '''
+    assert hdr_path.endswith(".hdr"), f"Need path to HDR file, not binary. Got {hdr_path}."
+    return hdr_path[:-len(".hdr")]
+
+def default_output_file(hdr_path, output_format="json"):
+    return envi_data_path(hdr_path) + {"json": ".json", "parquet": ".parq", "grid": ".grid.json"}[output_format]
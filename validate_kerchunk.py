@@ -0,0 +1,246 @@
+import re
+
+import numpy as np
+import fsspec
+import ujson
+import zarr
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.reference import LazyReferenceMapper
+
+from utils import interleave_dims, envi_memmap, read_envi_region, grid_paths, grid_nchunks, \
+    grid_chunk_arrays
+from envi_store import EnviReferenceStore
+from batch_kerchunk import fetch_headers, fetch_infos
+from iostats import timed_phase, dump_stats
+
+# ENVI dimension of each dimension name used by the generators; "<name>_band"
+# dimensions of BIP band variables are bands as well
+envi_dim_names = {"line": "line", "y": "line", "sample": "sample", "x": "sample",
+                  "wavelength": "band", "band": "band"}
+
+def reference_extents(refs, grids, block_size=65536):
+    '''
+    Every file referenced by a reference set, with the end of the last
+    byte range read from it: `{path: end}`. Whole-file references count
+    with an end of 0. Grids are evaluated in blocks of `block_size` chunks
+    and Parquet references one record file at a time.
+    '''
+    extents = {}
+
+    def add(path, end):
+        extents[path] = max(extents.get(path, 0), int(end))
+
+    for var, grid in grids.items():
+        zarray = ujson.loads(refs[f"{var}/.zarray"])
+        paths = grid_paths(grid)
+        nchunks = int(np.prod(grid_nchunks(zarray["shape"], zarray["chunks"])))
+        for start in range(0, nchunks, block_size):
+            path_index, offsets, lengths = grid_chunk_arrays(grid, zarray["shape"], zarray["chunks"],
+                                                             start, start + block_size)
+            ends = np.zeros(len(paths), dtype=np.int64)
+            np.maximum.at(ends, path_index, offsets + lengths)
+            for path, end in zip(paths, ends.tolist()):
+                add(path, end)
+
+    if isinstance(refs, LazyReferenceMapper):
+        import pandas as pd
+        for key, zarray in refs.zmetadata.items():
+            if not key.endswith("/.zarray"):
+                continue
+            field = key[:-len("/.zarray")]
+            nchunks = int(np.prod(grid_nchunks(zarray["shape"], zarray["chunks"])))
+            for record in range(-(-nchunks // refs.record_size)):
+                columns = refs.open_refs(field, record)
+                if columns is None or "path" not in columns:
+                    continue
+                df = pd.DataFrame({c: columns[c] for c in ("path", "offset", "size")})
+                df = df[df["path"].notna()]
+                for path, end in (df["offset"] + df["size"]).groupby(df["path"]).max().items():
+                    add(path, end)
+        return extents
+
+    for val in refs.values():
+        if isinstance(val, list):
+            add(val[0], val[1] + val[2] if len(val) == 3 else 0)
+    return extents
+
+@timed_phase("check_ranges")
+def check_ranges(extents, concurrency=64, remote_options=None):
+    '''
+    Check that every file in `extents` (see `reference_extents`) exists
+    and is large enough for the byte ranges referencing it, with batched
+    concurrent `info` calls. Returns `{path: problem}`.
+    '''
+    infos = fetch_infos(list(extents), concurrency, remote_options)
+    problems = {}
+    for path, info in infos.items():
+        if isinstance(info, FileNotFoundError):
+            problems[path] = "Missing file."
+        elif isinstance(info, Exception):
+            problems[path] = f"{info!r}"
+        elif info.get("size") is not None and extents[path] > info["size"]:
+            problems[path] = f"References bytes up to {extents[path]}, but the file has {info['size']} bytes."
+    return problems
+
+def _band_index(meta, attrs):
+    # Band of a single-band variable, from the long name `band_variables` gives it
+    long_name = attrs.get("long_name")
+    band_names = meta.band_names or []
+    if long_name in band_names:
+        return band_names.index(long_name)
+    match = re.fullmatch(r"Band (\d+)", long_name or "")
+    return int(match.group(1)) if match else None
+
+def _direct_read(path, meta, region, memmaps, remote_options):
+    # Region of an ENVI file in (line, band, sample) order, read with a
+    # memory map for local files and with a ranged read otherwise
+    fs, local_path = fsspec.core.url_to_fs(path, **(remote_options or {}))
+    if not isinstance(fs, LocalFileSystem):
+        with fs.open(local_path, "rb") as f:
+            return read_envi_region(f, meta, region["line"], region["band"], region["sample"])
+    if path not in memmaps:
+        memmaps[path] = envi_memmap(local_path, meta)
+    dims = interleave_dims[meta.interleave]
+    block = memmaps[path][np.ix_(*(np.asarray(region[d]) for d in dims))]
+    return block.transpose([dims.index(d) for d in ("line", "band", "sample")])
+
+@timed_phase("check_samples")
+def check_samples(store, nchunks=8, seed=0, concurrency=64, remote_options=None, exclude=()):
+    '''
+    Read `nchunks` random chunks of every variable of `store` (an
+    `EnviReferenceStore`) and compare them with a direct read of the ENVI
+    file each chunk references, using the geometry of that file's header
+    (the data path plus ".hdr"). Variables whose chunks are inline, or
+    whose dimensions do not map to the file's lines, bands and samples,
+    are skipped, as are chunks of the files in `exclude`.
+
+    Returns `(checked, mismatches, skipped)`: the number of chunks
+    compared, the keys of those that differ, and `{variable: reason}`.
+    '''
+    rng = np.random.default_rng(seed)
+    samples = []
+    skipped = {}
+    for var in store.listdir():
+        if f"{var}/.zarray" not in store:
+            continue
+        zarray = ujson.loads(store[f"{var}/.zarray"])
+        if len(zarray["shape"]) < 2:
+            continue
+        nchunks_all = grid_nchunks(zarray["shape"], zarray["chunks"])
+        picks = rng.integers(0, nchunks_all, size=(min(nchunks, int(np.prod(nchunks_all))), len(nchunks_all)))
+        for index in np.unique(picks, axis=0):
+            key = f"{var}/" + ".".join(str(i) for i in index)
+            try:
+                ref = store.resolve(key)
+            except KeyError:
+                continue
+            if isinstance(ref, bytes) or len(ref) != 3:
+                skipped[var] = "Chunks are not byte ranges of a file."
+                break
+            if ref[0] not in exclude:
+                samples.append((var, tuple(index), ref[0]))
+
+    hdr_paths = sorted({f"{path}.hdr" for _, _, path in samples})
+    headers = fetch_headers(hdr_paths, concurrency, remote_options)
+    arrays = {}
+    memmaps = {}
+    checked = 0
+    mismatches = []
+    for var, index, path in samples:
+        if var in skipped:
+            continue
+        meta = headers[f"{path}.hdr"]
+        if isinstance(meta, Exception):
+            skipped[var] = f"Header of {path}: {meta!r}"
+            continue
+        if var not in arrays:
+            arrays[var] = zarr.open_array(store, path=var, mode="r")
+        array = arrays[var]
+        attrs = ujson.loads(store[f"{var}/.zattrs"]) if f"{var}/.zattrs" in store else {}
+        dims = [envi_dim_names.get(d, "band" if d.endswith("_band") else None)
+                for d in attrs.get("_ARRAY_DIMENSIONS", [])]
+        # Other axes (e.g. time) must select a whole file, one chunk at a time
+        if len(dims) != array.ndim or {"line", "sample"} - set(dims) or \
+                any(d is None and c != 1 for d, c in zip(dims, array.chunks)):
+            skipped[var] = f"Dimensions {attrs.get('_ARRAY_DIMENSIONS')} do not map to an ENVI file."
+            continue
+
+        slices = tuple(slice(i*c, min((i + 1)*c, n)) for i, c, n in zip(index, array.chunks, array.shape))
+        region = {d: range(s.start, s.stop) for d, s in zip(dims, slices) if d is not None}
+        if "band" not in region:
+            band = _band_index(meta, attrs)
+            if band is None:
+                skipped[var] = "Band of the variable unknown."
+                continue
+            region["band"] = [band]
+        expected = _direct_read(path, meta, region, memmaps, remote_options)
+        envi_dims = [d for d in dims if d is not None]
+        if "band" not in envi_dims:
+            expected = expected[:, 0, :]
+            expected = expected.transpose([("line", "sample").index(d) for d in envi_dims])
+        else:
+            expected = expected.transpose([("line", "band", "sample").index(d) for d in envi_dims])
+        actual = array[slices].reshape(expected.shape)
+        equal_nan = expected.dtype.kind in "fc"
+        checked += 1
+        if actual.dtype != expected.dtype or not np.array_equal(actual, expected, equal_nan=equal_nan):
+            mismatches.append(f"{var}/" + ".".join(str(i) for i in index))
+    return checked, mismatches, skipped
+
+def validate_references(fo, nchunks=8, seed=0, concurrency=64, storage_options=None,
+                        remote_options=None):
+    '''
+    Validate a reference set (JSON, grid JSON or Parquet): every referenced
+    file must exist and hold the referenced byte ranges (`check_ranges`),
+    and a random sample of chunks must match a direct read of the ENVI
+    files (`check_samples`). Files that fail the first check are not sampled.
+
+    Returns a report dictionary; `report["ok"]` is False if any file or
+    chunk failed.
+    '''
+    store = EnviReferenceStore(fo, remote_options=remote_options, storage_options=storage_options)
+    extents = reference_extents(store.refs, store.grids)
+    problems = check_ranges(extents, concurrency, remote_options)
+    checked = 0
+    mismatches = []
+    skipped = {}
+    if nchunks > 0:
+        checked, mismatches, skipped = check_samples(store, nchunks, seed, concurrency, remote_options,
+                                                     exclude=problems)
+    return {
+        "ok": not problems and not mismatches,
+        "files": len(extents),
+        "problems": problems,
+        "checked": checked,
+        "mismatches": mismatches,
+        "skipped": skipped
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Validate Kerchunk metadata of ENVI files")
+    parser.add_argument("reference_file", metavar="Reference path", type=str,
+                        help = "Path or S3 URL of the JSON, grid JSON or Parquet reference set.")
+    parser.add_argument("--sample", type=int, default=8,
+                        help = "Number of random chunks per variable to compare with the binary files. "
+                        "0 only checks files and byte ranges.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help = "Seed of the random chunk sample.")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help = "Maximum number of concurrent file requests.")
+    parser.add_argument("--stats", type=str, default=None,
+                        help = "Write I/O and timing statistics, with a Chrome trace, to this JSON file.")
+
+    args = parser.parse_args()
+    with dump_stats(args.stats):
+        report = validate_references(args.reference_file, args.sample, args.seed, args.concurrency)
+    print(f"Checked {report['files']} files and {report['checked']} chunks: "
+          f"{len(report['problems'])} file problems, {len(report['mismatches'])} mismatching chunks.")
+    for path, problem in report["problems"].items():
+        print(f"  {path}: {problem}")
+    for key in report["mismatches"]:
+        print(f"  {key}: does not match the binary file.")
+    for var, reason in report["skipped"].items():
+        print(f"  Skipped {var}: {reason}")
+    if not report["ok"]:
+        raise SystemExit(1)